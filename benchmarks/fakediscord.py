@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+# Discord bot: benchmarks/fakediscord.py
+
+# A local stand-in for Discord's REST API and gateway, so the real bot and cogs can be benchmarked offline.
+# It serves a synthetic world of guilds (each with a couple of roles, an events channel, a sessions channel and some
+# scheduled events), answers the REST routes the cogs use, and runs a gateway that sends HELLO, READY and a GUILD_CREATE
+# per guild to each shard that identifies. It runs on its own event loop in a thread, so its work doesn't count against
+# the bot's.
+# Point the bot at it by setting discord.http.Route.BASE to FakeDiscord.api_base before the bot logs in.
+# Every REST request is counted per route, and interactions pushed through the gateway are timed until their callback
+# (or first followup) comes back.
+
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+BOT_ID = 1000
+OWNER_ID = 2000
+FIRST_USER_ID = 3000
+EVENT_PING = "Event Ping"
+GAMING_PING = "Gaming Ping"
+ACTIVITIES = [
+    "Call of Duty",
+    "Fortnite",
+    "World of Warcraft",
+    "Minecraft",
+    "Factorio",
+    "Deep Rock Galactic",
+    "Valheim",
+    "Stardew Valley",
+]
+
+# Interaction types and callback types, from Discord's API.
+APPLICATION_COMMAND = 2
+AUTOCOMPLETE = 4
+DEFERRED_CHANNEL_MESSAGE = 5
+
+
+def _iso(when: datetime) -> str:
+    return when.isoformat()
+
+
+class World:
+    """The synthetic guilds. IDs are chosen so the guilds spread evenly over the shards."""
+
+    def __init__(self, guilds: int, *, events_per_guild: int = 3, shards: int = 1) -> None:
+        self.shards = shards
+        self.guild_ids = [(index + 1) << 22 for index in range(guilds)]
+        self.events_per_guild = events_per_guild
+        # Spread the events over the next two days, on quarter hours like Discord's event picker.
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        self.start = now - timedelta(minutes=now.minute % 15) + timedelta(minutes=15)
+        self.events: Dict[int, List[dict]] = {
+            guild_id: [self._event(guild_id, number) for number in range(events_per_guild)] for guild_id in self.guild_ids
+        }
+
+    @property
+    def admin_guild(self) -> int:
+        return self.guild_ids[0]
+
+    def shard_of(self, guild_id: int) -> int:
+        return (guild_id >> 22) % self.shards
+
+    @staticmethod
+    def event_ping(guild_id: int) -> int:
+        return guild_id + 1
+
+    @staticmethod
+    def gaming_ping(guild_id: int) -> int:
+        return guild_id + 2
+
+    @staticmethod
+    def events_channel(guild_id: int) -> int:
+        return guild_id + 3
+
+    @staticmethod
+    def sessions_channel(guild_id: int) -> int:
+        return guild_id + 4
+
+    def _event(self, guild_id: int, number: int) -> dict:
+        start = self.start + timedelta(minutes=15 * ((guild_id >> 22) % 8 + number * 37))
+        return {
+            "id": str(guild_id + 100 + number),
+            "guild_id": str(guild_id),
+            "channel_id": None,
+            "creator_id": str(OWNER_ID),
+            "name": f"Event {number} of {guild_id >> 22}",
+            "description": "",
+            "scheduled_start_time": _iso(start),
+            "scheduled_end_time": _iso(start + timedelta(hours=2)),
+            "privacy_level": 2,
+            "status": 1,
+            "entity_type": 3,
+            "entity_id": None,
+            "entity_metadata": {"location": "Somewhere"},
+            "user_count": number,
+        }
+
+    def role(self, guild_id: int, role_id: int, name: str, position: int) -> dict:
+        return {"id": str(role_id), "name": name, "permissions": "0", "position": position, "color": 0, "hoist": False,
+                "managed": False, "mentionable": True, "flags": 0}
+
+    def channel(self, guild_id: int, channel_id: int, name: str, position: int) -> dict:
+        return {"id": str(channel_id), "guild_id": str(guild_id), "type": 0, "name": name, "position": position,
+                "permission_overwrites": [], "nsfw": False, "parent_id": None, "topic": None, "rate_limit_per_user": 0}
+
+    def guild(self, guild_id: int) -> dict:
+        return {
+            "id": str(guild_id),
+            "name": f"Guild {guild_id >> 22}",
+            "owner_id": str(OWNER_ID),
+            "unavailable": False,
+            "large": False,
+            "member_count": 100,
+            "joined_at": _iso(datetime(2024, 1, 1, tzinfo=timezone.utc)),
+            "features": [],
+            "emojis": [],
+            "stickers": [],
+            "roles": [
+                self.role(guild_id, guild_id, "@everyone", 0),
+                self.role(guild_id, self.event_ping(guild_id), EVENT_PING, 1),
+                self.role(guild_id, self.gaming_ping(guild_id), GAMING_PING, 2),
+            ],
+            "channels": [
+                self.channel(guild_id, self.events_channel(guild_id), "events", 0),
+                self.channel(guild_id, self.sessions_channel(guild_id), "sessions", 1),
+            ],
+            "threads": [],
+            "members": [],
+            "presences": [],
+            "voice_states": [],
+            "stage_instances": [],
+            "guild_scheduled_events": self.events[guild_id],
+            "premium_tier": 0,
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "nsfw_level": 0,
+            "system_channel_flags": 0,
+            "preferred_locale": "en-US",
+        }
+
+    def member(self, guild_id: int, user_id: int, roles: List[int] = ()) -> dict:
+        return {
+            "user": self.user(user_id),
+            "roles": [str(role) for role in roles],
+            "joined_at": _iso(datetime(2024, 1, 1, tzinfo=timezone.utc)),
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+            "permissions": "2147483647",
+        }
+
+    def presence(self, guild_id: int, user_id: int) -> dict:
+        return {
+            "user": {"id": str(user_id)},
+            "guild_id": str(guild_id),
+            "status": "online",
+            "activities": [],
+            "client_status": {"desktop": "online"},
+        }
+
+    def message(self, guild_id: int, user_id: int, message_id: int) -> dict:
+        return {
+            "id": str(message_id),
+            "channel_id": str(self.sessions_channel(guild_id)),
+            "guild_id": str(guild_id),
+            "author": self.user(user_id),
+            "member": {key: value for key, value in self.member(guild_id, user_id).items() if key != "user"},
+            "content": "hello",
+            "timestamp": _iso(datetime.now(timezone.utc)),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {
+            "id": str(user_id),
+            "username": f"user{user_id}",
+            "global_name": None,
+            "discriminator": "0",
+            "avatar": None,
+            "bot": user_id == BOT_ID,
+        }
+
+
+class FakeDiscord:
+    """The REST API and gateway, on 127.0.0.1."""
+
+    def __init__(self, world: World) -> None:
+        self.world = world
+        self.port: Optional[int] = None
+        # REST requests per rate limit route, gateway sends from the bot per opcode.
+        self.rest_calls: Dict[str, int] = {}
+        self.gateway_sends: Dict[int, int] = {}
+        self.presence_updates: Dict[int, int] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._sockets: Dict[int, web.WebSocketResponse] = {}
+        self._sequence: Dict[int, itertools.count] = {}
+        self._ids = itertools.count(10 ** 17)
+        # Interaction ID -> (when it was pushed, the future its latency goes to).
+        self._pending: Dict[int, tuple] = {}
+        self._tokens: Dict[str, int] = {}
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/v10"
+
+    @property
+    def cat_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/thecatapi/v1/images/search"
+
+    # Lifecycle, called from the bot's thread.
+
+    def start(self) -> None:
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fake discord", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+
+    def rest_total(self) -> int:
+        return sum(self.rest_calls.values())
+
+    def counters(self) -> Dict[str, Any]:
+        return {
+            "rest_calls": dict(self.rest_calls),
+            "gateway_sends": dict(self.gateway_sends),
+            "presence_updates": dict(self.presence_updates),
+        }
+
+    def interact(
+        self, guild_id: int, kind: int, data: dict, *, user_id: int = FIRST_USER_ID, roles: List[int] = ()
+    ) -> "concurrent.futures.Future[float]":
+        """Send an INTERACTION_CREATE to the guild's shard. The future gets the seconds until the bot answered it."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        asyncio.run_coroutine_threadsafe(self._interact(guild_id, kind, data, user_id, list(roles), future), self._loop)
+        return future
+
+    def dispatch(self, shard_id: int, event: str, data: dict) -> None:
+        asyncio.run_coroutine_threadsafe(self._dispatch(shard_id, event, data), self._loop)
+
+    def flood(self, shard_id: int, event: str, payloads: List[dict]) -> "concurrent.futures.Future[None]":
+        """Send many events of one type to a shard, in order. The future is done once they're all sent."""
+        return asyncio.run_coroutine_threadsafe(self._flood(shard_id, event, payloads), self._loop)
+
+    # The server, on its own loop.
+
+    async def _start(self) -> None:
+        app = web.Application(middlewares=[self._count])
+        app.router.add_get("/gateway", self._gateway)
+        api = "/api/v10"
+        routes = [
+            ("GET", "/users/@me", lambda request: self.world.user(BOT_ID)),
+            ("GET", "/oauth2/applications/@me", self._application),
+            ("GET", "/gateway", lambda request: {"url": self._gateway_url()}),
+            ("GET", "/gateway/bot", self._gateway_bot),
+            ("PUT", "/applications/{application_id}/commands", self._sync_commands),
+            ("PUT", "/applications/{application_id}/guilds/{guild_id}/commands", self._sync_commands),
+            ("GET", "/guilds/{guild_id}/scheduled-events", self._scheduled_events),
+            ("GET", "/guilds/{guild_id}/members/{user_id}", self._member),
+            ("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}", None),
+            ("DELETE", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}", None),
+            ("POST", "/channels/{channel_id}/messages", self._message),
+            ("PATCH", "/channels/{channel_id}/messages/{message_id}", self._message),
+            ("GET", "/channels/{channel_id}/pins", lambda request: []),
+            ("GET", "/channels/{channel_id}/messages/pins", lambda request: {"items": [], "has_more": False}),
+            ("PUT", "/channels/{channel_id}/pins/{message_id}", None),
+            ("PUT", "/channels/{channel_id}/messages/pins/{message_id}", None),
+            ("POST", "/interactions/{interaction_id}/{token}/callback", self._callback),
+            ("POST", "/webhooks/{application_id}/{token}", self._followup),
+            ("PATCH", "/webhooks/{application_id}/{token}/messages/{message_id}", self._followup),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, api + path, self._wrap(handler))
+        # TheCatAPI, which isn't Discord and isn't counted with it.
+        app.router.add_get("/thecatapi/v1/images/search", self._wrap(self._cats))
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        if request.path.startswith("/api/"):
+            # Counted per route template, so 10,000 guilds don't make 10,000 entries.
+            route = f"{request.method} {request.match_info.route.resource.canonical[len('/api/v10'):]}"
+            self.rest_calls[route] = self.rest_calls.get(route, 0) + 1
+        response = await handler(request)
+        # Generous limits, so the bot's own rate limiting never kicks in.
+        response.headers["X-RateLimit-Limit"] = "1000"
+        response.headers["X-RateLimit-Remaining"] = "999"
+        response.headers["X-RateLimit-Reset-After"] = "1.0"
+        response.headers["X-RateLimit-Bucket"] = "bench"
+        return response
+
+    def _wrap(self, handler):
+        async def respond(request: web.Request) -> web.StreamResponse:
+            if handler is None:
+                return web.Response(status=204)
+            result = handler(request)
+            if asyncio.iscoroutine(result):
+                result = await result
+            # discord.py only parses the body when the content type is exactly application/json, without a charset.
+            return web.Response(body=json.dumps(result).encode("utf-8"), content_type="application/json")
+        return respond
+
+    def _gateway_url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}/gateway"
+
+    def _gateway_bot(self, request: web.Request) -> dict:
+        return {"url": self._gateway_url(), "shards": self.world.shards,
+                "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 16}}
+
+    def _application(self, request: web.Request) -> dict:
+        return {
+            "id": str(BOT_ID),
+            "name": "Bench",
+            "icon": None,
+            "description": "",
+            "rpc_origins": [],
+            "bot_public": False,
+            "bot_require_code_grant": False,
+            "owner": self.world.user(OWNER_ID),
+            "verify_key": "",
+            "team": None,
+            "flags": 0,
+            "summary": "",
+            "terms_of_service_url": None,
+            "privacy_policy_url": None,
+        }
+
+    async def _sync_commands(self, request: web.Request) -> list:
+        commands = await request.json()
+        guild_id = request.match_info.get("guild_id")
+        for command in commands:
+            command.update(id=str(next(self._ids)), application_id=str(BOT_ID), version="1", default_member_permissions=None)
+            if guild_id:
+                command["guild_id"] = guild_id
+        return commands
+
+    def _scheduled_events(self, request: web.Request) -> list:
+        return self.world.events.get(int(request.match_info["guild_id"]), [])
+
+    def _member(self, request: web.Request) -> dict:
+        return self.world.member(int(request.match_info["guild_id"]), int(request.match_info["user_id"]))
+
+    async def _message(self, request: web.Request) -> dict:
+        body = await request.json()
+        channel_id = request.match_info["channel_id"]
+        return self._message_payload(channel_id, body.get("content"), request.match_info.get("message_id"))
+
+    def _message_payload(self, channel_id: Optional[str], content: Optional[str], message_id: Optional[str] = None) -> dict:
+        return {
+            "id": message_id or str(next(self._ids)),
+            "channel_id": channel_id or "0",
+            "author": self.world.user(BOT_ID),
+            "content": content or "",
+            "timestamp": _iso(datetime.now(timezone.utc)),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+
+    async def _callback(self, request: web.Request) -> dict:
+        interaction_id = int(request.match_info["interaction_id"])
+        body = await request.json()
+        self._answered(interaction_id)
+        return {
+            "interaction": {
+                "id": str(interaction_id),
+                "type": APPLICATION_COMMAND,
+                "response_message_loading": body.get("type") == DEFERRED_CHANNEL_MESSAGE,
+                "response_message_ephemeral": False,
+            },
+            "resource": {"type": body.get("type")},
+        }
+
+    async def _followup(self, request: web.Request) -> dict:
+        body = await request.json()
+        interaction_id = self._tokens.get(request.match_info["token"])
+        if interaction_id is not None:
+            self._answered(interaction_id)
+        return self._message_payload(None, body.get("content"))
+
+    def _cats(self, request: web.Request) -> list:
+        limit = int(request.query.get("limit", 10))
+        return [
+            {"id": str(next(self._ids)), "url": f"https://cdn.example.invalid/cat/{next(self._ids)}.jpg"} for _ in range(limit)
+        ]
+
+    def _answered(self, interaction_id: int) -> None:
+        pending = self._pending.pop(interaction_id, None)
+        if pending is not None:
+            sent, future = pending
+            if not future.done():
+                future.set_result(time.perf_counter() - sent)
+
+    # The gateway
+
+    async def _gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": 41250}, "s": None, "t": None}))
+        shard_id = None
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+            op = payload.get("op")
+            self.gateway_sends[op] = self.gateway_sends.get(op, 0) + 1
+            if op == 1:
+                # discord.py notes when it sent a heartbeat only after the send returns, so an instant ack looks like a
+                # very late one.
+                asyncio.get_running_loop().call_later(
+                    0.05, lambda: asyncio.ensure_future(ws.send_str(json.dumps({"op": 11, "d": None, "s": None, "t": None})))
+                )
+            elif op == 2:
+                shard_id = (payload["d"].get("shard") or [0, 1])[0]
+                self._sockets[shard_id] = ws
+                self._sequence[shard_id] = itertools.count(1)
+                await self._ready(shard_id)
+            elif op == 3:
+                self.presence_updates[shard_id] = self.presence_updates.get(shard_id, 0) + 1
+        if shard_id is not None and self._sockets.get(shard_id) is ws:
+            del self._sockets[shard_id]
+        return ws
+
+    async def _ready(self, shard_id: int) -> None:
+        guild_ids = [guild_id for guild_id in self.world.guild_ids if self.world.shard_of(guild_id) == shard_id]
+        await self._dispatch(shard_id, "READY", {
+            "v": 10,
+            "user": self.world.user(BOT_ID),
+            "guilds": [{"id": str(guild_id), "unavailable": True} for guild_id in guild_ids],
+            "session_id": f"bench-{shard_id}",
+            "resume_gateway_url": self._gateway_url(),
+            "shard": [shard_id, self.world.shards],
+            "application": {"id": str(BOT_ID), "flags": 0},
+        })
+        for guild_id in guild_ids:
+            await self._dispatch(shard_id, "GUILD_CREATE", self.world.guild(guild_id))
+
+    async def _dispatch(self, shard_id: int, event: str, data: dict) -> None:
+        ws = self._sockets.get(shard_id)
+        if ws is None:
+            return
+        await ws.send_str(json.dumps({"op": 0, "t": event, "s": next(self._sequence[shard_id]), "d": data}))
+
+    async def _flood(self, shard_id: int, event: str, payloads: List[dict]) -> None:
+        for data in payloads:
+            await self._dispatch(shard_id, event, data)
+
+    async def _interact(
+        self, guild_id: int, kind: int, data: dict, user_id: int, roles: List[int], future: concurrent.futures.Future
+    ) -> None:
+        interaction_id = next(self._ids)
+        token = f"token{interaction_id}"
+        self._tokens[token] = interaction_id
+        channel_id = self.world.sessions_channel(guild_id)
+        payload = {
+            "id": str(interaction_id),
+            "application_id": str(BOT_ID),
+            "type": kind,
+            "data": data,
+            "guild_id": str(guild_id),
+            "channel_id": str(channel_id),
+            "channel": {
+                "id": str(channel_id),
+                "type": 0,
+                "guild_id": str(guild_id),
+                "name": "sessions",
+                "position": 1,
+                "permission_overwrites": [],
+            },
+            "member": self.world.member(guild_id, user_id, roles),
+            "token": token,
+            "version": 1,
+            "app_permissions": "2147483647",
+            "locale": "en-US",
+            "guild_locale": "en-US",
+            "entitlements": [],
+            "authorizing_integration_owners": {"0": str(guild_id)},
+            "context": 0,
+            "attachment_size_limit": 10485760,
+        }
+        self._pending[interaction_id] = (time.perf_counter(), future)
+        await self._dispatch(self.world.shard_of(guild_id), "INTERACTION_CREATE", payload)
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+# Discord bot: benchmarks/run.py
+
+# Offline benchmarks of the real bot and cogs against the stand-in Discord in fakediscord.py. Nothing here talks to Discord.
+#   python3 benchmarks/run.py run --guilds 10 --guilds 1000 --guilds 10000 --output results.json
+#   python3 benchmarks/run.py compare old.json new.json
+# Each guild count runs in its own process, in a temporary directory with a generated config.py and cogs/*_config files, so the
+# peak memory of one scale doesn't leak into the next and the real config is never touched. The results are JSON, so runs from
+# two commits can be compared with the compare command.
+# Measured for each scale:
+#   - startup: from bot.start() until the bot is ready;
+#   - events: how long EventsCog's refresh tick takes and how many REST calls it makes, cold (every guild stale) and warm;
+#   - randomstatus: how long a status change takes, how many presence updates it sends and how many it defers;
+#   - gateway: how long the bot takes to get through a burst of PRESENCE_UPDATE and MESSAGE_CREATE events it doesn't use
+#     (--skip-event sets gateway_skip_events instead of the bot's default);
+#   - interactions: latency percentiles from INTERACTION_CREATE to the bot's first answer, for /announce, /anygame,
+#     /ping_role_add_me, /ping_role_remove_me, /gimmeacat and /stats, and for /announce's activity autocomplete;
+#   - the peak RSS of the process (and the peak traced Python allocations, with --tracemalloc).
+# The httpclient command checks the bot's HTTP client (cogs/utils/httpclient.py) against a local stand-in server instead:
+#   python3 benchmarks/run.py httpclient
+
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+
+log = logging.getLogger("benchmarks")
+
+
+def percentiles(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "p50_ms": at(0.50),
+        "p90_ms": at(0.90),
+        "p99_ms": at(0.99),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def write_workdir(path: str, world, admin_guild: int, skip_events: Tuple[str, ...] = ()) -> None:
+    """A config.py and the cogs' config directories for the synthetic guilds."""
+    from fakediscord import ACTIVITIES, EVENT_PING, GAMING_PING
+
+    for directory in ("cogs/events_config", "cogs/announce_config", "cogs/randomstatus_config", "data", "logs"):
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    with open(os.path.join(path, "config.py"), "w") as file:
+        file.write(f"""discordbot_token = "bench"
+admin_guild = {admin_guild}
+admin_roles = {{{admin_guild}: {{"admin_role": "@everyone"}}}}
+initial_extensions = ("cogs.admin", "cogs.announce", "cogs.events", "cogs.randomstatus", "cogs.thecatapi")
+thecatapi_token = "bench"
+cache_profile = "minimal"
+watchdog = False
+store_path = "data/bench.sqlite3"
+""")
+        # Without --skip-event, the bot's default gateway_skip_events applies.
+        if skip_events:
+            file.write(f"gateway_skip_events = {tuple(skip_events)!r}\n")
+    for guild_id in world.guild_ids:
+        with open(os.path.join(path, "cogs/events_config", f"{guild_id}.yaml"), "w") as file:
+            file.write(
+                f'events_channel: {world.events_channel(guild_id)}\nping_role: "{EVENT_PING}"\nannounce_times: [0, 1, 24]\n'
+            )
+        with open(os.path.join(path, "cogs/announce_config", f"{guild_id}.yaml"), "w") as file:
+            activities = "".join(f'  - "{activity}"\n' for activity in ACTIVITIES)
+            file.write(
+                f'sessions_channel: {world.sessions_channel(guild_id)}\nping: "{GAMING_PING}"\nactivities:\n{activities}'
+            )
+    shutil.copy(
+        os.path.join(REPO, "cogs/randomstatus_config/statuses.yaml"),
+        os.path.join(path, "cogs/randomstatus_config/statuses.yaml"),
+    )
+
+
+async def timed(callback: Callable, fake) -> Dict[str, float]:
+    before = fake.rest_total()
+    started = time.perf_counter()
+    await callback()
+    return {"seconds": time.perf_counter() - started, "rest_calls": fake.rest_total() - before}
+
+
+async def run_interactions(fake, requests: List[tuple], concurrency: int, timeout: float = 15.0) -> Dict[str, Any]:
+    """Push (guild ID, type, data, roles) interactions through the gateway, concurrency at a time, and time the answers."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(guild_id: int, kind: int, data: dict, roles: List[int]) -> None:
+        nonlocal errors
+        async with semaphore:
+            try:
+                latencies.append(
+                    await asyncio.wait_for(asyncio.wrap_future(fake.interact(guild_id, kind, data, roles=roles)), timeout)
+                )
+            except asyncio.TimeoutError:
+                errors += 1
+
+    await asyncio.gather(*(one(*request) for request in requests))
+    return {**percentiles(latencies), "timeouts": errors}
+
+
+async def start_bot(bot) -> asyncio.Task:
+    """Start the bot and wait until it's ready. Returns the task running it."""
+    runner = asyncio.create_task(bot.start("bench"))
+    ready = asyncio.create_task(bot.wait_until_ready())
+    await asyncio.wait([ready, runner], timeout=600, return_when=asyncio.FIRST_COMPLETED)
+    if runner.done():
+        ready.cancel()
+        runner.result()
+        raise RuntimeError("The bot stopped before it was ready.")
+    if not ready.done():
+        raise TimeoutError("The bot wasn't ready after 10 minutes.")
+    return runner
+
+
+def command(name: str, *options: dict, guild_id: Optional[int] = None) -> dict:
+    data = {"id": "1", "name": name, "type": 1, "options": list(options)}
+    if guild_id is not None:
+        # Guild commands say which guild they belong to. That's how discord.py finds them in the tree.
+        data["guild_id"] = str(guild_id)
+    return data
+
+
+async def scenario(world, fake, *, interactions: int, concurrency: int, ticks: int, gateway_events: int) -> Dict[str, Any]:
+    import discord
+
+    from bot import DiscordBot
+    from fakediscord import ACTIVITIES, APPLICATION_COMMAND, AUTOCOMPLETE, FIRST_USER_ID
+
+    class BenchBot(DiscordBot):
+        # The real gateway wants 5 seconds between IDENTIFYs. This one doesn't.
+        async def before_identify_hook(self, shard_id: Optional[int], *, initial: bool = False) -> None:
+            pass
+
+        # Extensions are loaded as fresh modules, so TheCatAPI's URL can only be pointed at the fake once its cog is loaded.
+        async def load_extension(self, name: str, *, package: Optional[str] = None) -> None:
+            await super().load_extension(name, package=package)
+            if name == "cogs.thecatapi":
+                sys.modules[name].THECATAPI_URL = fake.cat_url
+
+    discord.http.Route.BASE = fake.api_base
+    results: Dict[str, Any] = {
+        "guilds": len(world.guild_ids),
+        "shards": world.shards,
+        "events_per_guild": world.events_per_guild,
+    }
+
+    async with BenchBot() as bot:
+        # Don't wait 2 seconds after the last GUILD_CREATE to decide a shard is ready.
+        bot._connection.guild_ready_timeout = 0.2
+        started = time.perf_counter()
+        runner = await start_bot(bot)
+        results["startup_seconds"] = time.perf_counter() - started
+        results["rest_calls_at_startup"] = fake.rest_total()
+
+        # The events cog's first refresh starts as soon as the bot is ready. Let it finish before measuring.
+        events = bot.get_cog("EventsCog")
+        deadline = time.monotonic() + 600
+        while any(
+            events.event_cache.needs_fetch(guild_id) or events.event_cache.is_provisional(guild_id)
+            for guild_id in world.guild_ids
+        ):
+            if time.monotonic() > deadline:
+                raise TimeoutError("The events cog's first refresh didn't finish.")
+            await asyncio.sleep(0.1)
+
+        events.event_cache.mark_stale(world.guild_ids)
+        cold = await timed(events.post_about_events, fake)
+        warm = [await timed(events.post_about_events, fake) for _ in range(ticks)]
+        results["events"] = {
+            "cold_tick": cold,
+            "warm_tick": {
+                **percentiles([tick["seconds"] for tick in warm]),
+                "rest_calls_per_tick": sum(tick["rest_calls"] for tick in warm) / max(1, len(warm)),
+            },
+            "announcement_jobs": sum(len(jobs) for jobs in events.announcement_jobs.values()),
+        }
+
+        status = bot.get_cog("RandomStatus")
+        presence_before = sum(fake.presence_updates.values())
+        updates = [await timed(status.update_status, fake) for _ in range(ticks)]
+        # Presence updates go over the gateway, so give the fake a moment to read them.
+        await asyncio.sleep(0.2)
+        # Each change is one presence update per shard, except those the cog held back for its per-shard budget.
+        results["randomstatus"] = {
+            **percentiles([update["seconds"] for update in updates]),
+            "presence_updates_per_change": (sum(fake.presence_updates.values()) - presence_before) / max(1, ticks),
+            "deferred_shards": len(status.deferred),
+        }
+
+        # Interactions go to guilds spread over the whole world, so per-guild caches don't flatter the numbers.
+        step = max(1, len(world.guild_ids) // max(1, interactions))
+        guilds = [world.guild_ids[(index * step) % len(world.guild_ids)] for index in range(interactions)]
+
+        activity = {"name": "activity", "type": 3, "value": "Fortnite"}
+        hours = {"name": "hours", "type": 4, "value": 2}
+        commands = {
+            "announce": [
+                (guild_id, APPLICATION_COMMAND, command("announce", activity, hours, guild_id=guild_id), [])
+                for guild_id in guilds
+            ],
+            "anygame": [
+                (guild_id, APPLICATION_COMMAND, command("anygame", hours, guild_id=guild_id), []) for guild_id in guilds
+            ],
+            "ping_role_add_me": [
+                (guild_id, APPLICATION_COMMAND, command("ping_role_add_me", guild_id=guild_id), []) for guild_id in guilds
+            ],
+            "ping_role_remove_me": [
+                (
+                    guild_id,
+                    APPLICATION_COMMAND,
+                    command("ping_role_remove_me", guild_id=guild_id),
+                    [world.gaming_ping(guild_id)],
+                )
+                for guild_id in guilds
+            ],
+            "gimmeacat": [(guild_id, APPLICATION_COMMAND, command("gimmeacat"), []) for guild_id in guilds],
+            "stats": [
+                (world.admin_guild, APPLICATION_COMMAND, command("stats", guild_id=world.admin_guild), []) for _ in guilds
+            ],
+        }
+        results["interactions"] = {}
+        for name, requests in commands.items():
+            before = fake.rest_total()
+            results["interactions"][name] = {
+                **await run_interactions(fake, requests, concurrency),
+                "rest_calls": fake.rest_total() - before,
+            }
+
+        prefixes = [name[:length] for name in ACTIVITIES for length in (1, 2, 4)]
+        autocomplete = [
+            (
+                guild_id,
+                AUTOCOMPLETE,
+                command(
+                    "announce",
+                    {"name": "activity", "type": 3, "value": prefixes[index % len(prefixes)], "focused": True},
+                    guild_id=guild_id,
+                ),
+                [],
+            )
+            for index, guild_id in enumerate(guilds)
+        ]
+        results["autocomplete"] = await run_interactions(fake, autocomplete, concurrency)
+
+        # Each burst is followed by an interaction on the same shard. Its answer means the bot got through everything
+        # before it.
+        guild_id = world.guild_ids[0]
+        shard_id = world.shard_of(guild_id)
+        bursts = {
+            "PRESENCE_UPDATE": [world.presence(guild_id, FIRST_USER_ID + index) for index in range(gateway_events)],
+            "MESSAGE_CREATE": [
+                world.message(guild_id, FIRST_USER_ID + index, 10**15 + index) for index in range(gateway_events)
+            ],
+        }
+        results["gateway"] = {}
+        for event, payloads in bursts.items():
+            started = time.perf_counter()
+            await asyncio.wrap_future(fake.flood(shard_id, event, payloads))
+            await asyncio.wait_for(asyncio.wrap_future(fake.interact(guild_id, AUTOCOMPLETE, autocomplete[0][2])), 60)
+            seconds = time.perf_counter() - started
+            results["gateway"][event.lower()] = {
+                "events": gateway_events,
+                "seconds": seconds,
+                "us_per_event": seconds / max(1, gateway_events) * 1e6,
+            }
+
+        await bot.close()
+        await asyncio.gather(runner, return_exceptions=True)
+
+    results["rest_calls_by_route"] = dict(sorted(fake.rest_calls.items()))
+    return results
+
+
+def measure(
+    guilds: int,
+    shards: int,
+    events_per_guild: int,
+    interactions: int,
+    concurrency: int,
+    ticks: int,
+    gateway_events: int,
+    skip_events: Tuple[str, ...],
+    trace_memory: bool,
+    keep: bool,
+) -> Dict[str, Any]:
+    """One scale, in this process.
+    Changes the working directory and sys.path, so it's only called from the scenario command."""
+    sys.path[:0] = [BENCHMARKS, REPO]
+    from fakediscord import FakeDiscord, World
+
+    world = World(guilds, events_per_guild=events_per_guild, shards=shards)
+    workdir = tempfile.mkdtemp(prefix="discordbot-bench-")
+    try:
+        write_workdir(workdir, world, world.admin_guild, skip_events)
+        os.chdir(workdir)
+        # config.py is in the working directory. The cogs package is still the repository's.
+        sys.path.insert(0, workdir)
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        fake = FakeDiscord(world)
+        fake.start()
+        try:
+            results = asyncio.run(
+                scenario(
+                    world, fake, interactions=interactions, concurrency=concurrency, ticks=ticks, gateway_events=gateway_events
+                )
+            )
+        finally:
+            fake.stop()
+        results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        if trace_memory:
+            results["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        return results
+    finally:
+        os.chdir(REPO)
+        if keep:
+            log.warning(f"Kept the working directory {workdir}.")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(data: Any, prefix: str = "") -> Dict[str, float]:
+    if isinstance(data, dict):
+        flat = {}
+        for key, value in data.items():
+            flat.update(flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    if isinstance(data, (int, float)) and not isinstance(data, bool):
+        return {prefix: float(data)}
+    return {}
+
+
+@click.group()
+def main() -> None:
+    logging.basicConfig(level=os.environ.get("BENCH_LOG", "WARNING"), format="[{levelname:<7}] {name}: {message}", style="{")
+
+
+@main.command()
+@click.option(
+    "--guilds",
+    "-g",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=(10, 100, 1000),
+    show_default=True,
+    help="Guild counts to run. Repeat for several.",
+)
+@click.option(
+    "--shards", type=click.IntRange(min=1), default=None, help="Shard count. Defaults to one per 2500 guilds, like Discord."
+)
+@click.option(
+    "--events",
+    "events_per_guild",
+    type=click.IntRange(min=0),
+    default=3,
+    show_default=True,
+    help="Scheduled events per guild.",
+)
+@click.option("--interactions", type=click.IntRange(min=1), default=200, show_default=True, help="Interactions per command.")
+@click.option(
+    "--concurrency", type=click.IntRange(min=1), default=20, show_default=True, help="Interactions in flight at once."
+)
+@click.option(
+    "--ticks",
+    type=click.IntRange(min=1),
+    default=5,
+    show_default=True,
+    help="Warm event refreshes and status changes to time.",
+)
+@click.option(
+    "--gateway-events", type=click.IntRange(min=1), default=5000, show_default=True, help="Events in each gateway burst."
+)
+@click.option(
+    "--skip-event", "skip_events", multiple=True, help="A gateway event type for gateway_skip_events. Repeat for several."
+)
+@click.option(
+    "--tracemalloc",
+    "trace_memory",
+    is_flag=True,
+    help="Also report the peak traced Python allocations. Makes everything slower.",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the results here instead of stdout.",
+)
+def run(
+    guilds, shards, events_per_guild, interactions, concurrency, ticks, gateway_events, skip_events, trace_memory, output
+) -> None:
+    """Run the benchmarks at each guild count."""
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": [],
+    }
+    for count in guilds:
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "scenario",
+            "--guilds",
+            str(count),
+            "--shards",
+            str(shards or count // 2500 + 1),
+            "--events",
+            str(events_per_guild),
+            "--interactions",
+            str(interactions),
+            "--concurrency",
+            str(concurrency),
+            "--ticks",
+            str(ticks),
+            "--gateway-events",
+            str(gateway_events),
+        ]
+        for event in skip_events:
+            command += ["--skip-event", event]
+        if trace_memory:
+            command.append("--tracemalloc")
+        click.echo(f"Running {count} guild(s)...", err=True)
+        finished = subprocess.run(command, cwd=REPO, stdout=subprocess.PIPE, text=True)
+        if finished.returncode != 0:
+            report["results"].append({"guilds": count, "error": f"exited with {finished.returncode}"})
+            continue
+        report["results"].append(json.loads(finished.stdout))
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    else:
+        click.echo(text)
+
+
+@main.command("scenario", hidden=True)
+@click.option("--guilds", type=int, required=True)
+@click.option("--shards", type=int, default=1)
+@click.option("--events", "events_per_guild", type=int, default=3)
+@click.option("--interactions", type=int, default=200)
+@click.option("--concurrency", type=int, default=20)
+@click.option("--ticks", type=int, default=5)
+@click.option("--gateway-events", type=int, default=5000)
+@click.option("--skip-event", "skip_events", multiple=True)
+@click.option("--tracemalloc", "trace_memory", is_flag=True)
+@click.option("--keep", is_flag=True, help="Keep the temporary working directory.")
+def scenario_command(
+    guilds, shards, events_per_guild, interactions, concurrency, ticks, gateway_events, skip_events, trace_memory, keep
+) -> None:
+    """One guild count, in this process. The run command starts one of these per count."""
+    click.echo(
+        json.dumps(
+            measure(
+                guilds,
+                shards,
+                events_per_guild,
+                interactions,
+                concurrency,
+                ticks,
+                gateway_events,
+                tuple(skip_events),
+                trace_memory,
+                keep,
+            )
+        )
+    )
+
+
+async def stand_in_server(state: Dict[str, str]):
+    """A server on a free local port that fails, hangs or answers depending on state["mode"]. Returns its AppRunner."""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        if state["mode"] == "hang":
+            await asyncio.sleep(30)
+        return web.json_response({"ok": True}, status=503 if state["mode"] == "down" else 200)
+
+    app = web.Application()
+    app.router.add_get("/", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+async def check_httpclient() -> List[Tuple[str, bool, str]]:
+    """Drive the HTTP client's circuit breaker through a failing, hanging and recovered stand-in server."""
+    from types import SimpleNamespace
+
+    sys.path.insert(0, REPO)
+    from cogs.utils import httpclient
+    from cogs.utils.metrics import Registry
+
+    state = {"mode": "down"}
+    runner = await stand_in_server(state)
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/"
+
+    checks = []
+    httpclient.CIRCUIT_RESET = 0.2
+    client = httpclient.HTTPClient(
+        SimpleNamespace(metrics=SimpleNamespace(registry=Registry())), hosts={"127.0.0.1": {"retries": 0, "timeout": 5}}
+    )
+    await client.start()
+    host = client.host("127.0.0.1")
+    try:
+        for _ in range(httpclient.CIRCUIT_FAILURES):
+            await client.request("GET", url)
+        checks.append(("opens after failures", host.circuit.state == httpclient.OPEN, host.circuit.state))
+        try:
+            await client.request("GET", url)
+            checks.append(("fails fast while open", False, "the request was sent"))
+        except httpclient.CircuitOpen:
+            checks.append(("fails fast while open", True, ""))
+
+        # The half-open trial is cancelled before the server answers. The next request has to be allowed to be the trial.
+        await asyncio.sleep(httpclient.CIRCUIT_RESET)
+        state["mode"] = "hang"
+        try:
+            await asyncio.wait_for(client.request("GET", url), 0.2)
+        except asyncio.TimeoutError:
+            pass
+        state["mode"] = "up"
+        try:
+            response = await client.request("GET", url)
+            checks.append(
+                (
+                    "recovers after a cancelled trial",
+                    response.status == 200 and host.circuit.state == httpclient.CLOSED,
+                    host.circuit.state,
+                )
+            )
+        except httpclient.CircuitOpen as e:
+            checks.append(("recovers after a cancelled trial", False, f"CircuitOpen: {e}"))
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return checks
+
+
+@main.command("httpclient")
+def httpclient_command() -> None:
+    """Check the HTTP client's circuit breaker against a local stand-in server."""
+    checks = asyncio.run(check_httpclient())
+    for name, passed, detail in checks:
+        click.echo(f"{'ok  ' if passed else 'FAIL'} {name}{f' ({detail})' if detail and not passed else ''}")
+    if not all(passed for _, passed, _ in checks):
+        sys.exit(1)
+
+
+@main.command()
+@click.argument("old", type=click.File("r"))
+@click.argument("new", type=click.File("r"))
+@click.option("--threshold", type=float, default=10.0, show_default=True, help="Mark changes bigger than this many percent.")
+def compare(old, new, threshold) -> None:
+    """Compare two result files, scale by scale."""
+    old_results = {result["guilds"]: result for result in json.load(old)["results"]}
+    new_results = {result["guilds"]: result for result in json.load(new)["results"]}
+    for guilds in sorted(set(old_results) & set(new_results)):
+        click.echo(f"{guilds} guild(s):")
+        before, after = flatten(old_results[guilds]), flatten(new_results[guilds])
+        for key in sorted(set(before) & set(after)):
+            if key.startswith("rest_calls_by_route.") or before[key] == after[key]:
+                continue
+            change = (after[key] - before[key]) / before[key] * 100 if before[key] else float("inf")
+            mark = " !" if abs(change) > threshold else ""
+            click.echo(f"  {key:<55} {before[key]:>12.3f} {after[key]:>12.3f} {change:>+8.1f}%{mark}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,31 @@
 #!/usr/bin/env python3
 # Discord bot: bot.py
 
+import asyncio
 import logging
+import os
+import time
+from typing import List, Optional
 
 import aiohttp
 import discord
 from discord.ext import commands
 
 import config
+from cogs.utils.cacheprofile import CacheProfile
+from cogs.utils.cluster import SECRET_ENV, ClusterClient
+from cogs.utils.configstore import ConfigStore
+from cogs.utils.dispatcher import Dispatcher
+from cogs.utils.gatewayprofile import DEFAULT_SKIP, GatewayProfiler
+from cogs.utils.httpclient import HTTPClient
+from cogs.utils.metrics import BotMetrics, MeteredCommandTree
+from cogs.utils.reloader import ExtensionReloader
+from cogs.utils.resolver import GuildResolver
+from cogs.utils.scheduler import Scheduler
+from cogs.utils.startup import StartupReport, declared_dependencies, load_waves
+from cogs.utils.store import Store
+from cogs.utils.treesync import TreeSync
+from cogs.utils.watchdog import LoopWatchdog
 
 description = """Hello! I am DiscordBot."""
 
@@ -17,47 +35,165 @@ log = logging.getLogger("discord")
 class DiscordBot(commands.AutoShardedBot):
     bot_app_info: discord.AppInfo
 
-    def __init__(self) -> None:
+    # In cluster mode (launcher.py cluster), each worker process runs the shards in shard_ids and talks to the
+    # supervisor on cluster_port.
+    # With data_directory, the store and the config indexes are kept there instead of where the config file says
+    # (launcher.py coldstart).
+    def __init__(
+        self,
+        *,
+        shard_ids: Optional[List[int]] = None,
+        shard_count: Optional[int] = None,
+        cluster_id: Optional[int] = None,
+        cluster_port: Optional[int] = None,
+        data_directory: Optional[str] = None,
+    ) -> None:
+        self.startup = StartupReport()
         allowed_mentions = discord.AllowedMentions(roles=False, everyone=False, users=True)
-        # use the default non-privileged intents and allow the config to opt-in to
-        # the three privileged intents separately.  This keeps the common case
-        # simple while still giving us explicit control over presences,
-        # members and message content.  The config file can define boolean
-        # flags such as ``intent_presences`` etc. (see config.py example below).
-
-        intents = discord.Intents.default()
-        # Privileged intents
-        intents.presences = True
-        intents.members = False
-        intents.message_content = False
+        # Intents, member cache, message cache and chunking come from cache_profile in the config file. See
+        # cogs/utils/cacheprofile.py.
+        self.cache_profile = CacheProfile.from_config(getattr(config, "cache_profile", "default"))
+        # The dispatcher reads the rate limit headers of every response through this, and the metrics time every request.
+        http_trace = aiohttp.TraceConfig()
 
         super().__init__(
             command_prefix="!",
             description=description,
-            chunk_guilds_at_startup=False,
-            heartbeat_timeout=150.0,
+            chunk_guilds_at_startup=self.cache_profile.chunk_guilds_at_startup,
+            member_cache_flags=self.cache_profile.member_cache_flags,
+            max_messages=self.cache_profile.max_messages,
+            # Long enough that a slow guild stream doesn't drop a shard. Stalls of the loop itself are reported by the
+            # watchdog instead.
+            heartbeat_timeout=getattr(config, "heartbeat_timeout", 150.0),
             allowed_mentions=allowed_mentions,
-            intents=intents,
+            intents=self.cache_profile.intents,
             enable_debug_events=False,
+            tree_cls=MeteredCommandTree,
+            http_trace=http_trace,
             activity=discord.Activity(type=discord.ActivityType.listening, name="Responding to pings"),
+            shard_ids=shard_ids,
+            shard_count=shard_count,
         )
 
+        self.metrics = BotMetrics(self)
+        self.metrics.attach(http_trace)
+        # Gateway accounting (gateway_profile) and event types that aren't worth parsing (gateway_skip_events).
+        self.gateway = GatewayProfiler(
+            self, profile=getattr(config, "gateway_profile", False), skip=getattr(config, "gateway_skip_events", DEFAULT_SKIP)
+        )
+        self.gateway.install()
+        self.dispatcher = Dispatcher(self, maxsize=getattr(config, "dispatcher_queue_size", 1000))
+        self.dispatcher.attach(http_trace)
+        # For everything the cogs fetch from outside Discord.
+        self.http_client = HTTPClient(self, hosts=getattr(config, "http_hosts", None))
+        # Shared by all cogs, so they don't each need their own tasks.loop.
+        self.scheduler = Scheduler()
+        self.resolver = GuildResolver(self)
+        index_directory = getattr(config, "config_index_directory", "data/configindex")
+        store_path = getattr(config, "store_path", "data/discordbot.sqlite3")
+        if data_directory is not None:
+            index_directory = os.path.join(data_directory, "configindex")
+            store_path = os.path.join(data_directory, "discordbot.sqlite3")
+        self.config_store = ConfigStore(self, index_directory=index_directory)
+        # State that survives restarts. Cluster workers share the file.
+        self.store = Store(store_path, name="main" if cluster_id is None else f"cluster{cluster_id}")
+        self.cluster: Optional[ClusterClient] = None
+        if cluster_id is not None:
+            self.cluster = ClusterClient(self, cluster_id, cluster_port, os.environ[SECRET_ENV])
+            # Each worker syncs its own guilds. Only the first one syncs the global commands.
+            self.tree_sync = TreeSync(self.tree, self.store, include_global=cluster_id == 0)
+        else:
+            self.tree_sync = TreeSync(self.tree, self.store)
+        self.reloader = ExtensionReloader(self)
+        self.watchdog: Optional[LoopWatchdog] = None
+
+    # Everything the cogs need that doesn't involve connecting to Discord.
+    # measure_only is for launcher.py coldstart: only what loading the extensions needs, nothing that reports or keeps running.
+    async def start_services(self, *, measure_only: bool = False) -> None:
+        await self.http_client.start()
+        await self.store.open()
+        self.scheduler.start()
+        self.dispatcher.start()
+        if measure_only:
+            return
+        # How far back the events cog looks for announcements it missed after a crash.
+        self.scheduler.every(self.store.touch_alive, seconds=60, name="store: last alive")
+        metrics_port = getattr(config, "metrics_port", None)
+        if metrics_port and self.cluster is not None:
+            metrics_port += self.cluster.cluster_id
+        await self.metrics.start(getattr(config, "metrics_host", "127.0.0.1"), metrics_port)
+        if self.cluster is not None:
+            await self.cluster.connect()
+        if getattr(config, "watchdog", True) and self.watchdog is None:
+            self.watchdog = LoopWatchdog(
+                threshold=getattr(config, "watchdog_threshold", 0.5),
+                systemd=getattr(config, "systemd_watchdog", False),
+                on_stall=lambda stall: self.metrics.loop_stalls.inc(stall.cog or "none"),
+            )
+            self.watchdog.start_watching()
+
     async def setup_hook(self) -> None:
-        self.session = aiohttp.ClientSession()
+        self.startup.mark("setup_hook")
+        log.info(f"Cache profile: {self.cache_profile}")
+        await self.start_services()
 
         self.bot_app_info = await self.application_info()
         self.owner_id = self.bot_app_info.owner.id
 
-        for extension in config.initial_extensions:
-            try:
-                await self.load_extension(extension)
-            except Exception as e:
-                log.exception(f"Failed to load extension {extension}. {e}")
+        await self.load_initial_extensions()
+        self.startup.mark("extensions loaded")
+        self.gateway.check_skipped()
 
         # Add the list of all connected guilds to the log
         for guild in self.guilds:
             log.info(f"Connected to guild: {guild} (ID: {guild.id})")
 
+    # Extensions that don't depend on each other are loaded at the same time. Ones with dependencies wait for them.
+    # With sequential, each wave is loaded one extension after another instead, so every extension's time is its own
+    # (launcher.py coldstart). Loaded at the same time, an extension's time includes whatever the others did while it waited.
+    async def load_initial_extensions(self, *, sequential: bool = False) -> None:
+        dependencies = {extension: declared_dependencies(extension) for extension in config.initial_extensions}
+        for extension, extra in getattr(config, "extension_dependencies", {}).items():
+            dependencies[extension] = tuple(dependencies.get(extension, ())) + tuple(extra)
+
+        failed = set()
+        self.startup.sequential = sequential
+        for wave, extensions in enumerate(load_waves(config.initial_extensions, dependencies)):
+            if sequential:
+                for extension in extensions:
+                    await self._load_initial_extension(extension, wave, dependencies, failed)
+            else:
+                await asyncio.gather(
+                    *(self._load_initial_extension(extension, wave, dependencies, failed) for extension in extensions)
+                )
+
+    async def _load_initial_extension(self, extension: str, wave: int, dependencies: dict, failed: set) -> None:
+        missing = [dependency for dependency in dependencies.get(extension, ()) if dependency in failed]
+        if missing:
+            failed.add(extension)
+            log.error(f"Not loading extension {extension} because {', '.join(missing)} failed to load.")
+            self.startup.extension_loaded(extension, wave, 0.0, RuntimeError(f"dependency {', '.join(missing)} failed"))
+            return
+        started = time.perf_counter()
+        try:
+            await self.load_extension(extension)
+        except Exception as e:
+            failed.add(extension)
+            log.exception(f"Failed to load extension {extension}. {e}")
+            self.startup.extension_loaded(extension, wave, time.perf_counter() - started, e)
+        else:
+            self.startup.extension_loaded(extension, wave, time.perf_counter() - started)
+
+    async def add_cog(self, cog: commands.Cog, /, **kwargs) -> None:
+        # Refuse a cog that needs an intent or cache the cache profile leaves out, instead of letting it quietly never
+        # get its events.
+        self.cache_profile.check(cog)
+        started = time.perf_counter()
+        try:
+            await super().add_cog(cog, **kwargs)
+        finally:
+            self.startup.add_setup_time(cog.__module__, time.perf_counter() - started)
+
     @property
     def owner(self) -> discord.User:
         return self.bot_app_info.owner
@@ -65,28 +201,71 @@ class DiscordBot(commands.AutoShardedBot):
     async def on_ready(self) -> None:
         if not hasattr(self, "startuptime"):
             self.startuptime = discord.utils.utcnow()
+            self.startup.mark("ready")
+            log.info(f"Startup report: {self.startup.to_json()}")
 
             # It's not recommended to sync the command tree in on_ready because it can be called multiple times rather than just once when the bot loads. Everyone recommends having a sync command, but how do you implement a command if you don't sync it first? So, the sync commands are in the admin_guild's command tree, so we'll only sync those on_ready, so you can at least resync all using the command if you need to.
             # Maybe the correct solution is to use a regular command rather than an app_command to do syncing.
-            await self.tree.sync(guild=discord.Object(id=config.admin_guild))
+            # TreeSync only actually syncs if the admin guild's commands changed since the last time, so restarts don't
+            # burn the rate limit.
+            if self.has_guild_shard(config.admin_guild):
+                await self.tree_sync.sync([config.admin_guild])
 #            await self.tree.sync()
+            if self.cluster is not None:
+                await self.cluster.ready()
 
         if self.user:
             log.info("Ready: %s (ID: %s)", self.user, self.user.id)
         for guild in self.guilds:
             log.info(f"Bot is in guild: {guild.name} (ID: {guild.id})")
 
+    # Whether a guild is on one of this process's shards.
+    def has_guild_shard(self, guild_id: int) -> bool:
+        if self.shard_ids is None:
+            return True
+        return (guild_id >> 22) % (self.shard_count or 1) in self.shard_ids
+
+    async def on_shard_ready(self, shard_id: int) -> None:
+        self.startup.shard_ready(shard_id)
+
     async def on_shard_resumed(self, shard_id: int) -> None:
         log.info("Shard ID %s has resumed...", shard_id)
 
-    async def on_message(self, message: discord.Message) -> None:
-        if message.author.bot:
-            return
-        await self.process_commands(message)
+    # Fingerprint each extension as it's loaded, so the reloader can tell later whether its source changed.
+    async def load_extension(self, name: str, *, package: Optional[str] = None) -> None:
+        await super().load_extension(name, package=package)
+        await self.reloader.record(self._resolve_name(name, package))
+
+    async def reload_extension(self, name: str, *, package: Optional[str] = None) -> None:
+        await super().reload_extension(name, package=package)
+        await self.reloader.record(self._resolve_name(name, package))
+
+    async def unload_extension(self, name: str, *, package: Optional[str] = None) -> None:
+        await super().unload_extension(name, package=package)
+        self.reloader.forget(self._resolve_name(name, package))
+
+    # Cancel any scheduled jobs and config subscriptions a cog registered when it's removed (which includes unloading
+    # and reloading it).
+    async def remove_cog(self, name: str, /, **kwargs) -> Optional[commands.Cog]:
+        cog = await super().remove_cog(name, **kwargs)
+        if cog is not None:
+            self.scheduler.cancel_owner(cog)
+            self.config_store.unsubscribe_owner(cog)
+            if self.cluster is not None:
+                self.cluster.unhandle_owner(cog)
+        return cog
 
     async def close(self) -> None:
+        if self.cluster is not None:
+            await self.cluster.close()
         await super().close()
-        await self.session.close()
+        await self.scheduler.close()
+        await self.dispatcher.close()
+        await self.metrics.close()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        await self.store.close()
+        await self.http_client.close()
 
     async def start(self, token: str, *, reconnect: bool = True) -> None:
         await super().start(token, reconnect=reconnect)
@@ -4,11 +4,14 @@
 # Note: Remember to use "cogs.<cogname>" when using load/unload/reload. Example: "/reload cogs.admin"
 
 import logging
+from typing import Any, Dict, Tuple
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
+from cogs.utils.logqueue import Actor, interaction_extra
+from cogs.utils.metrics import format_summary, merge_snapshots
 from config import admin_guild, admin_roles
 
 log = logging.getLogger("discord")
@@ -16,43 +19,104 @@ log = logging.getLogger("discord")
 
 class AdminCog(commands.Cog):
     """Admin-only commands that make the bot dynamic."""
+    # The admin check looks up the admin roles in the guild's role cache.
+    requires_intents = ("guilds",)
 
     def __init__(self, bot) -> None:
         self.bot = bot
         self.sessions: set[int] = set()
 
+    async def cog_load(self) -> None:
+        if self.bot.cluster is not None:
+            for command, handler in self.cluster_handlers().items():
+                self.bot.cluster.handle(command, handler, owner=self)
+
+    # What reload_all, resync, stats and gateway do in each process. In cluster mode they're broadcast to every process.
+    def cluster_handlers(self) -> Dict[str, Any]:
+        return {
+            "reload_all": self.reload_all_here,
+            "resync": self.resync_here,
+            "stats": self.stats_here,
+            "gateway": self.gateway_here,
+        }
+
+    async def reload_all_here(self, force: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+        # Cogs whose source didn't change are left alone, and a cog that fails to reload keeps running its previous version.
+        report = await self.bot.reloader.reload(force=force, dry_run=dry_run)
+        return {"text": str(report), "failed": bool(report.failed)}
+
+    async def resync_here(self, force: bool = False) -> Dict[str, Any]:
+        report = await self.bot.tree_sync.sync(force=force)
+        return {"text": str(report), "failed": bool(report.failed)}
+
+    async def stats_here(self) -> Dict[str, Any]:
+        return self.bot.metrics.snapshot()
+
+    async def gateway_here(self, top: int = 15) -> Dict[str, Any]:
+        return {"text": self.bot.gateway.report(top)}
+
+    async def everywhere(self, command: str, **args) -> Dict[int, Any]:
+        """Run a command in every process of the cluster (or just this one, if the bot isn't clustered).
+        Results are by cluster ID."""
+        if self.bot.cluster is not None:
+            return await self.bot.cluster.broadcast(command, **args)
+        return {0: await self.cluster_handlers()[command](**args)}
+
+    @staticmethod
+    def combine(results: Dict[int, Any]) -> Tuple[str, bool]:
+        """The text results of every process in one message, and whether any of them failed."""
+        if len(results) == 1:
+            result = next(iter(results.values()))
+            return result.get("text") or result.get("error", ""), bool(result.get("failed") or "error" in result)
+        lines = [
+            f"Cluster {cluster_id}: {result.get('text') or result.get('error', '')}" for cluster_id, result in results.items()
+        ]
+        return "\n".join(lines), any(result.get("failed") or "error" in result for result in results.values())
+
     # Prevent a command from being run by anyone other than a bot admin (currently only the bot owner)
     async def verify_user_is_owner(self, ctx: discord.Interaction) -> bool:
         if ctx.user.id != self.bot.owner_id:
             await ctx.response.send_message("Only the bot owner can use this command.", ephemeral=True)
-            command_name = getattr(getattr(ctx, "command", None), "name", "unknown")
-            log.error(f"User {ctx.user} tried to use {command_name}, but is not the bot owner.")
+            log.error(
+                "User %s tried to use %s, but is not the bot owner.",
+                ctx.user,
+                getattr(ctx.command, "name", "unknown"),
+                extra=interaction_extra(ctx),
+            )
             return False
         else:
             return True
 
     async def verify_user_is_admin(self, ctx: discord.Interaction) -> bool:
-        command_name = getattr(getattr(ctx, "command", None), "name", "unknown")
         user = getattr(ctx, "user", None)
         guild = getattr(ctx, "guild", None)
-        user_name = getattr(user, "name", None) or getattr(user, "display_name", "unknown")
-        guild_name = getattr(guild, "name", "unknown")
 
         if not guild or guild.id not in admin_roles:
             await ctx.response.send_message("This command is not allowed to be used in this server.", ephemeral=True)
-            log.error(f"{user_name} tried to use {command_name} in {guild_name}, but this guild is not in the admin_roles in the config file.")
+            log.error(
+                "%s tried to use %s in %s, but this guild is not in the admin_roles in the config file.",
+                getattr(user, "name", "unknown"),
+                getattr(ctx.command, "name", "unknown"),
+                getattr(guild, "name", "unknown"),
+                extra=interaction_extra(ctx),
+            )
             return False
 
         admin_role = admin_roles[guild.id]["admin_role"]
+        admin_role_ids = self.bot.resolver.admin_role_ids(guild)
         user_roles = getattr(user, "roles", [])
-        user_is_admin = False
-        for user_role in user_roles:
-            if getattr(user_role, "name", None) == admin_role:
-                user_is_admin = True
-                break
+        user_is_admin = any(user_role.id in admin_role_ids for user_role in user_roles)
         if not user_is_admin:
             await ctx.response.send_message("You do not have permission to run this command.", ephemeral=True)
-            log.error(f"{user_name} tried to use {command_name} in {guild_name}, but was not in the role '{admin_role}'. ({user_roles})")
+            log.error(
+                "%s tried to use %s in %s, but was not in the role '%s'. (%s)",
+                getattr(user, "name", "unknown"),
+                getattr(ctx.command, "name", "unknown"),
+                guild.name,
+                admin_role,
+                user_roles,
+                extra=interaction_extra(ctx),
+            )
             return False
 
         return True
@@ -65,15 +129,13 @@ class AdminCog(commands.Cog):
             try:
                 await self.bot.load_extension(cog)
                 await ctx.response.send_message(f"Cog {cog} **loaded** successfully. 👌", ephemeral=True)
-                user_name = getattr(getattr(ctx, "user", None), "name", None) or getattr(getattr(ctx, "user", None), "display_name", "unknown")
-                guild_name = getattr(getattr(ctx, "guild", None), "name", "unknown")
-                log.info(f"Cog {cog} **loaded** successfully. ({user_name} in {guild_name})")
+                log.info("Cog %s **loaded** successfully. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
             except commands.ExtensionNotFound:
                 await ctx.response.send_message(f"Cog {cog} __not found__. 👎", ephemeral=True)
-                log.error(f"Tried to load {cog}, but it wasn't found. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.error("Tried to load %s, but it wasn't found. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
             except commands.ExtensionError as e:
                 await ctx.response.send_message(f"{e.__class__.__name__}: {e}", ephemeral=True)
-                log.error(f"Tried to load {cog}, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.error("Tried to load %s, but failed. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
 
     @app_commands.command()
     @app_commands.guilds(discord.Object(id=admin_guild))
@@ -83,10 +145,10 @@ class AdminCog(commands.Cog):
             try:
                 await self.bot.unload_extension(cog)
                 await ctx.response.send_message(f"Cog {cog} **unloaded** successfully. 👌", ephemeral=True)
-                log.info(f"Cog {cog} unloaded successfully. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.info("Cog %s unloaded successfully. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
             except commands.ExtensionError as e:
                 await ctx.response.send_message(f"{e.__class__.__name__}: {e}", ephemeral=True)
-                log.error(f"Tried to unload {cog}, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.error("Tried to unload %s, but failed. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
 
     @app_commands.command()
     @app_commands.guilds(discord.Object(id=admin_guild))
@@ -96,37 +158,47 @@ class AdminCog(commands.Cog):
             try:
                 await self.bot.load_extension(cog)
                 await ctx.response.send_message(f"Cog {cog} __loaded__ successfully. 👌", ephemeral=True)
-                log.info(f"Cog {cog} loaded successfully using the reload command. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.info(
+                    "Cog %s loaded successfully using the reload command. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx)
+                )
                 return
             except commands.ExtensionAlreadyLoaded:
                 try:
                     await self.bot.reload_extension(cog)
                     await ctx.response.send_message(f"Cog {cog} **reloaded** successfully. 👌", ephemeral=True)
-                    log.info(f"Cog {cog} reloaded successfully. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                    log.info("Cog %s reloaded successfully. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
                 except commands.ExtensionError as e:
                     await ctx.response.send_message(f"{e.__class__.__name__}: {e}", ephemeral=True)
-                    log.error(f"Tried to reload {cog}, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                    log.error("Tried to reload %s, but failed. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
             except commands.ExtensionError as e:
                 await ctx.response.send_message(f"{e.__class__.__name__}: {e}", ephemeral=True)
-                log.error(f"Tried to reload {cog}, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                log.error("Tried to reload %s, but failed. (%s)", cog, Actor(ctx), extra=interaction_extra(ctx))
 
     @app_commands.command()
     @app_commands.guilds(discord.Object(id=admin_guild))
-    async def reload_all(self, ctx: discord.Interaction) -> None:
-        """Reloads all currently-loaded cogs. (Admins only)"""
+    async def reload_all(self, ctx: discord.Interaction, force: bool = False, dry_run: bool = False) -> None:
+        """Reloads the loaded cogs whose files changed (or all of them, with force). (Admins only)"""
         if await self.verify_user_is_admin(ctx):
             try:
-                loaded_cogs = list(self.bot.extensions.keys())
-                for cog in loaded_cogs:
-                    try:
-                        await self.bot.reload_extension(cog)
-                    except Exception as e:
-                        await ctx.response.send_message(f"Failed to reload {cog}: {e}", ephemeral=True)
-                await ctx.response.send_message("Cogs reloaded successfully. Don't forget to /resync commands if you changed any. 👌", ephemeral=True)
-                log.info(f"All cogs unloaded successfully. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                await ctx.response.defer(ephemeral=True, thinking=True)
+                text, failed = self.combine(await self.everywhere("reload_all", force=force, dry_run=dry_run))
+                if dry_run:
+                    await ctx.followup.send(f"Dry run: {text}"[:2000], ephemeral=True)
+                    return
+                if failed:
+                    await ctx.followup.send(
+                        f"Some cogs failed to reload and are still running their previous version.\n{text}"[:2000],
+                        ephemeral=True,
+                    )
+                    return
+                await ctx.followup.send(
+                    f"Cogs reloaded successfully. Don't forget to /resync commands if you changed any. 👌\n{text}"[:2000],
+                    ephemeral=True,
+                )
+                log.info("Changed cogs reloaded successfully. (%s)", Actor(ctx), extra=interaction_extra(ctx))
             except Exception as e:
-                await ctx.response.send_message(f"Failed to reload all cogs: {e}", ephemeral=True)
-                log.error(f"Tried to unload all cogs, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                await ctx.followup.send(f"Failed to reload all cogs: {e}", ephemeral=True)
+                log.error("Tried to unload all cogs, but failed. (%s)", Actor(ctx), extra=interaction_extra(ctx))
 
     @app_commands.command()
     @app_commands.guilds(discord.Object(id=admin_guild))
@@ -136,27 +208,94 @@ class AdminCog(commands.Cog):
             return
         try:
             await ctx.response.send_message("👍", ephemeral=True)
+            if self.bot.cluster is not None:
+                # Stops every process, this one included, and the supervisor won't restart them.
+                log.info("Cluster stopped using the stop command. (%s)", Actor(ctx), extra=interaction_extra(ctx))
+                await self.bot.cluster.broadcast("stop")
+                return
             await self.bot.close()
-            log.info(f"Bot stopped using the stop command. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+            log.info("Bot stopped using the stop command. (%s)", Actor(ctx), extra=interaction_extra(ctx))
         except Exception as e:
             await ctx.response.send_message(f"Unable to stop the bot: {e}", ephemeral=True)
-            log.error(f"Tried to stop the bot, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+            log.error("Tried to stop the bot, but failed. (%s)", Actor(ctx), extra=interaction_extra(ctx))
+
+    @app_commands.command()
+    @app_commands.guilds(discord.Object(id=admin_guild))
+    async def stats(self, ctx: discord.Interaction) -> None:
+        """Show a summary of the bot's metrics. (Admins only)"""
+        if await self.verify_user_is_admin(ctx):
+            if self.bot.cluster is None:
+                await ctx.response.send_message(f"```\n{self.bot.metrics.summary()}\n```", ephemeral=True)
+                return
+            await ctx.response.defer(ephemeral=True, thinking=True)
+            results = await self.everywhere("stats", timeout=10.0)
+            snapshots = {cluster_id: result for cluster_id, result in results.items() if "error" not in result}
+            lines = [format_summary(merge_snapshots(snapshots.values()))] if snapshots else []
+            for cluster_id, result in results.items():
+                if "error" in result:
+                    lines.append(f"Cluster {cluster_id}: {result['error']}")
+                else:
+                    lines.append(
+                        f"Cluster {cluster_id}: {result['guilds']} guilds, {len(result['shards'])} shards, "
+                        f"{int(result['commands'])} commands"
+                    )
+            await ctx.followup.send("```\n" + "\n".join(lines)[:1990] + "\n```", ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.guilds(discord.Object(id=admin_guild))
+    async def stalls(self, ctx: discord.Interaction, count: app_commands.Range[int, 1, 20] = 3, stacks: bool = True) -> None:
+        """Show the most recent times the event loop was blocked, and what was blocking it. (Admins only)"""
+        if not await self.verify_user_is_admin(ctx):
+            return
+        if self.bot.watchdog is None:
+            await ctx.response.send_message("The watchdog is turned off in the config file.", ephemeral=True)
+            return
+        recent = self.bot.watchdog.recent(count)
+        if not recent:
+            await ctx.response.send_message(
+                f"No stalls longer than {self.bot.watchdog.threshold}s since the bot started. 👌", ephemeral=True
+            )
+            return
+        parts = []
+        for stall in recent:
+            part = stall.describe()
+            if stacks and stall.stack:
+                # The innermost frames are the interesting ones, and they're at the end.
+                part += f"\n```py\n{stall.stack[-700:]}\n```"
+            parts.append(part)
+        await ctx.response.send_message("\n".join(parts)[:2000], ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.guilds(discord.Object(id=admin_guild))
+    async def gateway(self, ctx: discord.Interaction, top: app_commands.Range[int, 1, 30] = 15) -> None:
+        """Show which gateway events the bot gets, what parsing them costs and what listens to them. (Admins only)"""
+        if not await self.verify_user_is_admin(ctx):
+            return
+        await ctx.response.defer(ephemeral=True, thinking=True)
+        text, _ = self.combine(await self.everywhere("gateway", top=top))
+        await ctx.followup.send(f"```\n{text[:1990]}\n```", ephemeral=True)
 
     # Don't use this too much. There is rate-limiting on it and you will have issues.
     @app_commands.command()
     @app_commands.guilds(discord.Object(id=admin_guild))
-    async def resync(self, ctx: discord.Interaction) -> None:
-        """Resync all slash commands. Rate-limited. (Admins only)"""
+    async def resync(self, ctx: discord.Interaction, force: bool = False) -> None:
+        """Resync changed slash commands (or all of them, with force). Rate-limited. (Admins only)"""
         if await self.verify_user_is_admin(ctx):
             try:
-                await self.bot.tree.sync()
-                for guild in self.bot.guilds:
-                    await self.bot.tree.sync(guild=guild)
-                await ctx.response.send_message("Resync successful. Actual update may take up to an hour. 👌", ephemeral=True)
-                log.info(f"Resync successful. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                # Syncing can take a while, so don't let the interaction time out.
+                await ctx.response.defer(ephemeral=True, thinking=True)
+                text, failed = self.combine(await self.everywhere("resync", force=force))
+                if failed:
+                    await ctx.followup.send(f"Resync finished with errors: {text}"[:2000], ephemeral=True)
+                    log.error("Resync failed for some scopes: %s", text, extra=interaction_extra(ctx))
+                    return
+                await ctx.followup.send(
+                    f"Resync successful ({text}). Actual update may take up to an hour. 👌"[:2000], ephemeral=True
+                )
+                log.info("Resync successful. (%s)", Actor(ctx), extra=interaction_extra(ctx))
             except Exception as e:
-                await ctx.response.send_message(f"Failed to resync: {e}", ephemeral=True)
-                log.error(f"Tried to resync commands, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
+                await ctx.followup.send(f"Failed to resync: {e}", ephemeral=True)
+                log.error("Tried to resync commands, but failed. (%s)", Actor(ctx), extra=interaction_extra(ctx))
                 return
 
     # Don't use this too much. There is rate-limiting on it and you will have issues.
@@ -168,22 +307,22 @@ class AdminCog(commands.Cog):
             try:
                 # Clear and resync all commands
                 await ctx.response.send_message("clear_commands has been called. If successful, the bot will not be able to continue running this command after syncing, so there's no way to send a confirmation.", ephemeral=True)
-                log.info(f"clear_commands has been called. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')})")
-                self.bot.tree.clear_commands(guild=None)
-                await self.bot.tree.sync()
-                
+                log.info("clear_commands has been called. (%s)", Actor(ctx), extra=interaction_extra(ctx))
+                # Through TreeSync, so the stored hashes say these scopes are empty and the next sync (on_ready's, after
+                # a restart) puts the commands back.
+                await self.bot.tree_sync.clear(None)
+
                 # Clear commands from all but the admin guild first. This script stops running when you clear the clear_commands command from the bot, so it has to be last.
                 for guild in self.bot.guilds:
                     if guild.id == admin_guild:
                         continue
-                    self.bot.tree.clear_commands(guild=guild)
-                    await self.bot.tree.sync(guild=guild)
-                self.bot.tree.clear_commands(guild=admin_guild)
-                await self.bot.tree.sync(guild=admin_guild)
+                    await self.bot.tree_sync.clear(guild.id)
+                await self.bot.tree_sync.clear(admin_guild)
             except Exception as e:
                 await ctx.response.send_message(f"Failed to clear commands: {e}", ephemeral=True)
-                log.error(f"Tried to clear all commands, but failed. ({getattr(getattr(ctx, 'user', None), 'name', None) or getattr(getattr(ctx, 'user', None), 'display_name', 'unknown')} in {getattr(getattr(ctx, 'guild', None), 'name', 'unknown')}) ({e})")
+                log.error("Tried to clear all commands, but failed. (%s) (%s)", Actor(ctx), e, extra=interaction_extra(ctx))
                 return
 
+
 async def setup(bot) -> None:
     await bot.add_cog(AdminCog(bot))
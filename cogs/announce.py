@@ -2,78 +2,156 @@
 # Discord bot: cogs/announce.py
 
 import logging
-import os
-from typing import List
+from typing import List, Optional, Tuple
 
 import discord
-import yaml
 from discord import app_commands
 from discord.ext import commands
-from discord.utils import get
+
+from cogs.utils.configstore import ConfigRecord, ConfigSchema
+from cogs.utils.dispatcher import INTERACTIVE
+from cogs.utils.responder import Responder
+from cogs.utils.search import LRUCache, SearchIndex
 
 log = logging.getLogger("discord")
 
-# Load YAML files once when bot starts
-guild_configs = {}
-guild_with_ping_role = []
-for filename in os.listdir("./cogs/announce_config"):
-    if filename == ".gitignore" or filename == "000000000000000000.yaml":
-        continue # Ignore .gitignore and the template file.
-    with open(f"./cogs/announce_config/{filename}", "r") as file:
-        yaml_guild_id = int(filename.split(".")[0])
-        guild_configs[yaml_guild_id] = yaml.safe_load(file)
-        if guild_configs[yaml_guild_id].get("ping"): # Only add guilds with a ping role configured to the list of guilds for the command.
-            guild_with_ping_role.append(yaml_guild_id)
+# The config files are in ./cogs/announce_config, one per guild, and are reloaded automatically when they change.
+CONFIG_DIRECTORY = "./cogs/announce_config"
+CONFIG_SCHEMA = ConfigSchema(
+    required={"sessions_channel": int},
+    optional={"guild_name": str, "guild": int, "activities": list, "ping": str},
+)
+# Guilds whose autocomplete index is kept built. The rest are built again the next time someone types in them.
+ACTIVITY_INDEXES = 1024
+
+
+class AnnounceConfig(ConfigRecord):
+    """The settings of a guild's config file that the cog reads."""
+
+    __slots__ = ("sessions_channel", "activities", "ping")
+    sessions_channel: int
+    activities: Optional[Tuple[str, ...]]
+    ping: Optional[str]
 
 
 class Announce(commands.Cog):
     """Let users announce they're starting an activity."""
+    # Channels and roles come from the guild cache. Members don't need to be cached, see member().
+    requires_intents = ("guilds",)
+
     def __init__(self, bot) -> None:
         self.bot = bot
+        # A guild's autocomplete index is built the first time it's needed, instead of lowercasing every activity on
+        # every keystroke.
+        self.activity_indexes = LRUCache(maxsize=ACTIVITY_INDEXES)
+        self.autocomplete_cache = LRUCache(maxsize=2048)
+
+    @property
+    def guild_configs(self):
+        return self.bot.config_store.configs("announce")
+
+    def activity_index(self, guild_id: Optional[int]) -> Optional[SearchIndex]:
+        index = self.activity_indexes.get(guild_id)
+        if index is None:
+            guild_config = self.guild_configs.get(guild_id)
+            if guild_config is None:
+                return None
+            index = SearchIndex(guild_config.activities or ())
+            self.activity_indexes.put(guild_id, index)
+        return index
+
+    async def cog_load(self) -> None:
+        self.bot.config_store.subscribe("announce", self.on_config_change, owner=self)
+
+    # Only the guild whose config file changed is updated.
+    async def on_config_change(self, guild_id: int, old: Optional[AnnounceConfig], new: Optional[AnnounceConfig]) -> None:
+        if new is None or old is None or old.activities != new.activities:
+            self.activity_indexes.pop(guild_id)
+        self.autocomplete_cache.clear()
+        self.bot.resolver.invalidate(guild_id)
+
+        # The commands are only registered in guilds with a ping role, so add or remove them if that changed.
+        had_ping = bool(old and old.ping)
+        has_ping = bool(new and new.ping)
+        if had_ping == has_ping:
+            return
+        guild = discord.Object(id=guild_id)
+        for command in self.get_app_commands():
+            if has_ping:
+                self.bot.tree.add_command(command, guild=guild, override=True)
+            else:
+                self.bot.tree.remove_command(command.name, guild=guild)
+        log.info(
+            f"Announce: Commands were {'added to' if has_ping else 'removed from'} guild {guild_id} because its ping "
+            "role changed. Use /resync to update Discord."
+        )
 
     @app_commands.command()
-    @app_commands.guilds(*guild_with_ping_role)
     @app_commands.guild_only()
     async def announce(self, interaction: discord.Interaction, activity: str, hours: int) -> None:
         """Announce you're going to engage in an activity now."""
 
-        try:
-            guild_config = guild_configs.get(interaction.guild_id)
-            if not guild_config:
-                if not interaction.guild:
+        async with Responder(interaction, ephemeral=True) as responder:
+            try:
+                guild_config = self.guild_configs.get(interaction.guild_id)
+                if not guild_config:
+                    if not interaction.guild:
+                        return
+                    await responder.send(
+                        "This server has not been configured to use this command. Let an admin know if you'd like "
+                        "them to configure it."
+                    )
+                    log.info(f"Announce: {interaction.user.display_name} used /announce in {interaction.guild.name} but the server has not been configured.")
+                    # This should never happen because the command is only registered for guilds that have configs with a
+                    # ping role.
                     return
-                await interaction.response.send_message("This server has not been configured to use this command. Let an admin know if you'd like them to configure it.", ephemeral=True)
-                log.info(f"Announce: {interaction.user.display_name} used /announce in {interaction.guild.name} but the server has not been configured.")
-                return # This should never happen because the command is only registered for guilds that have configs with a ping role.
-
-            # We've got everything now. Send output.
-            channel = self.bot.get_channel(guild_config.get("sessions_channel"))
 
-            # Get the role ID for the ping
-            notify_role = discord.utils.get(channel.guild.roles, name=guild_config.get("ping"))
-
-            # Send the message(s)
-            await channel.send(f"{interaction.user.display_name} is planning to play {activity} for {hours} hour(s). <@&{notify_role.id}>")
-            await interaction.response.send_message(f"Announced you're playing {activity} for {hours} hour(s) in channel <{channel.name}>.", ephemeral=True)
-            
-            log.info(f"Announce: {interaction.user.display_name} used /announce successfully.")
-        except Exception as exception:
-            await interaction.response.send_message("Command failed, sorry.", ephemeral=True)
-            log.error(f"Announce: {interaction.user.display_name} used /announce but it failed. Error was: {exception}")
+                # We've got everything now. Send output.
+                channel = self.bot.resolver.channel(interaction.guild, guild_config.sessions_channel)
+
+                # Get the role ID for the ping
+                notify_role = self.bot.resolver.role(channel.guild, guild_config.ping)
+
+                # Post the announcement while the user gets their answer. If it fails, they're told in a followup.
+                responder.concurrently(
+                    self.bot.dispatcher.send(
+                        channel,
+                        f"{interaction.user.display_name} is planning to play {activity} for {hours} hour(s). "
+                        f"<@&{notify_role.id}>",
+                        priority=INTERACTIVE,
+                    ),
+                    error="Your announcement couldn't be posted, sorry.",
+                )
+                await responder.send(f"Announced you're playing {activity} for {hours} hour(s) in channel <{channel.name}>.")
+
+                # Popular activities float to the top of the autocomplete list.
+                activity_index = self.activity_index(interaction.guild_id)
+                if activity_index:
+                    activity_index.bump(activity)
+
+                log.info(f"Announce: {interaction.user.display_name} used /announce successfully.")
+            except Exception as exception:
+                await responder.fail()
+                log.error(f"Announce: {interaction.user.display_name} used /announce but it failed. Error was: {exception}")
 
     @announce.autocomplete(name="activity")
     async def announce_autocomplete_activity(self, interaction: discord.Interaction, activity: str) -> List[app_commands.Choice[str]]:
         try:
             # Skip this guild if there's no config file for it.
-            guild_config = guild_configs.get(interaction.guild_id)
-            if not guild_config:
+            activity_index = self.activity_index(interaction.guild_id)
+            if not activity_index:
                 return []
 
-            activities = guild_config.get("activities") or []
-            return [
-                app_commands.Choice(name=act, value=act)
-                for act in activities if activity.lower() in act.lower()
-            ]
+            # Repeated keystrokes (and other users typing the same thing) are served from the cache.
+            key = (interaction.guild_id, activity_index.generation, activity.casefold())
+            choices = self.autocomplete_cache.get(key)
+            if choices is None:
+                choices = [
+                    app_commands.Choice(name=act[:100], value=act[:100])
+                    for act in activity_index.search(activity)
+                ]
+                self.autocomplete_cache.put(key, choices)
+            return choices
         except Exception as e:
             log.error(f"Error in announce_autocomplete_activity: {e}")
             return []
@@ -87,127 +165,189 @@ class Announce(commands.Cog):
 #        ]
 
     @app_commands.command()
-    @app_commands.guilds(*guild_with_ping_role)
     @app_commands.guild_only()
     async def anygame(self, interaction: discord.Interaction, hours: int) -> None:
         """Announce that you're up for gaming for a few hours and welcome an invite."""
 
-        try:
-            # Skip this guild if there's no config file for it.
-            guild_id = interaction.guild_id
-            guild_config = guild_configs.get(guild_id)
-            if not guild_config:
-                await interaction.response.send_message("This server has not been configured to use this command. Let an admin know if you'd like them to configure it.", ephemeral=True)
-                if not interaction.guild:
+        async with Responder(interaction, ephemeral=True) as responder:
+            try:
+                # Skip this guild if there's no config file for it.
+                guild_id = interaction.guild_id
+                guild_config = self.guild_configs.get(guild_id)
+                if not guild_config:
+                    await responder.send(
+                        "This server has not been configured to use this command. Let an admin know if you'd like "
+                        "them to configure it."
+                    )
+                    if not interaction.guild:
+                        return
+                    log.info(f"Announce: {interaction.user.display_name} used /anygame in {interaction.guild.name} but the server has not been configured.")
                     return
-                log.info(f"Announce: {interaction.user.display_name} used /anygame in {interaction.guild.name} but the server has not been configured.")
-                return
-
-            # We've got everything now. Send output.
-            channel = self.bot.get_channel(guild_config.get("sessions_channel"))
 
-            # Get the role ID for the ping
-            notify_role = discord.utils.get(channel.guild.roles, name=guild_config.get("ping"))
-
-            # Send the message(s)
-            await channel.send(f"{interaction.user.display_name} is available to play something for {hours} hour(s). <@&{notify_role.id}>")
-            await interaction.response.send_message(f"Announced you're available to play something for {hours} hour(s) in channel <{channel.name}>.", ephemeral=True)
-            
-            log.info(f"Announce: {interaction.user.display_name} used /anygame successfully.")
-        except Exception as exception:
-            await interaction.response.send_message("Command failed, sorry.", ephemeral=True)
-            log.error(f"Announce: {interaction.user.display_name} used /anygame but it failed. Error was: {exception}")
+                # We've got everything now. Send output.
+                channel = self.bot.resolver.channel(interaction.guild, guild_config.sessions_channel)
+
+                # Get the role ID for the ping
+                notify_role = self.bot.resolver.role(channel.guild, guild_config.ping)
+
+                # Post the announcement while the user gets their answer. If it fails, they're told in a followup.
+                responder.concurrently(
+                    self.bot.dispatcher.send(
+                        channel,
+                        f"{interaction.user.display_name} is available to play something for {hours} hour(s). "
+                        f"<@&{notify_role.id}>",
+                        priority=INTERACTIVE,
+                    ),
+                    error="Your announcement couldn't be posted, sorry.",
+                )
+                await responder.send(
+                    f"Announced you're available to play something for {hours} hour(s) in channel <{channel.name}>."
+                )
+
+                log.info(f"Announce: {interaction.user.display_name} used /anygame successfully.")
+            except Exception as exception:
+                await responder.fail()
+                log.error(f"Announce: {interaction.user.display_name} used /anygame but it failed. Error was: {exception}")
+
+    # The interaction usually already carries the member (with their roles). The member cache is only a fallback, and with a
+    # low-memory cache profile it's empty, so fall back to fetching the member from Discord.
+    async def member(self, guild: discord.Guild, user) -> Optional[discord.Member]:
+        if isinstance(user, discord.Member):
+            return user
+        member = guild.get_member(user.id)
+        if member is not None:
+            return member
+        try:
+            return await guild.fetch_member(user.id)
+        except discord.NotFound:
+            return None
 
     @app_commands.command()
-    @app_commands.guilds(*guild_with_ping_role) # Remove this line to make it a global command.
     @app_commands.guild_only()
     async def ping_role_add_me(self, interaction: discord.Interaction) -> None:
         """Add the user to the ping role, as defined by guild_configs[guild_id].ping in the config file for the server."""
 
-        try:
-            guild_id = interaction.guild_id
-            print(guild_id)
-            if not guild_id:
-                return
-            guild = self.bot.get_guild(guild_id)
-
-            ping_role_name = guild_configs[guild_id].get("ping")
-
-            ping_role = get(guild.roles, name=ping_role_name)
-            if not ping_role:
-                await interaction.response.send_message(f"The configured ping role ({ping_role_name} does not exist on this server.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the ping role does not exist.")
-                return
-
-            member = interaction.user
-            if not isinstance(member, discord.Member):
-                member = guild.get_member(member.id)
-            if member is None:
-                await interaction.response.send_message(f"{interaction.user} not found in server {guild_id}.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but was not found as a member.")
-                return
-
-            if any(r.name == ping_role_name for r in member.roles):
-                await interaction.response.send_message(f"You already have role {ping_role_name} on server {guild_id}.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but is already in the ping role.")
-                return
-
+        async with Responder(interaction, ephemeral=True) as responder:
             try:
-                await member.add_roles(ping_role, reason=f"{self.bot.user} adding user to {ping_role_name} role.")
-                await interaction.response.send_message(f"You have been added to the {ping_role.name} role!", ephemeral=True)
-                log.info(f"User {interaction.user} used ping_role_add_me in guild {guild_id} and was added to the ping role.")
-            except discord.Forbidden:
-                await interaction.response.send_message(f"I do not have permission to add you to the {ping_role_name} role. Please contact an administrator for this server.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the bot got a permission error.")
-        except Exception as exception:
-            await interaction.response.send_message("Command failed, sorry.", ephemeral=True)
-            log.error(f"Announce: {interaction.user.display_name} used /ping_role_add_me but it failed. Error was: {exception}")
+                guild_id = interaction.guild_id
+                if not guild_id:
+                    return
+                guild = self.bot.get_guild(guild_id)
+
+                guild_config = self.guild_configs.get(guild_id)
+                if not guild_config or not guild_config.ping:
+                    await responder.send(
+                        "This server has no ping role configured. Let an admin know if you'd like them to configure one."
+                    )
+                    log.info(
+                        f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the "
+                        "server has no ping role configured."
+                    )
+                    return
+                ping_role_name = guild_config.ping
 
+                ping_role = self.bot.resolver.role(guild, ping_role_name)
+                if not ping_role:
+                    await responder.send(f"The configured ping role ({ping_role_name} does not exist on this server.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the ping role does not exist.")
+                    return
+
+                member = await self.member(guild, interaction.user)
+                if member is None:
+                    await responder.send(f"{interaction.user} not found in server {guild_id}.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but was not found as a member.")
+                    return
+
+                if any(r.name == ping_role_name for r in member.roles):
+                    await responder.send(f"You already have role {ping_role_name} on server {guild_id}.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but is already in the ping role.")
+                    return
+
+                try:
+                    await self.bot.dispatcher.add_roles(
+                        member, ping_role, reason=f"{self.bot.user} adding user to {ping_role_name} role."
+                    )
+                    await responder.send(f"You have been added to the {ping_role.name} role!")
+                    log.info(
+                        f"User {interaction.user} used ping_role_add_me in guild {guild_id} and was added to the ping role."
+                    )
+                except discord.Forbidden:
+                    await responder.send(
+                        f"I do not have permission to add you to the {ping_role_name} role. Please contact an "
+                        "administrator for this server."
+                    )
+                    log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the bot got a permission error.")
+            except Exception as exception:
+                await responder.fail()
+                log.error(f"Announce: {interaction.user.display_name} used /ping_role_add_me but it failed. Error was: {exception}")
 
     @app_commands.command()
-    @app_commands.guilds(*guild_with_ping_role) # Remove this line to make it a global command.
     @app_commands.guild_only()
     async def ping_role_remove_me(self, interaction: discord.Interaction) -> None:
         """Remove the user from the ping role, as defined by guild_configs[guild_id].ping in the config file for the server."""
 
-        try:
-            guild_id = interaction.guild_id
-            print(guild_id)
-            if not guild_id:
-                return
-            guild = self.bot.get_guild(guild_id)
-
-            ping_role_name = guild_configs[guild_id].get("ping")
-
-            ping_role = get(guild.roles, name=ping_role_name)
-            if not ping_role:
-                await interaction.response.send_message(f"The configured ping role ({ping_role_name} does not exist on this server.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but the ping role does not exist.")
-                return
-
-            member = interaction.user
-            if not isinstance(member, discord.Member):
-                member = guild.get_member(member.id)
-            if member is None:
-                await interaction.response.send_message(f"{interaction.user} not found in server {guild_id}.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but was not found as a member.")
-                return
-
-            if not any(r.name == ping_role_name for r in member.roles):
-                await interaction.response.send_message(f"You do not have role {ping_role_name} on server {guild_id}.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but is not in the ping role.")
-                return
-
+        async with Responder(interaction, ephemeral=True) as responder:
             try:
-                await member.remove_roles(ping_role, reason=f"{self.bot.user} adding user to {ping_role_name} role.")
-                await interaction.response.send_message(f"You have been removed from the {ping_role.name} role!", ephemeral=True)
-                log.info(f"User {interaction.user} used ping_role_remove_me in guild {guild_id} and was removed from the ping role.")
-            except discord.Forbidden:
-                await interaction.response.send_message(f"I do not have permission to remove you to the {ping_role_name} role. Please contact an administrator for this server.", ephemeral=True)
-                log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the bot got a permission error.")
-        except Exception as exception:
-            await interaction.response.send_message("Command failed, sorry.", ephemeral=True)
-            log.error(f"Announce: {interaction.user.display_name} used /ping_role_remove_me but it failed. Error was: {exception}")
+                guild_id = interaction.guild_id
+                if not guild_id:
+                    return
+                guild = self.bot.get_guild(guild_id)
+
+                guild_config = self.guild_configs.get(guild_id)
+                if not guild_config or not guild_config.ping:
+                    await responder.send(
+                        "This server has no ping role configured. Let an admin know if you'd like them to configure one."
+                    )
+                    log.info(
+                        f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but the "
+                        "server has no ping role configured."
+                    )
+                    return
+                ping_role_name = guild_config.ping
+
+                ping_role = self.bot.resolver.role(guild, ping_role_name)
+                if not ping_role:
+                    await responder.send(f"The configured ping role ({ping_role_name} does not exist on this server.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but the ping role does not exist.")
+                    return
+
+                member = await self.member(guild, interaction.user)
+                if member is None:
+                    await responder.send(f"{interaction.user} not found in server {guild_id}.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but was not found as a member.")
+                    return
+
+                if not any(r.name == ping_role_name for r in member.roles):
+                    await responder.send(f"You do not have role {ping_role_name} on server {guild_id}.")
+                    log.info(f"User {interaction.user} attempted to use ping_role_remove_me in guild {guild_id} but is not in the ping role.")
+                    return
+
+                try:
+                    await self.bot.dispatcher.remove_roles(
+                        member, ping_role, reason=f"{self.bot.user} adding user to {ping_role_name} role."
+                    )
+                    await responder.send(f"You have been removed from the {ping_role.name} role!")
+                    log.info(f"User {interaction.user} used ping_role_remove_me in guild {guild_id} and was removed from the ping role.")
+                except discord.Forbidden:
+                    await responder.send(
+                        f"I do not have permission to remove you to the {ping_role_name} role. Please contact an "
+                        "administrator for this server."
+                    )
+                    log.info(f"User {interaction.user} attempted to use ping_role_add_me in guild {guild_id} but the bot got a permission error.")
+            except Exception as exception:
+                await responder.fail()
+                log.error(f"Announce: {interaction.user.display_name} used /ping_role_remove_me but it failed. Error was: {exception}")
+
 
 async def setup(bot) -> None:
-    await bot.add_cog(Announce(bot))
+    guild_configs = await bot.config_store.watch("announce", CONFIG_DIRECTORY, record=AnnounceConfig, schema=CONFIG_SCHEMA)
+    # Only add guilds with a ping role configured to the list of guilds for the commands. The index knows which without
+    # decoding their configs.
+    guild_with_ping_role = [discord.Object(id=guild_id) for guild_id in guild_configs.with_setting("ping")]
+    cog = Announce(bot)
+    await bot.add_cog(cog, guilds=guild_with_ping_role)
+    # add_cog registers the commands globally when it's given no guilds. Until some guild sets a ping role they belong nowhere,
+    # and on_config_change adds them to that guild when one does.
+    if not guild_with_ping_role:
+        for command in cog.get_app_commands():
+            bot.tree.remove_command(command.name)
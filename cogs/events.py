@@ -3,109 +3,489 @@
 
 # This module posts in a Discord channel when there's an event in the server.
 # The config files should be in cogs/events_config and named <guild_id>.yaml. It will skip any guild without a config file.
+# Config files are reloaded automatically when they change.
+# With "digest: true" in a guild's config file, the bot keeps one pinned "upcoming events" message in the events channel and
+# edits it when the events change, instead of posting a message per event per announce time. Pings are only sent at the
+# announce_times, and events that reach one at the same time share a single ping message.
+# Every announcement that's posted is recorded in the bot's store. After a restart, announcements that came due while the bot
+# was down (since it was last known to be running) are posted late instead of being lost, and none are posted twice.
 
-# This requires the following intent: Guild
+# This requires the following intents: Guild, Guild Scheduled Events
 
-import asyncio
+import functools
 import logging
-import os
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
 
 import discord
-import yaml
-from discord.ext import commands, tasks
+from discord.ext import commands
+
+import config
+from cogs.utils.configstore import ConfigRecord, ConfigSchema
+from cogs.utils.eventcache import CachedEvent, ScheduledEventCache
+from cogs.utils.fanout import FanOut
+from cogs.utils.scheduler import Job
+from cogs.utils.store import AnnouncementKey
 
 log = logging.getLogger("discord")
 
-# Load YAML files once when bot starts
-guild_configs = {}
-for filename in os.listdir("./cogs/events_config"):
-    if filename == ".gitignore" or filename == "000000000000000000.yaml":
-        continue # Ignore .gitignore and the template file.
-    with open(f"./cogs/events_config/{filename}", "r") as file:
-        guild_id = int(filename.split(".")[0])
-        guild_configs[guild_id] = yaml.safe_load(file)
+CONFIG_DIRECTORY = "./cogs/events_config"
+CONFIG_SCHEMA = ConfigSchema(
+    required={"events_channel": int, "ping_role": str, "announce_times": list},
+    optional={"guild_name": str, "guild": int, "digest": bool, "digest_size": int},
+)
+
+
+class EventsConfig(ConfigRecord):
+    """The settings of a guild's config file that the cog reads."""
+
+    __slots__ = ("events_channel", "ping_role", "announce_times", "digest", "digest_size")
+    events_channel: int
+    ping_role: str
+    announce_times: Tuple[int, ...]
+    digest: Optional[bool]
+    digest_size: Optional[int]
+
+
+DIGEST_TITLE = "**Upcoming events**"
+# Pings that come due within this many seconds of each other go out as one message.
+PING_MERGE_WINDOW = 2.0
+# Gateway updates often come in bunches, so digest edits wait this long and then go out together.
+DIGEST_DELAY = 5.0
+# How long announcements stay in the ledger after their event started.
+LEDGER_RETENTION = 2 * 24 * 3600
+# How often changed guilds' events are saved to the store.
+SNAPSHOT_INTERVAL = 60
 
 
 class EventsCog(commands.Cog):
     """Events stuff."""
+    requires_intents = ("guilds", "guild_scheduled_events")
+
     def __init__(self, bot) -> None:
         self.bot = bot
-        if not self.post_about_events.is_running():
-            self.post_about_events.start()
+        self.event_cache = ScheduledEventCache()
+        # Announcement jobs per guild, keyed by (event ID, hours before the event), along with the start time they were
+        # scheduled for.
+        self.announcement_jobs: Dict[int, Dict[Tuple[int, int], Tuple[datetime, Job]]] = {}
+        # Per-guild refreshes run through this so a tick never has more than a handful of REST calls in flight.
+        self.fanout = FanOut(
+            "events: refresh",
+            concurrency=getattr(config, "events_concurrency", 10),
+            jitter=getattr(config, "events_jitter", 2.0),
+        )
+        # Digest mode: the digest message per guild, what it last said, and the guilds whose digest needs another look.
+        self.digest_messages: Dict[int, Optional[discord.Message]] = {}
+        self.digest_contents: Dict[int, str] = {}
+        self.dirty_digests: Set[int] = set()
+        self.digest_job: Optional[Job] = None
+        # Digest mode: pings waiting to be merged, per guild, as (hours before the event, event ID).
+        self.pending_pings: Dict[int, List[Tuple[int, int]]] = {}
+        # Announcements that have been posted, as (guild ID, event ID, hours before the event, start timestamp).
+        self.announced: Set[AnnouncementKey] = set()
+        # Guilds still to be checked for announcements missed while the bot was down, and when it went down.
+        self.catch_up_pending: Set[int] = set()
+        self.catch_up_since: Optional[datetime] = None
 
-    async def event_posting(self, guild, channel, current_time):
-        # Fetch the scheduled events for the guild. We do this because guilds.scheduled_events doesn't get updated after the bot has started. The fetch is slow, though.
-        guild_events = await guild.fetch_scheduled_events()
+    @property
+    def guild_configs(self):
+        return self.bot.config_store.configs("events")
 
-        for event in guild_events:
+    async def cog_load(self) -> None:
+        store = self.bot.store
+        await store.prune_announcements(time.time() - LEDGER_RETENTION)
+        self.announced = await store.announcements(time.time() - LEDGER_RETENTION)
+        # Start from the events saved before the restart instead of fetching every guild again.
+        guild_configs = self.guild_configs
+        for guild_id, events in (await store.event_snapshots()).items():
+            if guild_id in guild_configs and self.bot.has_guild_shard(guild_id):
+                self.event_cache.seed(guild_id, events)
+        # Only the first load after the process started catches up. A reload later on (/reload, or the reloader) would
+        # otherwise replay announcements from before the process started, so the store's previous_alive is cleared once
+        # it's used.
+        previous_alive, store.previous_alive = store.previous_alive, None
+        if previous_alive is not None and getattr(config, "events_catch_up", True):
+            self.catch_up_since = datetime.fromtimestamp(previous_alive, timezone.utc)
+            self.catch_up_pending = set(guild_configs)
+        self.bot.scheduler.every(self.save_snapshots, seconds=SNAPSHOT_INTERVAL, owner=self, name="events: snapshots")
 
-            # Calculate the number of hours until the event starts.
-            time_until_start = event.start_time - current_time
+        self.bot.config_store.subscribe("events", self.on_config_change, owner=self)
+        # Events can't be scheduled except at 00, 15, 30, and 45 minutes past the hour, so only refresh then.
+        self.bot.scheduler.cron(self.post_about_events, minute=(0, 15, 30, 45), owner=self, name="events: refresh")
+        # Don't wait for the first quarter hour to schedule the upcoming announcements.
+        self.bot.scheduler.call_later(0, self.post_about_events, owner=self, name="events: first refresh")
 
-            # Calculate the total number of minutes until the event starts, rounding up.
-            total_minutes_until_start = int(time_until_start.total_seconds() // 60 + 1)
+    # Only the guild whose config file changed is rescheduled.
+    async def on_config_change(self, guild_id: int, old: Optional[EventsConfig], new: Optional[EventsConfig]) -> None:
+        self.bot.resolver.invalidate(guild_id)
+        if not (new and new.digest) or (old and old.events_channel) != new.events_channel:
+            self.forget_digest(guild_id)
+        if new is None:
+            for _, job in self.announcement_jobs.pop(guild_id, {}).values():
+                job.cancel()
+        else:
+            self.schedule_announcements(guild_id)
 
-            # Only continue if there's an exact number of minutes until the event starts.
-            # We don't want to notify if there's 59 or 61 minutes remaining, only 60.
-            hours_until_start = total_minutes_until_start // 60
-            minutes_until_start = total_minutes_until_start % 60
-            if not minutes_until_start == 0:
-                continue
+    async def event_posting(self, guild: discord.Guild, current_time: datetime) -> None:
+        # Read the scheduled events from the cache. The slow fetch only happens the first time we see a guild, or after
+        # its shard reconnected.
+        # A guild seeded from its snapshot is brought up to date from the gateway's copy of its events instead.
+        if self.event_cache.is_provisional(guild.id):
+            self.event_cache.reconcile(guild)
+        elif self.event_cache.needs_fetch(guild.id):
+            await self.event_cache.fetch(guild)
+        self.schedule_announcements(guild.id, current_time)
 
-            # Get the event start time.
-            event_start_time = event.start_time.astimezone()
-            event_start_time = event_start_time.strftime("X%I:%M %p").replace("X0","X").replace("X","")
+    def schedule_announcements(self, guild_id: int, current_time: Optional[datetime] = None) -> None:
+        """Make sure there's exactly one scheduler job for every upcoming announcement in the guild."""
+        guild_config = self.guild_configs.get(guild_id)
+        # Snapshots can be out of date, so nothing is scheduled from one until the guild has been reconciled.
+        if not guild_config or guild_id not in self.event_cache or self.event_cache.is_provisional(guild_id):
+            return
+        current_time = current_time or datetime.now(timezone.utc)
+        if guild_id in self.catch_up_pending:
+            self.catch_up_pending.discard(guild_id)
+            self.catch_up(guild_id, guild_config, current_time)
+
+        wanted = self.upcoming_announcements(guild_id, guild_config, current_time)
+        jobs = self.announcement_jobs.setdefault(guild_id, {})
+        for key, (start_time, job) in list(jobs.items()):
+            # Drop jobs for events that were removed, rescheduled or have already been announced.
+            if job.cancelled or job.deadline is None or wanted.get(key) != start_time:
+                job.cancel()
+                del jobs[key]
+
+        for key, start_time in wanted.items():
+            if key in jobs:
+                continue
+            event_id, hours = key
+            job = self.bot.scheduler.before(
+                start_time,
+                functools.partial(self.announce_event, guild_id, event_id, hours),
+                hours=hours,
+                owner=self,
+                name=f"events: {guild_id}/{event_id} {hours}h",
+                misfire_grace=300,
+                catch_up="skip",
+            )
+            jobs[key] = (start_time, job)
 
-            notify_role = discord.utils.get(channel.guild.roles, name=guild_configs[guild.id]["ping_role"])
+        if guild_config.digest:
+            self.schedule_digest(guild_id)
 
+    def upcoming_announcements(
+        self, guild_id: int, guild_config: EventsConfig, current_time: datetime
+    ) -> Dict[Tuple[int, int], datetime]:
+        """The start time of the event behind every announcement still to come, keyed by (event id, hours)."""
+        wanted = {}
+        for event in self.event_cache.events(guild_id):
             # Only if the event is scheduled.
-            if event.status == discord.EventStatus.scheduled or event.status == discord.EventStatus.active:
-                if 0 in guild_configs[guild.id]["announce_times"] and hours_until_start == 0:
-                    log.info(f"Message posted: [{event.name}]({event.url}) is starting now. <@&{notify_role.id}>")
-                    await channel.send(f"[{event.name}]({event.url}) is starting now. <@&{notify_role.id}>")
-                elif hours_until_start in guild_configs[guild.id]["announce_times"]:
-                    log.info(f"Message posted: [{event.name}]({event.url}) is starting in {hours_until_start} hour(s). <@&{notify_role.id}>")
-                    await channel.send(f"[{event.name}]({event.url}) is starting in {hours_until_start} hour(s). <@&{notify_role.id}>")
+            if event.status != discord.EventStatus.scheduled and event.status != discord.EventStatus.active:
+                continue
+            for hours in guild_config.announce_times:
+                announce_at = event.start_time - timedelta(hours=hours)
+                if announce_at > current_time:
+                    wanted[(event.id, hours)] = event.start_time
+        return wanted
 
+    def catch_up(self, guild_id: int, guild_config: EventsConfig, current_time: datetime) -> None:
+        """Post the announcements that came due while the bot was down. Only the latest one per event is posted late."""
+        late = []
+        skipped = []
+        for event in self.event_cache.events(guild_id):
+            if event.status != discord.EventStatus.scheduled and event.status != discord.EventStatus.active:
+                continue
+            missed = sorted(hours for hours in guild_config.announce_times
+                            if self.catch_up_since < event.start_time - timedelta(hours=hours) <= current_time
+                            and self.announcement_key(guild_id, event, hours) not in self.announced)
+            if missed:
+                late.append((event.id, missed[0]))
+                skipped += [self.announcement_key(guild_id, event, hours) for hours in missed[1:]]
+        if not late:
+            return
+        log.info(f"Events: Posting {len(late)} announcement(s) in guild {guild_id} that came due while the bot was down.")
+        if skipped:
+            self.bot.scheduler.call_later(
+                0, functools.partial(self.remember, skipped), owner=self, name=f"events: {guild_id} catch-up"
+            )
+        for event_id, hours in late:
+            self.bot.scheduler.call_later(
+                0,
+                functools.partial(self.announce_event, guild_id, event_id, hours, late=True),
+                owner=self,
+                name=f"events: {guild_id}/{event_id} {hours}h (late)",
+            )
 
+    @staticmethod
+    def announcement_key(guild_id: int, event: CachedEvent, hours: int) -> AnnouncementKey:
+        return (guild_id, event.id, hours, int(event.start_time.timestamp()))
 
+    async def remember(self, keys: List[AnnouncementKey]) -> None:
+        """Record announcements in the ledger, so they aren't posted again after a restart."""
+        self.announced.update(keys)
+        await self.bot.store.record_announcements(keys)
 
-    # Post about events at various intervals. Use ./events_config/ files to configure your settings.
-    @tasks.loop(minutes=1)
-    async def post_about_events(self) -> None:
-        # Events can't be scheduled except at 00, 15, 30, and 45 minutes past the hour, so only run then.
-        current_time = datetime.now(timezone.utc)
-        if current_time.minute not in [00, 15, 30, 45]:
+    async def announce_event(self, guild_id: int, event_id: int, hours_until_start: int, *, late: bool = False) -> None:
+        self.announcement_jobs.get(guild_id, {}).pop((event_id, hours_until_start), None)
+
+        event = self.event_cache.get(guild_id, event_id)
+        guild_config = self.guild_configs.get(guild_id)
+        guild = self.bot.get_guild(guild_id)
+        if event is None or guild_config is None or guild is None:
+            return
+
+        # Only if the event is still scheduled.
+        if event.status != discord.EventStatus.scheduled and event.status != discord.EventStatus.active:
             return
+        key = self.announcement_key(guild_id, event, hours_until_start)
+        if key in self.announced:
+            log.debug(f"Events: {event.name} ({hours_until_start}h) in guild {guild_id} was already announced.")
+            return
+
+        if guild_config.digest:
+            # Wait a moment for any other events reaching an announce time right now, and ping for all of them at once.
+            pending = self.pending_pings.setdefault(guild_id, [])
+            if not pending:
+                self.bot.scheduler.call_later(
+                    PING_MERGE_WINDOW,
+                    functools.partial(self.send_pings, guild_id),
+                    owner=self,
+                    name=f"events: {guild_id} pings",
+                )
+            pending.append((hours_until_start, event_id))
+            return
+
+        channel = self.bot.resolver.channel(guild, guild_config.events_channel)
+        notify_role = self.bot.resolver.role(guild, guild_config.ping_role)
+        if channel is None or notify_role is None:
+            return  # The resolver has already logged what's missing.
 
+        if late:
+            # The announce time has passed, so say when the event starts (or started) instead.
+            timestamp = int(event.start_time.timestamp())
+            verb = "started" if event.start_time <= datetime.now(timezone.utc) else "is starting"
+            content = f"[{event.name}]({event.url}) {verb} <t:{timestamp}:R>. <@&{notify_role.id}>"
+        elif hours_until_start == 0:
+            content = f"[{event.name}]({event.url}) is starting now. <@&{notify_role.id}>"
+        else:
+            content = f"[{event.name}]({event.url}) is starting in {hours_until_start} hour(s). <@&{notify_role.id}>"
+        log.info(f"Message posted: {content}")
+        await self.bot.dispatcher.send(channel, content)
+        await self.remember([key])
+
+    # Digest mode
+
+    async def send_pings(self, guild_id: int) -> None:
+        """One ping message for every event in the guild that reached an announce time in the last moment."""
+        pending = self.pending_pings.pop(guild_id, [])
+        guild_config = self.guild_configs.get(guild_id)
+        guild = self.bot.get_guild(guild_id)
+        if not pending or guild_config is None or guild is None:
+            return
+        channel = self.bot.resolver.channel(guild, guild_config.events_channel)
+        notify_role = self.bot.resolver.role(guild, guild_config.ping_role)
+        if channel is None or notify_role is None:
+            return
+
+        by_hours: Dict[int, List[CachedEvent]] = {}
+        for hours, event_id in sorted(set(pending)):
+            event = self.event_cache.get(guild_id, event_id)
+            if event is None or self.announcement_key(guild_id, event, hours) in self.announced:
+                continue
+            if event.status in (discord.EventStatus.scheduled, discord.EventStatus.active):
+                by_hours.setdefault(hours, []).append(event)
+        if not by_hours:
+            return
+        lines = []
+        for hours, events in by_hours.items():
+            names = ", ".join(f"[{event.name}]({event.url})" for event in events)
+            lines.append(f"Starting now: {names}" if hours == 0 else f"Starting in {hours} hour(s): {names}")
+        content = "\n".join(lines) + f" <@&{notify_role.id}>"
+        log.info(f"Message posted: {content}")
+        await self.bot.dispatcher.send(channel, content[:2000])
+        await self.remember(
+            [self.announcement_key(guild_id, event, hours) for hours, events in by_hours.items() for event in events]
+        )
+        self.schedule_digest(guild_id)
+
+    def schedule_digest(self, guild_id: int) -> None:
+        self.dirty_digests.add(guild_id)
+        if self.digest_job is None:
+            self.digest_job = self.bot.scheduler.call_later(
+                DIGEST_DELAY, self.update_digests, owner=self, name="events: digests"
+            )
+
+    async def update_digests(self) -> None:
+        self.digest_job = None
+        dirty, self.dirty_digests = self.dirty_digests, set()
+        guilds = [guild for guild in (self.bot.get_guild(guild_id) for guild_id in dirty) if guild is not None]
+        # Digest edits go through the dispatcher, which already spaces them out, so they start right away.
+        await self.fanout.run(self.update_digest, guilds, key=lambda guild: guild.id, jitter=0.0)
+
+    def render_digest(self, guild_id: int, size: int) -> str:
+        events = sorted(
+            (
+                event
+                for event in self.event_cache.events(guild_id)
+                if event.status in (discord.EventStatus.scheduled, discord.EventStatus.active)
+            ),
+            key=lambda event: event.start_time,
+        )
+        lines = [DIGEST_TITLE]
+        for event in events[:size]:
+            if event.status == discord.EventStatus.active:
+                lines.append(f"• [{event.name}]({event.url}): happening now")
+            else:
+                # Discord shows these in each reader's timezone and keeps the countdown current, so the message doesn't
+                # need editing as time passes.
+                timestamp = int(event.start_time.timestamp())
+                lines.append(f"• [{event.name}]({event.url}): <t:{timestamp}:F> (<t:{timestamp}:R>)")
+        if not events:
+            lines.append("No upcoming events.")
+        elif len(events) > size:
+            lines.append(f"…and {len(events) - size} more.")
+        content = "\n".join(lines)
+        return content if len(content) <= 2000 else content[:1999] + "…"
+
+    async def update_digest(self, guild: discord.Guild) -> None:
+        """Edit the guild's digest message, but only if what it should say changed."""
+        guild_config = self.guild_configs.get(guild.id)
+        if not guild_config or not guild_config.digest or guild.id not in self.event_cache:
+            return
+        content = self.render_digest(guild.id, guild_config.digest_size or 10)
+        if self.digest_contents.get(guild.id) == content:
+            return
+        channel = self.bot.resolver.channel(guild, guild_config.events_channel)
+        if channel is None:
+            return
+
+        if guild.id not in self.digest_messages:
+            self.digest_messages[guild.id] = await self.find_digest(channel)
+        message = self.digest_messages[guild.id]
+        if message is not None and message.content == content:
+            self.digest_contents[guild.id] = content
+            return
+        if message is not None and await self.edit_digest(guild, message, content):
+            return
+
+        message = await self.bot.dispatcher.send(channel, content)
+        self.digest_messages[guild.id] = message
+        self.digest_contents[guild.id] = content
+        try:
+            await message.pin(reason="Upcoming events digest")
+        except discord.HTTPException as e:
+            log.warning(f"Events: Could not pin the digest message in {guild.name}. {e}")
+
+    async def edit_digest(self, guild: discord.Guild, message: discord.Message, content: str) -> bool:
+        """Edit the digest message in place. False if it was deleted, so a new one has to be posted."""
+        try:
+            await self.bot.dispatcher.edit(message, content=content)
+        except discord.NotFound:
+            log.info(f"Events: The digest message in {guild.name} was deleted. Posting a new one.")
+            return False
+        self.digest_contents[guild.id] = content
+        return True
+
+    async def find_digest(self, channel) -> Optional[discord.Message]:
+        """The digest message the bot pinned before it last restarted, if it's still there."""
         try:
-            for guild in self.bot.guilds:
-                # Find out if we should even bother getting the list of events. The fetch_scheduled_events function is really slow, so we only want to run it for guilds we don't have a config file for.
+            for message in await channel.pins():
+                if message.author.id == self.bot.user.id and message.content.startswith(DIGEST_TITLE):
+                    return message
+        except discord.HTTPException as e:
+            log.warning(f"Events: Could not read the pins in {channel}. {e}")
+        return None
 
-                # Skip this guild if there's no config file for it.
-                guild_config = guild_configs.get(guild.id)
-                if not guild_config:
-                    continue
+    def forget_digest(self, guild_id: int) -> None:
+        self.digest_messages.pop(guild_id, None)
+        self.digest_contents.pop(guild_id, None)
+        self.dirty_digests.discard(guild_id)
 
-                events_channel = guild_config.get("events_channel")
-                channel = self.bot.get_channel(events_channel)
+    # Refresh the events and announcement jobs for every configured guild. Use ./events_config/ files to configure your
+    # settings.
+    # The announcements themselves are posted by their own scheduler jobs at the exact minute they're due.
+    async def post_about_events(self) -> None:
+        await self.bot.wait_until_ready()
+        current_time = datetime.now(timezone.utc)
+
+        # Skip any guild there's no config file for.
+        guild_configs = self.guild_configs
+        guilds = [guild for guild in self.bot.guilds if guild.id in guild_configs]
+
+        async def refresh(guild: discord.Guild) -> None:
+            await self.event_posting(guild, current_time)
+
+        # Errors and timings for every guild are collected and logged by the FanOut.
+        await self.fanout.run(refresh, guilds, key=lambda guild: guild.id)
+
+    # Keep the event cache current from the gateway so the loop doesn't need to fetch anything.
+    @commands.Cog.listener()
+    async def on_scheduled_event_create(self, event: discord.ScheduledEvent) -> None:
+        self.event_cache.upsert(event)
+        self.schedule_announcements(event.guild_id)
+
+    @commands.Cog.listener()
+    async def on_scheduled_event_update(self, before: discord.ScheduledEvent, after: discord.ScheduledEvent) -> None:
+        self.event_cache.upsert(after)
+        self.schedule_announcements(after.guild_id)
 
-                # Do the actual posting ascynchronously because the fetch_scheduled_events function is so slow.
-                asyncio.create_task(self.event_posting(guild, channel, current_time))
+    @commands.Cog.listener()
+    async def on_scheduled_event_delete(self, event: discord.ScheduledEvent) -> None:
+        self.event_cache.remove(event)
+        self.schedule_announcements(event.guild_id)
 
-        except Exception as e:
-            log.exception(f"Exception in post_about_events loop: {e}.")
+    @commands.Cog.listener()
+    async def on_scheduled_event_user_add(self, event: discord.ScheduledEvent, user: discord.User) -> None:
+        self.event_cache.adjust_user_count(event, 1)
 
-    # Make sure the loop gets stopped if the cog is unloaded.
+    @commands.Cog.listener()
+    async def on_scheduled_event_user_remove(self, event: discord.ScheduledEvent, user: discord.User) -> None:
+        self.event_cache.adjust_user_count(event, -1)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        self.event_cache.drop_guild(guild.id)
+        for _, job in self.announcement_jobs.pop(guild.id, {}).values():
+            job.cancel()
+        self.forget_digest(guild.id)
+        self.pending_pings.pop(guild.id, None)
+
+    # Gateway events may have been missed while a shard was disconnected, so refetch its guilds on the next tick.
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id: int) -> None:
+        self.mark_shard_stale(shard_id)
+
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id: int) -> None:
+        self.mark_shard_stale(shard_id)
+
+    def mark_shard_stale(self, shard_id: int) -> None:
+        # Guilds still on their snapshot are reconciled from the gateway on the next tick anyway.
+        stale = [
+            guild.id
+            for guild in self.bot.guilds
+            if guild.shard_id == shard_id and guild.id in self.event_cache and not self.event_cache.is_provisional(guild.id)
+        ]
+        if stale:
+            self.event_cache.mark_stale(stale)
+            log.info(f"Events: Shard ID {shard_id} reconnected. {len(stale)} guild(s) will be refetched on the next tick.")
+
+    async def save_snapshots(self) -> None:
+        """Save the events of every guild that changed since the last save."""
+        dirty = self.event_cache.take_dirty()
+        if dirty:
+            guild_configs = self.guild_configs
+            await self.bot.store.save_event_snapshots(
+                {guild_id: self.event_cache.snapshot(guild_id) if guild_id in guild_configs else None for guild_id in dirty}
+            )
+
+    # Scheduler jobs are cancelled automatically when the cog is unloaded. Give any refresh in progress a moment to finish.
     async def cog_unload(self) -> None:
-        self.post_about_events.cancel()
-        # Yield once to ensure the cancellation is processed in the event loop.
-        await asyncio.sleep(0)
+        await self.fanout.close()
+        await self.save_snapshots()
 
-    @post_about_events.before_loop
-    async def before_post_about_events(self) -> None:
-        await self.bot.wait_until_ready()
 
 async def setup(bot) -> None:
+    await bot.config_store.watch("events", CONFIG_DIRECTORY, record=EventsConfig, schema=CONFIG_SCHEMA)
     await bot.add_cog(EventsCog(bot))
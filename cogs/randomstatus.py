@@ -1,52 +1,212 @@
 #!/usr/bin/env python3
 # Discord bot: cogs/randomstatus.py
 
+# Presence is per shard, so each shard gets its own rotation and its own turn. A shard's status is set when it becomes ready
+# (shards connect a few seconds apart anyway), and after that shard N of M changes N/M of the way into each interval, so the
+# whole cluster spreads its presence updates over the hour instead of sending them all in the same instant.
+# statuses.yaml:
+#   statuses:                      # Every shard's statuses, unless it has its own below.
+#     - "Brewing coffee"
+#     - name: "Compiling kernels"  # Or with a weight (how often it comes up, default 1) and an activity type
+#                                  # (default listening).
+#       weight: 3
+#       type: watching
+#   shards:                        # Optional. Statuses for particular shards, in the same format.
+#     0:
+#       - "Watching racks fall over"
+
+import asyncio
+import collections
+import functools
 import logging
 import os
 import random
+import time
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 import discord
-import yaml
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 log = logging.getLogger("discord")
 
-# Load config file once when bot starts
 filename = "./cogs/randomstatus_config/statuses.yaml"
-if not os.path.isfile(filename):
-    log.error(f"RandomStatus: No config file found. {filename} at {os.getcwd()}")
-with open(filename, "r") as file:
-    data = yaml.safe_load(file)
-    statuses = data["statuses"]
+
+# How often each shard's status changes, in seconds.
+STATUS_INTERVAL = 3600
+
+# Presence updates share the gateway's 120 sends per 60 seconds per shard with heartbeats and everything else.
+# A shard sends at most this many in PRESENCE_WINDOW seconds, and anything past that waits for the window.
+PRESENCE_BUDGET = 5
+PRESENCE_WINDOW = 60.0
+
+ACTIVITY_TYPES = {
+    "playing": discord.ActivityType.playing,
+    "listening": discord.ActivityType.listening,
+    "watching": discord.ActivityType.watching,
+    "competing": discord.ActivityType.competing,
+}
+
+
+class Status:
+    """One entry of statuses.yaml."""
+
+    __slots__ = ("name", "type", "weight")
+
+    def __init__(self, name: str, type: discord.ActivityType = discord.ActivityType.listening, weight: int = 1) -> None:
+        self.name = name
+        self.type = type
+        self.weight = weight
+
+    @classmethod
+    def from_config(cls, entry) -> "Status":
+        if isinstance(entry, str):
+            return cls(entry)
+        if not isinstance(entry, dict) or not entry.get("name"):
+            raise ValueError(f"A status needs a name: {entry!r}")
+        kind = str(entry.get("type", "listening")).lower()
+        if kind not in ACTIVITY_TYPES:
+            raise ValueError(
+                f"Unknown activity type {kind!r} for status {entry['name']!r}. Use one of {', '.join(ACTIVITY_TYPES)}."
+            )
+        weight = int(entry.get("weight", 1))
+        if weight < 1:
+            raise ValueError(f"The weight of status {entry['name']!r} must be at least 1.")
+        return cls(str(entry["name"]), ACTIVITY_TYPES[kind], weight)
+
+    @property
+    def key(self) -> Tuple[discord.ActivityType, str]:
+        return (self.type, self.name)
+
+
+def load_statuses() -> Tuple[List[Status], Dict[int, List[Status]]]:
+    """The default statuses, and the statuses of shards that have their own."""
+    import yaml
+
+    if not os.path.isfile(filename):
+        log.error(f"RandomStatus: No config file found. {filename} at {os.getcwd()}")
+    with open(filename, "r") as file:
+        data = yaml.safe_load(file)
+    statuses = [Status.from_config(entry) for entry in data["statuses"]]
+    shards = {
+        int(shard_id): [Status.from_config(entry) for entry in entries]
+        for shard_id, entries in (data.get("shards") or {}).items()
+    }
+    return statuses, shards
+
+
+class Rotation:
+    """A weighted shuffle bag: every status comes up weight times per round, in random order, and never twice in a row."""
+
+    def __init__(self, statuses: List[Status]) -> None:
+        self.statuses = statuses
+        self._bag: List[Status] = []
+
+    def next(self, current: Optional[Tuple[discord.ActivityType, str]]) -> Optional[Status]:
+        if not self.statuses:
+            return None
+        if all(status.key == current for status in self._bag):
+            # Empty, or only what's showing now is left (it can't come up twice in a row anyway): start the next round.
+            self._bag = self._round()
+        # The bag is drawn from the end. If the next one is what's showing now, swap in a different one.
+        if self._bag[-1].key == current:
+            for index in range(len(self._bag) - 2, -1, -1):
+                if self._bag[index].key != current:
+                    self._bag[index], self._bag[-1] = self._bag[-1], self._bag[index]
+                    break
+        return self._bag.pop()
+
+    def _round(self) -> List[Status]:
+        statuses = [status for status in self.statuses for _ in range(status.weight)]
+        random.shuffle(statuses)
+        return statuses
 
 
 class RandomStatus(commands.Cog):
-    """Randomly changes the bot's status every so often."""
+    """Randomly changes the bot's status every so often, one shard at a time."""
 
     def __init__(self, bot) -> None:
         self.bot = bot
-        if not self.update_status.is_running():
-            self.update_status.start()
-
-    # Make sure the loop gets stopped if the cog is unloaded.
-    async def cog_unload(self) -> None:
-        self.update_status.cancel()
-
-    # Update bot's status every so often.
-    @tasks.loop(hours=1)
-    async def update_status(self) -> None:
-        try:
-            # Get a status and set it as the current status
-            status = random.choice(statuses)
-            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=status))
-            log.info(f"RandomStatus: Changed bot status to \"{status}\".")
-        except Exception as e:
-            log.error(f"RandomStatus: {e.__class__.__name__}: {e}")
-            return
+        self.statuses: List[Status] = []
+        self.shard_statuses: Dict[int, List[Status]] = {}
+        self.rotations: Dict[int, Rotation] = {}
+        # What each shard is showing, as far as this cog knows.
+        self.current: Dict[int, Tuple[discord.ActivityType, str]] = {}
+        # When each shard sent its recent presence updates, for the budget.
+        self.sent: Dict[int, Deque[float]] = {}
+        # Shards with an update waiting for room in their budget.
+        self.deferred: Set[int] = set()
+
+    # Rotate the statuses every so often. The scheduler cancels the jobs if the cog is unloaded.
+    async def cog_load(self) -> None:
+        # Load the config file off the event loop when the cog loads, instead of at import.
+        self.statuses, self.shard_statuses = await asyncio.to_thread(load_statuses)
+        self.bot.scheduler.every(self.rotate, seconds=STATUS_INTERVAL, owner=self, name="randomstatus: rotate")
+        if self.bot.is_ready():
+            # Reloaded: the shards are already up, so they won't be ready again.
+            self.bot.scheduler.call_later(0, self.update_status, owner=self, name="randomstatus: update")
+
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id: int) -> None:
+        # A shard that identified again has lost its presence.
+        self.current.pop(shard_id, None)
+        await self.update_status(shard_id)
+
+    def rotation(self, shard_id: int) -> Rotation:
+        if shard_id not in self.rotations:
+            self.rotations[shard_id] = Rotation(self.shard_statuses.get(shard_id, self.statuses))
+        return self.rotations[shard_id]
+
+    async def rotate(self) -> None:
+        """Give every shard of this process its turn, spread over the interval by shard ID."""
+        await self.bot.wait_until_ready()
+        shard_count = self.bot.shard_count or 1
+        for shard_id in sorted(self.bot.shards):
+            delay = STATUS_INTERVAL * (shard_id % shard_count) / shard_count
+            self.bot.scheduler.call_later(
+                delay, functools.partial(self.update_status, shard_id), owner=self, name=f"randomstatus: shard {shard_id}"
+            )
 
-    @update_status.before_loop
-    async def before_update_status(self) -> None:
+    async def update_status(self, shard_id: Optional[int] = None) -> None:
+        """Change the status of one shard, or of every shard of this process now."""
         await self.bot.wait_until_ready()
+        for shard in sorted(self.bot.shards) if shard_id is None else (shard_id,):
+            try:
+                await self.update_shard(shard)
+            except Exception as e:
+                log.error(f"RandomStatus: Shard {shard}: {e.__class__.__name__}: {e}")
+
+    async def update_shard(self, shard_id: int) -> None:
+        if shard_id not in self.bot.shards:
+            return
+        sent = self.sent.setdefault(shard_id, collections.deque())
+        now = time.monotonic()
+        while sent and now - sent[0] >= PRESENCE_WINDOW:
+            sent.popleft()
+        if len(sent) >= PRESENCE_BUDGET:
+            # Out of budget. Try again once the oldest update leaves the window. One waiting update per shard is enough.
+            if shard_id not in self.deferred:
+                self.deferred.add(shard_id)
+                self.bot.scheduler.call_later(
+                    PRESENCE_WINDOW - (now - sent[0]),
+                    functools.partial(self._deferred, shard_id),
+                    owner=self,
+                    name=f"randomstatus: shard {shard_id} (deferred)",
+                )
+            log.debug(f"RandomStatus: Shard {shard_id} is out of presence updates for now. Deferring.")
+            return
+
+        status = self.rotation(shard_id).next(self.current.get(shard_id))
+        if status is None or status.key == self.current.get(shard_id):
+            return
+        sent.append(now)
+        await self.bot.change_presence(activity=discord.Activity(type=status.type, name=status.name), shard_id=shard_id)
+        self.current[shard_id] = status.key
+        log.info(f"RandomStatus: Changed shard {shard_id}'s status to \"{status.name}\".")
+
+    async def _deferred(self, shard_id: int) -> None:
+        self.deferred.discard(shard_id)
+        await self.update_status(shard_id)
+
 
 async def setup(bot) -> None:
     await bot.add_cog(RandomStatus(bot))
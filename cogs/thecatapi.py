@@ -1,16 +1,110 @@
 #!/usr/bin/env python3
 # Loudfoot bot: cogs/thecatapi.py
 
+# /gimmeacat answers from a buffer of image URLs that's refilled in the background, so the command never waits on TheCatAPI.
+# If TheCatAPI is slow or down, it falls back to recently shown cats until the buffer can be refilled.
+
+import asyncio
 import logging
+import random
+from collections import deque
+from typing import Deque, List, Optional
 
-import requests
 from discord import Interaction, app_commands
 from discord.ext import commands
 
 import config
+from cogs.utils.responder import Responder
 
 log = logging.getLogger("discord")
 
+THECATAPI_URL = "https://api.thecatapi.com/v1/images/search"
+
+
+class CatBuffer:
+    """Pre-fetched cat image URLs, refilled between a low and a high watermark."""
+
+    def __init__(self, bot, token: Optional[str], *, low: int = 5, high: int = 30, batch: int = 10, recent: int = 50) -> None:
+        self.bot = bot
+        self.token = token
+        self.low = low
+        self.high = high
+        self.batch = batch
+        self.urls: Deque[str] = deque()
+        # Cats that were already shown, to fall back on when the buffer runs dry.
+        self.recent: Deque[str] = deque(maxlen=recent)
+        self._needs_refill = asyncio.Event()
+        self._refilled = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._needs_refill.set()
+            self._task = asyncio.create_task(self._refill_loop(), name="thecatapi: refill")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def pop(self) -> Optional[str]:
+        """Return a fresh cat if there is one, otherwise a recently shown one, otherwise None."""
+        try:
+            url = self.urls.popleft()
+        except IndexError:
+            url = random.choice(self.recent) if self.recent else None
+        else:
+            self.recent.append(url)
+        if len(self.urls) < self.low:
+            self._needs_refill.set()
+        return url
+
+    async def wait(self, timeout: float) -> Optional[str]:
+        """Wait up to `timeout` seconds for the buffer to have something in it."""
+        if not self.urls and not self.recent:
+            self._needs_refill.set()
+            self._refilled.clear()
+            try:
+                await asyncio.wait_for(self._refilled.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pop()
+
+    async def fetch(self) -> List[str]:
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["x-api-key"] = self.token
+        # Random cats, so nothing to cache. Retries, timeouts and failing fast while TheCatAPI is down come from
+        # bot.http_client.
+        catjson = await self.bot.http_client.get_json(THECATAPI_URL, params={"limit": str(self.batch)}, headers=headers)
+        return [cat["url"] for cat in catjson if cat.get("url")]
+
+    async def _refill_loop(self) -> None:
+        await self.bot.wait_until_ready()
+        backoff = 1.0
+        while True:
+            await self._needs_refill.wait()
+            try:
+                while len(self.urls) < self.high:
+                    known = set(self.urls)
+                    urls = [url for url in await self.fetch() if url not in known]
+                    if not urls:
+                        break
+                    self.urls.extend(urls)
+                    self._refilled.set()
+                self._needs_refill.clear()
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep serving whatever we have and try again later.
+                log.warning(
+                    f"CatAPI: Refilling the cat buffer failed ({e.__class__.__name__}: {e}). Retrying in {backoff:.0f}s."
+                )
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300.0)
+
 
 class TheCatAPICog(commands.Cog):
     """TheCatAPI stuff."""
@@ -18,33 +112,45 @@ class TheCatAPICog(commands.Cog):
     def __init__(self, bot, thecatapi_token):
         self.bot = bot
         self.thecatapi_token = thecatapi_token
+        self.cats = CatBuffer(bot, thecatapi_token)
+
+    async def cog_load(self) -> None:
+        self.cats.start()
+
+    async def cog_unload(self) -> None:
+        await self.cats.close()
 
     @app_commands.command()
     async def gimmeacat(self, interaction: Interaction) -> None:
         """Gets and shows a cat photo."""
 
-        # Check if the token is found
-#        if not config.thecatapi_token:
-#            await interaction.reply("The config file does not have a value for thecatapi_token.")
-#            return
+        async with Responder(interaction) as responder:
+            try:
+                caturl = self.cats.pop()
+                if caturl is None:
+                    # Nothing buffered yet (the bot just started, or TheCatAPI has been down the whole time), so this
+                    # one has to wait.
+                    await responder.defer()
+                    caturl = await self.cats.wait(timeout=10.0)
+                    if caturl is None:
+                        await responder.send("TheCatAPI isn't answering right now. Try again in a bit.")
+                        log.warning(
+                            f"CatAPI: Command {getattr(interaction.command, 'name', 'unknown')} had no cat to show "
+                            f"in {getattr(interaction.guild, 'name', 'DM')}."
+                        )
+                        return
+                await responder.send("Prepare for this cuteness: " + caturl)
+                log.info(
+                    f"CatAPI: Command {getattr(interaction.command, 'name', 'unknown')} "
+                    f"was executed successfully in {getattr(interaction.guild, 'name', 'DM')}."
+                )
+            except Exception as e:
+                await responder.fail(f"{e.__class__.__name__}: {e}")
+                log.error(
+                    f"CatAPI: Command {getattr(interaction.command, 'name', 'unknown')} "
+                    f"failed in {getattr(interaction.guild, 'name', 'DM')}."
+                )
 
-        try:
-            catrequest = requests.get("https://api.thecatapi.com/v1/images/search","Content-Type: application/json")
-            #, headers = {"x-api-key": config.thecatapi_token})
-            catjson = catrequest.json()
-            caturl = catjson[0]["url"]
-
-            await interaction.response.send_message("Prepare for this cuteness: " + caturl)
-            log.info(
-                f"CatAPI: Command {getattr(interaction.command, 'name', 'unknown')} "
-                f"was executed successfully in {getattr(interaction.guild, 'name', 'DM')}."
-            )
-        except commands.ExtensionError as e:
-            await interaction.response.send_message(f"{e.__class__.__name__}: {e}")
-            log.error(
-                f"CatAPI: Command {getattr(interaction.command, 'name', 'unknown')} "
-                f"failed in {getattr(interaction.guild, 'name', 'DM')}."
-            )
 
 async def setup(bot):
-    await bot.add_cog(TheCatAPICog(bot, config.thecatapi_token))
+    await bot.add_cog(TheCatAPICog(bot, getattr(config, "thecatapi_token", None)))
@@ -4,7 +4,6 @@ import logging
 import socket
 
 import discord
-import pytz
 from discord import Interaction, app_commands
 from discord.ext import commands
 
@@ -39,6 +38,9 @@ class UptimeCog(commands.Cog):
     @app_commands.command(name="whattimeisit", description="Returns the current time in Eastern Time (Toronto).")
     async def whattimeisit(self, interaction: Interaction):
         try:
+            # pytz is only needed here, so don't import it until someone asks.
+            import pytz
+
             eastern = pytz.timezone("America/Toronto")
             now_utc = discord.utils.utcnow()
             now_eastern = now_utc.astimezone(eastern)
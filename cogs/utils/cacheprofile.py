@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/cacheprofile.py
+
+# The gateway intents and caches the bot runs with, chosen in the config file instead of hardcoded.
+# cache_profile can be one of the presets below, or a dict that starts from a preset and changes parts of it:
+#   cache_profile = {"preset": "minimal", "intents": {"members": True}, "member_cache": ["joined"], "max_messages": None}
+# Presences are the biggest memory and CPU cost in large guilds and no cog reads them, so only "full" has them.
+# A cog says what it needs with class attributes, which are checked when it's added:
+#   requires_intents = ("guild_scheduled_events",)
+#   requires_member_cache = ("joined",)
+
+from typing import Any, Dict, List, Optional
+
+import discord
+from discord.ext import commands
+
+
+class CacheRequirementError(RuntimeError):
+    """A cog needs an intent or cache that the cache profile doesn't have."""
+
+
+def _minimal() -> Dict[str, Any]:
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_scheduled_events = True
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "max_messages": None,
+        "chunk_guilds_at_startup": False,
+    }
+
+
+def _default() -> Dict[str, Any]:
+    # The library's defaults. Intents.default() has none of the privileged intents.
+    intents = discord.Intents.default()
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "max_messages": 1000,
+        "chunk_guilds_at_startup": False,
+    }
+
+
+def _full() -> Dict[str, Any]:
+    intents = discord.Intents.all()
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.all(),
+        "max_messages": 1000,
+        "chunk_guilds_at_startup": True,
+    }
+
+
+PRESETS = {"minimal": _minimal, "default": _default, "full": _full}
+
+
+def _set_flags(flags, values: Dict[str, Any], kind: str):
+    for name, value in values.items():
+        if name not in flags.VALID_FLAGS:
+            raise ValueError(f"Unknown {kind} {name!r} in cache_profile.")
+        setattr(flags, name, bool(value))
+    return flags
+
+
+class CacheProfile:
+    """The intents, member cache, message cache and chunking settings passed to the bot."""
+
+    def __init__(
+        self,
+        name: str,
+        intents: discord.Intents,
+        member_cache_flags: discord.MemberCacheFlags,
+        max_messages: Optional[int],
+        chunk_guilds_at_startup: bool,
+    ) -> None:
+        self.name = name
+        self.intents = intents
+        self.member_cache_flags = member_cache_flags
+        self.max_messages = max_messages
+        self.chunk_guilds_at_startup = chunk_guilds_at_startup
+
+    @classmethod
+    def from_config(cls, setting: Any = "default") -> "CacheProfile":
+        if isinstance(setting, str):
+            setting = {"preset": setting}
+        if not isinstance(setting, dict):
+            raise ValueError(f"cache_profile should be a preset name or a dict, not {type(setting).__name__}.")
+        preset = setting.get("preset", "default")
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown cache_profile preset {preset!r}. Use one of {', '.join(PRESETS)}.")
+        options = PRESETS[preset]()
+
+        _set_flags(options["intents"], setting.get("intents", {}), "intent")
+        if "member_cache" in setting:
+            options["member_cache_flags"] = _set_flags(
+                discord.MemberCacheFlags.none(), dict.fromkeys(setting["member_cache"], True), "member cache flag"
+            )
+        for key in ("max_messages", "chunk_guilds_at_startup"):
+            if key in setting:
+                options[key] = setting[key]
+
+        name = preset if set(setting) <= {"preset"} else f"{preset} (customized)"
+        return cls(name, **options)
+
+    def missing(self, cog: commands.Cog) -> List[str]:
+        """What the cog needs that this profile doesn't have."""
+        missing = [
+            f"the {name} intent" for name in getattr(cog, "requires_intents", ()) if not getattr(self.intents, name, False)
+        ]
+        missing += [
+            f"the {name} member cache"
+            for name in getattr(cog, "requires_member_cache", ())
+            if not getattr(self.member_cache_flags, name, False)
+        ]
+        return missing
+
+    def check(self, cog: commands.Cog) -> None:
+        missing = self.missing(cog)
+        if missing:
+            raise CacheRequirementError(
+                f"{cog.qualified_name} needs {', '.join(missing)}, which the {self.name} cache profile doesn't have. "
+                "Change cache_profile in the config file."
+            )
+
+    def __str__(self) -> str:
+        intents = ", ".join(name for name, enabled in self.intents if enabled) or "none"
+        member_cache = ", ".join(name for name, enabled in self.member_cache_flags if enabled) or "none"
+        return (f"{self.name}: intents {intents}; member cache {member_cache}; max_messages {self.max_messages}; "
+                f"chunking at startup {'on' if self.chunk_guilds_at_startup else 'off'}")
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/cluster.py
+
+# Multi-process shard clustering, for when one process (one core, one GIL) can't keep up with decoding and dispatching
+# every shard.
+# `launcher.py cluster --processes N` runs a Supervisor, which splits the shards into N contiguous ranges and starts one worker
+# process per range, one after another so they don't all identify at once. Workers that exit are restarted with a backoff.
+# The supervisor and the workers talk over a local TCP socket, one JSON object per line, authenticated with a random secret.
+# A worker can broadcast a command (reload_all, resync, stats, stop...) to every worker, including itself, and gets each
+# worker's result back, so the admin commands act on the whole cluster even though only one process gets the interaction.
+# In a worker, the bot has the client side as bot.cluster. Outside cluster mode, bot.cluster is None.
+
+import asyncio
+import hmac
+import itertools
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+log = logging.getLogger("discord")
+
+SECRET_ENV = "DISCORDBOT_CLUSTER_SECRET"
+# Big enough for a stats snapshot or a reload report.
+LINE_LIMIT = 4 * 1024 * 1024
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[range]:
+    """Split the shards into contiguous ranges, as even as possible. There's never more processes than shards."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+def format_shard_ids(shard_ids: range) -> str:
+    return f"{shard_ids.start}-{shard_ids.stop - 1}"
+
+
+def parse_shard_ids(text: str) -> List[int]:
+    start, _, end = text.partition("-")
+    return list(range(int(start), int(end or start) + 1))
+
+
+async def _send(writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+    writer.write(json.dumps(message, separators=(",", ":"), default=str).encode("utf-8") + b"\n")
+    await writer.drain()
+
+
+class ClusterClient:
+    """A worker's connection to the supervisor."""
+
+    def __init__(self, bot, cluster_id: int, port: int, secret: str) -> None:
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.port = port
+        self.secret = secret
+        self.handlers: Dict[str, Tuple[Handler, Any]] = {"stop": (self._stop, self)}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        # Broadcast commands being run. The loop only keeps weak references to tasks, and close() waits for these.
+        self._commands: Set[asyncio.Task] = set()
+        # The bot's close() closes this connection too, so that task isn't one close() cancels.
+        self._close_task: Optional[asyncio.Task] = None
+        self._results: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._closing = False
+
+    def handle(self, command: str, callback: Handler, *, owner: Any = None) -> None:
+        """Run callback(**args) when a broadcast of this command arrives. Its result must be JSON-able."""
+        self.handlers[command] = (callback, owner)
+
+    def unhandle_owner(self, owner: Any) -> None:
+        self.handlers = {
+            command: (callback, cb_owner) for command, (callback, cb_owner) in self.handlers.items() if cb_owner is not owner
+        }
+
+    async def connect(self) -> None:
+        reader, self._writer = await asyncio.open_connection("127.0.0.1", self.port, limit=LINE_LIMIT)
+        await _send(self._writer, {"op": "hello", "cluster": self.cluster_id, "secret": self.secret})
+        self._reader_task = asyncio.create_task(self._read(reader), name=f"cluster {self.cluster_id}: ipc")
+
+    async def close(self) -> None:
+        self._closing = True
+        tasks = [task for task in self._commands if task is not asyncio.current_task()]
+        if self._reader_task is not None:
+            tasks.append(self._reader_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._writer is not None:
+            self._writer.close()
+        for future in self._results.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The cluster connection was closed."))
+
+    async def ready(self) -> None:
+        """Tell the supervisor this worker's shards are up, so it can start the next worker."""
+        if self._writer is not None:
+            await _send(self._writer, {"op": "ready"})
+
+    async def broadcast(self, command: str, *, timeout: float = 60.0, **args) -> Dict[int, Any]:
+        """Run a command on every worker (this one included) and return each one's result, by cluster ID.
+        A worker that failed or didn't answer in time has {"error": "..."} as its result."""
+        if self._writer is None:
+            raise ConnectionError("Not connected to the cluster supervisor.")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._results[request_id] = future
+        try:
+            await _send(
+                self._writer, {"op": "broadcast", "id": request_id, "command": command, "args": args, "timeout": timeout}
+            )
+            # The supervisor applies the timeout to each worker. This one only covers the supervisor itself going quiet.
+            results = await asyncio.wait_for(future, timeout + 10)
+        finally:
+            self._results.pop(request_id, None)
+        return {int(cluster_id): result for cluster_id, result in sorted(results.items(), key=lambda item: int(item[0]))}
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message["op"] == "command":
+                    task = asyncio.create_task(self._run(message), name=f"cluster {self.cluster_id}: {message.get('command')}")
+                    self._commands.add(task)
+                    task.add_done_callback(self._commands.discard)
+                elif message["op"] == "result":
+                    future = self._results.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message["results"])
+        except (ConnectionError, ValueError, KeyError) as e:
+            log.error(f"Cluster: Lost the connection to the supervisor. {e}")
+        if not self._closing:
+            # Without a supervisor nothing would restart this worker or forward admin commands to it, so stop rather
+            # than run orphaned.
+            log.error("Cluster: The supervisor went away. Stopping.")
+            self._close_bot()
+
+    async def _run(self, message: Dict[str, Any]) -> None:
+        command = message["command"]
+        handler = self.handlers.get(command)
+        try:
+            if handler is None:
+                result: Any = {"error": f"cluster {self.cluster_id} has no handler for {command}"}
+            else:
+                result = await handler[0](**message.get("args", {}))
+        except Exception as e:
+            log.exception(f"Cluster: {command} failed. {e}")
+            result = {"error": f"{e.__class__.__name__}: {e}"}
+        try:
+            await _send(self._writer, {"op": "reply", "id": message["id"], "result": result})
+        except (ConnectionError, AttributeError):
+            pass
+
+    async def _stop(self) -> str:
+        # Reply first, then close.
+        self._closing = True
+        asyncio.get_running_loop().call_later(0.5, self._close_bot)
+        return "stopping"
+
+    def _close_bot(self) -> None:
+        if self._close_task is None:
+            self._close_task = asyncio.create_task(self.bot.close(), name=f"cluster {self.cluster_id}: close")
+
+
+class _Worker:
+    def __init__(self, cluster_id: int, shard_ids: range) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.ready = asyncio.Event()
+        self.restarts = 0
+
+
+class Supervisor:
+    """Starts, watches and restarts the worker processes, and relays broadcasts between them."""
+
+    def __init__(
+        self,
+        shard_count: int,
+        processes: int,
+        command: Callable[[int, range, int], Sequence[str]],
+        *,
+        ready_timeout: float = 120.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.shard_count = shard_count
+        self.command = command  # (cluster ID, shard IDs, IPC port) -> the worker's command line
+        self.ready_timeout = ready_timeout
+        self.max_backoff = max_backoff
+        self.workers = [
+            _Worker(cluster_id, shard_ids) for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, processes))
+        ]
+        self.secret = secrets.token_hex(16)
+        self.port = 0
+        self.stopping = False
+        self._stopped = asyncio.Event()
+        self._pending: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        # Broadcasts being relayed, kept so they aren't garbage collected and can be cancelled when the cluster stops.
+        self._broadcasts: Set[asyncio.Task] = set()
+
+    async def run(self) -> None:
+        server = await asyncio.start_server(self._connection, "127.0.0.1", 0, limit=LINE_LIMIT)
+        self.port = server.sockets[0].getsockname()[1]
+        log.info(
+            f"Cluster: {self.shard_count} shards across {len(self.workers)} processes: "
+            + ", ".join(
+                f"cluster {worker.cluster_id} has shards {format_shard_ids(worker.shard_ids)}" for worker in self.workers
+            )
+        )
+        tasks = []
+        try:
+            for worker in self.workers:
+                if self.stopping:
+                    break
+                tasks.append(asyncio.create_task(self._supervise(worker), name=f"cluster {worker.cluster_id}: supervise"))
+                # One worker at a time, so their shards don't all try to identify at once.
+                try:
+                    await asyncio.wait_for(worker.ready.wait(), self.ready_timeout)
+                except asyncio.TimeoutError:
+                    log.warning(
+                        f"Cluster: Cluster {worker.cluster_id} isn't ready after {self.ready_timeout:.0f}s. Starting "
+                        "the next one anyway."
+                    )
+            await self._stopped.wait()
+        finally:
+            self.stopping = True
+            await self._terminate_all()
+            for task in self._broadcasts:
+                task.cancel()
+            await asyncio.gather(*tasks, *self._broadcasts, return_exceptions=True)
+            server.close()
+            await server.wait_closed()
+
+    def stop(self) -> None:
+        self.stopping = True
+        self._stopped.set()
+
+    async def _supervise(self, worker: _Worker) -> None:
+        backoff = 1.0
+        while not self.stopping:
+            started = time.monotonic()
+            env = dict(os.environ, **{SECRET_ENV: self.secret})
+            worker.process = await asyncio.create_subprocess_exec(
+                *self.command(worker.cluster_id, worker.shard_ids, self.port), env=env
+            )
+            log.info(
+                f"Cluster: Started cluster {worker.cluster_id} (pid {worker.process.pid}, shards "
+                f"{format_shard_ids(worker.shard_ids)})."
+            )
+            code = await worker.process.wait()
+            worker.writer = None
+            worker.ready.clear()
+            if self.stopping:
+                log.info(f"Cluster: Cluster {worker.cluster_id} stopped.")
+                return
+            # Reset the backoff if it ran for a while, so an occasional crash is restarted right away.
+            if time.monotonic() - started > self.max_backoff:
+                backoff = 1.0
+            worker.restarts += 1
+            log.error(
+                f"Cluster: Cluster {worker.cluster_id} exited with code {code}. Restarting it in {backoff:.0f}s "
+                f"(restart #{worker.restarts})."
+            )
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _terminate_all(self, timeout: float = 30.0) -> None:
+        running = [
+            worker.process for worker in self.workers if worker.process is not None and worker.process.returncode is None
+        ]
+        for process in running:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker = None
+        try:
+            hello = json.loads(await reader.readline())
+            if hello.get("op") != "hello" or not hmac.compare_digest(str(hello.get("secret", "")), self.secret):
+                log.warning("Cluster: Refused an IPC connection that didn't authenticate.")
+                return
+            worker = self.workers[int(hello["cluster"])]
+            worker.writer = writer
+            while line := await reader.readline():
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "ready":
+                    log.info(f"Cluster: Cluster {worker.cluster_id} is ready.")
+                    worker.ready.set()
+                elif op == "broadcast":
+                    task = asyncio.create_task(
+                        self._broadcast(worker, message), name=f"cluster: broadcast {message.get('command')}"
+                    )
+                    self._broadcasts.add(task)
+                    task.add_done_callback(self._broadcasts.discard)
+                elif op == "reply":
+                    future = self._pending.get((message["id"], worker.cluster_id))
+                    if future is not None and not future.done():
+                        future.set_result(message.get("result"))
+        except (ConnectionError, ValueError, KeyError, IndexError) as e:
+            log.warning(f"Cluster: IPC connection error. {e}")
+        finally:
+            if worker is not None and worker.writer is writer:
+                worker.writer = None
+            writer.close()
+
+    async def _broadcast(self, origin: _Worker, message: Dict[str, Any]) -> None:
+        command = message["command"]
+        timeout = float(message.get("timeout", 60.0))
+        if command == "stop":
+            # Don't restart workers that stop because they were told to.
+            self.stopping = True
+        broadcast_id = next(self._ids)
+        results = await asyncio.gather(
+            *(self._ask(worker, broadcast_id, command, message.get("args", {}), timeout) for worker in self.workers)
+        )
+        if origin.writer is not None:
+            try:
+                await _send(
+                    origin.writer,
+                    {
+                        "op": "result",
+                        "id": message["id"],
+                        "results": {str(worker.cluster_id): result for worker, result in zip(self.workers, results)},
+                    },
+                )
+            except ConnectionError:
+                pass
+        if command == "stop":
+            log.info("Cluster: Stopping the cluster (requested by an admin command).")
+            self._stopped.set()
+
+    async def _ask(self, worker: _Worker, broadcast_id: int, command: str, args: Dict[str, Any], timeout: float) -> Any:
+        if worker.writer is None:
+            return {"error": f"cluster {worker.cluster_id} isn't connected"}
+        future = asyncio.get_running_loop().create_future()
+        self._pending[(broadcast_id, worker.cluster_id)] = future
+        try:
+            await _send(worker.writer, {"op": "command", "id": broadcast_id, "command": command, "args": args})
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return {"error": f"cluster {worker.cluster_id} didn't answer within {timeout:.0f}s"}
+        except ConnectionError as e:
+            return {"error": f"cluster {worker.cluster_id}: {e}"}
+        finally:
+            self._pending.pop((broadcast_id, worker.cluster_id), None)
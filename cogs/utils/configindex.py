@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/configindex.py
+
+# The compact form of a directory of guild configs, for bots in tens of thousands of guilds.
+# A guild's config is a ConfigRecord: a slotted object with the settings the cog reads as attributes, strings interned (so the
+# same role or activity name in a thousand guilds is one string) and lists turned into tuples, instead of a dict per guild.
+# The records of a directory are compiled into one binary index, saved as data/configindex/<name>.idx:
+#   a header, the guild IDs in order, each file's (mtime, size) when it was compiled, a bit per setting that's set, and the
+#   records, marshalled one after another.
+# At startup the index is read back instead of parsing every YAML file again, and only files that changed since are parsed.
+# A guild's record is only decoded the first time something asks for it. Membership and "which guilds set X" decode nothing.
+
+import marshal
+import os
+import struct
+import sys
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+# Bump when the layout below changes. An index in another layout (or for another record) is rebuilt from the YAML files.
+INDEX_VERSION = 1
+MAGIC = b"GCIX"
+# magic, version, record tag length, guild count
+HEADER = struct.Struct("<4sHHI")
+
+# (mtime_ns, size) of a config file.
+Stamp = Tuple[int, int]
+
+
+class ConfigRecord:
+    """A guild's config. Subclasses list the settings they read in __slots__. Settings a file doesn't have are None."""
+
+    __slots__ = ()
+
+    def __init__(self, *values: Any) -> None:
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_config(cls, data: Dict[str, Any]) -> "ConfigRecord":
+        return cls(*(_compact(data.get(name)) for name in cls.__slots__))
+
+    @classmethod
+    def tag(cls) -> bytes:
+        """What an index of these records was compiled for."""
+        return f"{cls.__module__}.{cls.__qualname__}({','.join(cls.__slots__)})".encode()
+
+    def values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def flags(self) -> int:
+        """A bit per setting, set if the setting is."""
+        return sum(1 << bit for bit, value in enumerate(self.values()) if value)
+
+    def __eq__(self, other: Any) -> bool:
+        return type(other) is type(self) and other.values() == self.values()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{name}={value!r}' for name, value in zip(self.__slots__, self.values()))})"
+
+
+def _compact(value: Any) -> Any:
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_compact(item) for item in value)
+    if isinstance(value, dict):
+        return {_compact(key): _compact(item) for key, item in value.items()}
+    return value
+
+
+class GuildIndex:
+    """A directory's config records by guild ID, decoded from the compiled index as they're asked for. Read-only."""
+
+    __slots__ = (
+        "record",
+        "_data",
+        "_ids",
+        "_mtimes",
+        "_sizes",
+        "_flags",
+        "_offsets",
+        "_records_start",
+        "_positions",
+        "_loaded",
+    )
+
+    def __init__(self, record: Type[ConfigRecord], data: bytes = b"") -> None:
+        self.record = record
+        self._data = data or compile_index(record, [])
+        magic, version, tag_length, count = HEADER.unpack_from(self._data)
+        tag = self._data[HEADER.size:HEADER.size + tag_length]
+        if magic != MAGIC or version != INDEX_VERSION or tag != record.tag():
+            raise ValueError("The config index is for a different version or record.")
+        start = _align(HEADER.size + tag_length)
+        arrays = []
+        for typecode, length in (("Q", count), ("q", count), ("q", count), ("Q", count), ("Q", count + 1)):
+            values = array(typecode)
+            values.frombytes(self._data[start:start + 8 * length])
+            if sys.byteorder != "little":
+                values.byteswap()
+            arrays.append(values)
+            start += 8 * length
+        self._ids, self._mtimes, self._sizes, self._flags, self._offsets = arrays
+        self._records_start = start
+        self._positions: Dict[int, int] = {guild_id: position for position, guild_id in enumerate(self._ids)}
+        self._loaded: Dict[int, ConfigRecord] = {}
+
+    @classmethod
+    def load(cls, path: str, record: Type[ConfigRecord]) -> Optional["GuildIndex"]:
+        """The index saved at path, or None if there isn't a usable one."""
+        try:
+            with open(path, "rb") as file:
+                return cls(record, file.read())
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, guild_id: Any) -> bool:
+        return guild_id in self._positions
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._positions)
+
+    def __getitem__(self, guild_id: int) -> ConfigRecord:
+        record = self.get(guild_id)
+        if record is None:
+            raise KeyError(guild_id)
+        return record
+
+    def ids(self):
+        """The guild IDs, as a set-like view."""
+        return self._positions.keys()
+
+    def get(self, guild_id: Optional[int], default: Any = None) -> Any:
+        record = self._loaded.get(guild_id)
+        if record is not None:
+            return record
+        position = self._positions.get(guild_id)
+        if position is None:
+            return default
+        record = self._loaded[guild_id] = self.record(*marshal.loads(self._payload(position)))
+        return record
+
+    def items(self) -> Iterator[Tuple[int, ConfigRecord]]:
+        """Every guild's record. This decodes all of them, so prefer get() and with_setting()."""
+        for guild_id in self._positions:
+            yield guild_id, self.get(guild_id)
+
+    def with_setting(self, name: str) -> List[int]:
+        """The guilds that set a setting (to anything but an empty or false value), without decoding their records."""
+        mask = 1 << self.record.__slots__.index(name)
+        return [guild_id for guild_id, flags in zip(self._ids, self._flags) if flags & mask]
+
+    def stamp(self, guild_id: int) -> Optional[Stamp]:
+        position = self._positions.get(guild_id)
+        return (self._mtimes[position], self._sizes[position]) if position is not None else None
+
+    def _payload(self, position: int) -> bytes:
+        return self._data[self._records_start + self._offsets[position]:self._records_start + self._offsets[position + 1]]
+
+    def updated(self, updates: Dict[int, Optional[Tuple[Stamp, ConfigRecord]]], path: Optional[str] = None) -> "GuildIndex":
+        """A new index with some guilds' records replaced (or removed, for None), saved to path if there is one."""
+        entries = []
+        for guild_id, position in self._positions.items():
+            if guild_id not in updates:
+                entries.append(
+                    (guild_id, (self._mtimes[position], self._sizes[position]), self._flags[position], self._payload(position))
+                )
+        for guild_id, update in updates.items():
+            if update is not None:
+                stamp, record = update
+                entries.append((guild_id, stamp, record.flags(), marshal.dumps(record.values(), 4)))
+        data = compile_index(self.record, entries)
+        if path is not None:
+            save_index(path, data)
+        index = GuildIndex(self.record, data)
+        # Records that were already decoded and didn't change carry over. The new ones are decoded when they're asked for,
+        # like everything else, so building the index for the first time doesn't keep every record.
+        index._loaded = {guild_id: record for guild_id, record in self._loaded.items() if guild_id not in updates}
+        return index
+
+
+def compile_index(record: Type[ConfigRecord], entries: List[Tuple[int, Stamp, int, bytes]]) -> bytes:
+    """The binary index of (guild ID, stamp, flags, marshalled record) entries."""
+    entries = sorted(entries)
+    tag = record.tag()
+    header = HEADER.pack(MAGIC, INDEX_VERSION, len(tag), len(entries)) + tag
+    header += b"\0" * (_align(len(header)) - len(header))
+    offsets = [0]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry[3]))
+    arrays = [
+        array("Q", [entry[0] for entry in entries]),
+        array("q", [entry[1][0] for entry in entries]),
+        array("q", [entry[1][1] for entry in entries]),
+        array("Q", [entry[2] for entry in entries]),
+        array("Q", offsets),
+    ]
+    if sys.byteorder != "little":
+        for values in arrays:
+            values.byteswap()
+    return b"".join([header, *(values.tobytes() for values in arrays), *(entry[3] for entry in entries)])
+
+
+def save_index(path: str, data: bytes) -> None:
+    """Write an index so nothing (another cluster process, say) ever reads half of one."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/configstore.py
+
+# Per-guild YAML config files (cogs/<name>_config/<guild_id>.yaml), loaded once and then hot-reloaded.
+# The directories are polled by mtime and only files that changed are re-parsed, in a thread so the event loop never
+# waits on disk or YAML.
+# Each file is validated before it replaces the old one, and subscribers are told which guild changed so they can update
+# just that guild.
+# A guild's config is a record (see configindex.py): the cog's ConfigRecord subclass, with the settings as attributes.
+# Each directory is compiled into an index file in index_directory, so a restart only parses the files that changed, and
+# records are only decoded once something asks for that guild.
+# Cogs get it as bot.config_store.
+
+import asyncio
+import inspect
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Type
+
+from cogs.utils.configindex import ConfigRecord, GuildIndex, Stamp
+
+log = logging.getLogger("discord")
+
+# Files in the config directories that aren't guild configs.
+IGNORED_FILES = {".gitignore", "000000000000000000.yaml"}
+
+# (old config, new config) for one guild. Either one is None when the guild's file was added or removed.
+Subscriber = Callable[[int, Optional[ConfigRecord], Optional[ConfigRecord]], Any]
+
+
+class ConfigSchema:
+    """Required and optional top-level keys of a guild config file, with the types they must have."""
+
+    def __init__(self, required: Optional[Dict[str, Any]] = None, optional: Optional[Dict[str, Any]] = None) -> None:
+        self.required = required or {}
+        self.optional = optional or {}
+
+    def validate(self, data: Any) -> List[str]:
+        if not isinstance(data, dict):
+            return ["the file must contain a mapping of settings"]
+        errors = []
+        for key, expected in self.required.items():
+            if key not in data:
+                errors.append(f"missing required setting \"{key}\"")
+            elif not isinstance(data[key], expected):
+                errors.append(f"\"{key}\" should be {_type_name(expected)}, not {type(data[key]).__name__}")
+        for key, expected in self.optional.items():
+            if data.get(key) is not None and not isinstance(data[key], expected):
+                errors.append(f"\"{key}\" should be {_type_name(expected)}, not {type(data[key]).__name__}")
+        return errors
+
+
+def _type_name(expected: Any) -> str:
+    if isinstance(expected, tuple):
+        return " or ".join(t.__name__ for t in expected)
+    return expected.__name__
+
+
+class _WatchedDirectory:
+    def __init__(
+        self, name: str, directory: str, schema: Optional[ConfigSchema], record: Type[ConfigRecord], index_path: Optional[str]
+    ) -> None:
+        self.name = name
+        self.directory = directory
+        self.schema = schema
+        self.record = record
+        self.index_path = index_path
+        # The index has each loaded file's (mtime_ns, size) too.
+        self.configs = GuildIndex(record)
+        # (mtime_ns, size) of files that didn't parse or validate, so they're only looked at again once they change.
+        self.rejected: Dict[int, Stamp] = {}
+        self.subscribers: List[Tuple[Subscriber, Any]] = []
+
+
+class ConfigStore:
+    """Hot-reloadable per-guild config files."""
+
+    def __init__(self, bot, *, interval: float = 10.0, index_directory: Optional[str] = "data/configindex") -> None:
+        self.bot = bot
+        self.interval = interval
+        # Where the compiled indexes are saved. None keeps them in memory only, so every start parses every file.
+        self.index_directory = index_directory
+        self._watched: Dict[str, _WatchedDirectory] = {}
+        self._lock = asyncio.Lock()
+        self._job = None
+
+    async def watch(
+        self, name: str, directory: str, *, record: Type[ConfigRecord], schema: Optional[ConfigSchema] = None
+    ) -> GuildIndex:
+        """Start watching a config directory (if it isn't already) and return its current configs."""
+        previous = self._watched.get(name)
+        # A reloaded cog brings a new record class (maybe with other settings), so its configs are loaded again as those.
+        if previous is None or previous.record is not record:
+            index_path = os.path.join(self.index_directory, f"{name}.idx") if self.index_directory else None
+            watched = self._watched[name] = _WatchedDirectory(name, directory, schema, record, index_path)
+            if previous is not None:
+                watched.subscribers = previous.subscribers
+            if index_path is not None:
+                index = await asyncio.to_thread(GuildIndex.load, index_path, record)
+                if index is not None:
+                    watched.configs = index
+            await self.reload(name)
+        if self._job is None or self._job.cancelled:
+            self._job = self.bot.scheduler.every(
+                self.poll, seconds=self.interval, owner=self, name="configstore: poll", catch_up="skip"
+            )
+        return self._watched[name].configs
+
+    def configs(self, name: str) -> GuildIndex:
+        """All of a directory's configs, by guild ID. A reload replaces the whole index instead of changing it."""
+        watched = self._watched.get(name)
+        return watched.configs if watched else _EMPTY
+
+    def get(self, name: str, guild_id: Optional[int]) -> Optional[ConfigRecord]:
+        return self.configs(name).get(guild_id)
+
+    def subscribe(self, name: str, callback: Subscriber, *, owner: Any = None) -> None:
+        self._watched[name].subscribers.append((callback, owner))
+
+    def unsubscribe_owner(self, owner: Any) -> None:
+        for watched in self._watched.values():
+            watched.subscribers = [(callback, cb_owner) for callback, cb_owner in watched.subscribers if cb_owner is not owner]
+
+    async def poll(self) -> None:
+        for name in list(self._watched):
+            await self.reload(name)
+
+    async def reload(self, name: str) -> List[int]:
+        """Re-parse any files in the directory that changed since last time and return the guild IDs that changed."""
+        watched = self._watched[name]
+        async with self._lock:
+            configs = watched.configs
+            present, stamps, parsed, errors = await asyncio.to_thread(_scan, watched.directory, configs, watched.rejected)
+
+            rejected = {guild_id: stamp for guild_id, stamp in watched.rejected.items() if guild_id in present}
+            updates: Dict[int, Optional[Tuple[Stamp, ConfigRecord]]] = {}
+            changed: List[Tuple[int, Optional[ConfigRecord], Optional[ConfigRecord]]] = []
+            for guild_id, data in parsed.items():
+                problems = watched.schema.validate(data) if watched.schema else []
+                if problems:
+                    # Keep the last good version of the file until it's fixed.
+                    log.error(
+                        f"ConfigStore: {watched.directory}/{guild_id}.yaml is invalid and was not loaded: "
+                        f"{'; '.join(problems)}."
+                    )
+                    rejected[guild_id] = stamps[guild_id]
+                    continue
+                rejected.pop(guild_id, None)
+                record = watched.record.from_config(data)
+                # The new stamp is kept even if nothing the cog reads changed, so the file isn't parsed again.
+                updates[guild_id] = (stamps[guild_id], record)
+                old = configs.get(guild_id)
+                if old != record:
+                    changed.append((guild_id, old, record))
+            for guild_id, error in errors.items():
+                log.error(f"ConfigStore: {watched.directory}/{guild_id}.yaml could not be read and was not loaded: {error}")
+                rejected[guild_id] = stamps[guild_id]
+            for guild_id in configs.ids() - present:
+                updates[guild_id] = None
+                changed.append((guild_id, configs.get(guild_id), None))
+
+            if updates:
+                configs = await asyncio.to_thread(configs.updated, updates, watched.index_path)
+            # Swap the whole index in one go so nothing ever sees a half-updated set of configs.
+            watched.configs = configs
+            watched.rejected = rejected
+
+        if changed:
+            log.info(f"ConfigStore: Loaded {len(changed)} changed {name} config(s) from {watched.directory}.")
+        for guild_id, old, new in changed:
+            await self._notify(watched, guild_id, old, new)
+        return [guild_id for guild_id, _, _ in changed]
+
+    async def _notify(
+        self, watched: _WatchedDirectory, guild_id: int, old: Optional[ConfigRecord], new: Optional[ConfigRecord]
+    ) -> None:
+        for callback, _ in list(watched.subscribers):
+            try:
+                result = callback(guild_id, old, new)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                log.exception(f"ConfigStore: A subscriber to {watched.name} failed for guild {guild_id}. {e}")
+
+
+def _scan(
+    directory: str, index: GuildIndex, rejected: Dict[int, Stamp]
+) -> Tuple[Set[int], Dict[int, Stamp], Dict[int, Any], Dict[int, str]]:
+    """Runs in a thread.
+    Returns the guilds that have a file, plus the stamp and parsed contents (or error) of the files that changed."""
+    import yaml
+
+    # libyaml's loader, if PyYAML was built with it, is several times faster than the pure Python one.
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    present: Set[int] = set()
+    stamps: Dict[int, Stamp] = {}
+    parsed: Dict[int, Any] = {}
+    errors: Dict[int, str] = {}
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        log.error(f"ConfigStore: The config directory {directory} does not exist.")
+        return present, stamps, parsed, errors
+
+    for entry in entries:
+        if entry.name in IGNORED_FILES or not entry.name.endswith(".yaml") or not entry.is_file():
+            continue
+        try:
+            guild_id = int(entry.name.split(".")[0])
+        except ValueError:
+            continue
+        present.add(guild_id)
+        stat = entry.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if index.stamp(guild_id) == stamp or rejected.get(guild_id) == stamp:
+            continue
+        stamps[guild_id] = stamp
+        try:
+            with open(entry.path, "r") as file:
+                parsed[guild_id] = yaml.load(file, Loader=loader)
+        except (OSError, yaml.YAMLError) as e:
+            errors[guild_id] = f"{e.__class__.__name__}: {e}"
+    return present, stamps, parsed, errors
+
+
+class _NoRecord(ConfigRecord):
+    __slots__ = ()
+
+
+_EMPTY = GuildIndex(_NoRecord)
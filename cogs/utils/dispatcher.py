@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/dispatcher.py
+
+# One queue for everything the cogs send to Discord: messages, edits and role changes.
+# Each request is queued under the rate limit route it will hit (e.g. sending messages to one channel). The dispatcher keeps
+# what Discord's rate limit headers said about each route (read from every response with an aiohttp trace, 429s included),
+# and only starts a request when its route has room, so a burst of announcements into the same channels waits here instead
+# of piling into 429s. Requests from users (INTERACTIVE) always go before background ones, and a route that's out of
+# requests doesn't hold up requests to other routes. The queue is bounded: background submitters wait for room, while
+# interactive requests have some headroom past the bound so a user never waits on a backlog of announcements.
+# discord.py's own rate limiting still runs underneath. This just keeps the bot from leaning on it.
+# The bot has it as bot.dispatcher.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+import discord
+
+log = logging.getLogger("discord")
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# How many requests are sent at once for a route Discord hasn't told us the limits of yet.
+UNKNOWN_ROUTE_CONCURRENCY = 1
+
+# /channels/<id>, /guilds/<id> and /webhooks/<id> are the "major parameters" that get separate rate limits. Other IDs don't.
+_MAJOR = re.compile(r"^/(channels|guilds|webhooks)/(\d+)")
+_ID = re.compile(r"/\d+")
+
+
+def route_key(method: str, path: str) -> str:
+    """The rate limit route for a request: the method and path, with every ID except the major parameter left out."""
+    api = path.find("/api/v")
+    if api != -1:
+        path = path[path.index("/", api + 5):]
+    major = _MAJOR.match(path)
+    if major:
+        return f"{method} {major.group(0)}{_ID.sub('/{id}', path[major.end():])}"
+    return f"{method} {_ID.sub('/{id}', path)}"
+
+
+class BucketState:
+    """What the last response said about a route's rate limit."""
+
+    __slots__ = ("limit", "remaining", "reset_at", "in_flight", "known")
+
+    def __init__(self) -> None:
+        self.limit = UNKNOWN_ROUTE_CONCURRENCY
+        self.remaining = UNKNOWN_ROUTE_CONCURRENCY
+        self.reset_at = 0.0
+        self.in_flight = 0
+        self.known = False
+
+    def available(self, now: float) -> bool:
+        if now >= self.reset_at and self.known:
+            # The window has reset since the last response. Allow a full window, minus what's already on its way.
+            return self.in_flight < self.limit
+        return self.remaining - self.in_flight > 0 if self.known else self.in_flight < UNKNOWN_ROUTE_CONCURRENCY
+
+    def update(self, headers, now: float) -> None:
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if limit is None or remaining is None or reset_after is None:
+            return
+        self.limit = int(limit)
+        self.remaining = int(remaining)
+        self.reset_at = now + float(reset_after)
+        self.known = True
+
+    def exhaust(self, retry_after: float, now: float) -> None:
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, now + retry_after)
+        self.known = True
+
+
+class _Request:
+    __slots__ = ("priority", "seq", "route", "factory", "future", "queued", "kind")
+
+    def __init__(
+        self, priority: int, seq: int, route: str, factory: Callable[[], Awaitable[Any]], future: asyncio.Future, kind: str
+    ) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.factory = factory
+        self.future = future
+        self.queued = time.monotonic()
+        self.kind = kind
+
+    def __lt__(self, other: "_Request") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Dispatcher:
+    """Rate-limit-aware, prioritized queue for outbound requests."""
+
+    def __init__(self, bot, *, maxsize: int = 1000, interactive_headroom: int = 100, concurrency: int = 8) -> None:
+        self.bot = bot
+        self.maxsize = maxsize
+        self.interactive_headroom = interactive_headroom
+        self.concurrency = concurrency
+        self.buckets: Dict[str, BucketState] = {}
+        # Queued requests per route, each in priority order.
+        self._queues: Dict[str, List[_Request]] = {}
+        self._size = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Condition()
+        self._global_until = 0.0
+        self._running = 0
+        self._task: Optional[asyncio.Task] = None
+        # Requests being sent. The loop only keeps weak references to tasks, and close() waits for these.
+        self._in_flight: Set[asyncio.Task] = set()
+
+        registry = bot.metrics.registry
+        self.queue_delay = registry.histogram(
+            "discordbot_dispatch_queue_seconds", "Time requests waited in the dispatcher queue.", ("priority",)
+        )
+        self.dispatched = registry.counter(
+            "discordbot_dispatch_requests_total", "Requests sent through the dispatcher.", ("kind", "priority", "outcome")
+        )
+        registry.gauge(
+            "discordbot_dispatch_queue_depth", "Requests waiting in the dispatcher queue.", callback=lambda: {(): self._size}
+        )
+
+    def attach(self, trace: aiohttp.TraceConfig) -> None:
+        """Watch the responses of the bot's HTTP client. The trace is the one passed to the bot as http_trace."""
+        trace.on_request_end.append(self._on_request_end)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="dispatcher")
+
+    async def close(self) -> None:
+        tasks = list(self._in_flight)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        for queue in self._queues.values():
+            for request in queue:
+                if not request.future.done():
+                    request.future.cancel()
+        self._queues.clear()
+        self._size = 0
+
+    # What the cogs call.
+
+    async def send(
+        self, channel: discord.abc.Messageable, content: Optional[str] = None, *, priority: int = BACKGROUND, **kwargs
+    ) -> discord.Message:
+        channel_id = getattr(channel, "id", None)
+        return await self.submit(
+            f"POST /channels/{channel_id}/messages", lambda: channel.send(content, **kwargs), priority=priority, kind="send"
+        )
+
+    async def edit(self, message: discord.Message, *, priority: int = BACKGROUND, **kwargs) -> discord.Message:
+        return await self.submit(
+            f"PATCH /channels/{message.channel.id}/messages/{{id}}",
+            lambda: message.edit(**kwargs),
+            priority=priority,
+            kind="edit",
+        )
+
+    async def add_roles(
+        self, member: discord.Member, *roles: discord.abc.Snowflake, reason: Optional[str] = None, priority: int = INTERACTIVE
+    ) -> None:
+        route = f"PUT /guilds/{member.guild.id}/members/{{id}}/roles/{{id}}"
+        await self.submit(route, lambda: member.add_roles(*roles, reason=reason), priority=priority, kind="add_roles")
+
+    async def remove_roles(
+        self, member: discord.Member, *roles: discord.abc.Snowflake, reason: Optional[str] = None, priority: int = INTERACTIVE
+    ) -> None:
+        route = f"DELETE /guilds/{member.guild.id}/members/{{id}}/roles/{{id}}"
+        await self.submit(route, lambda: member.remove_roles(*roles, reason=reason), priority=priority, kind="remove_roles")
+
+    async def submit(
+        self, route: str, factory: Callable[[], Awaitable[Any]], *, priority: int = BACKGROUND, kind: str = "request"
+    ) -> Any:
+        """Queue factory() under a rate limit route and return its result once it has run."""
+        limit = self.maxsize + (self.interactive_headroom if priority == INTERACTIVE else 0)
+        if self._size >= limit:
+            # Backpressure: wait for room instead of letting the queue grow without bound.
+            async with self._room:
+                await self._room.wait_for(lambda: self._size < limit)
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(priority, next(self._seq), route, factory, future, kind)
+        heapq.heappush(self._queues.setdefault(route, []), request)
+        self._size += 1
+        self._wakeup.set()
+        return await future
+
+    # The dispatch loop.
+
+    async def _run(self) -> None:
+        while True:
+            request, wait = self._next()
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._running += 1
+            self.buckets.setdefault(request.route, BucketState()).in_flight += 1
+            task = asyncio.create_task(self._execute(request), name=f"dispatcher: {request.kind}")
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _next(self) -> Tuple[Optional[_Request], Optional[float]]:
+        """The most urgent request whose route has room, or how long to wait before one might."""
+        now = time.monotonic()
+        if now < self._global_until:
+            return None, self._global_until - now
+        if self._running >= self.concurrency:
+            return None, None
+        best: Optional[_Request] = None
+        wait: Optional[float] = None
+        for route, queue in self._queues.items():
+            head = queue[0]
+            bucket = self.buckets.get(route)
+            if bucket is None or bucket.available(now):
+                if best is None or head < best:
+                    best = head
+            elif bucket.in_flight == 0 and bucket.reset_at > now:
+                wait = bucket.reset_at - now if wait is None else min(wait, bucket.reset_at - now)
+        if best is None:
+            return None, wait
+        queue = self._queues[best.route]
+        heapq.heappop(queue)
+        if not queue:
+            del self._queues[best.route]
+        self._size -= 1
+        return best, None
+
+    async def _execute(self, request: _Request) -> None:
+        delay = time.monotonic() - request.queued
+        self.queue_delay.observe(delay, PRIORITY_NAMES.get(request.priority, str(request.priority)))
+        outcome = "ok"
+        try:
+            if request.future.cancelled():
+                outcome = "cancelled"
+                return
+            try:
+                result = await request.factory()
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                request.future.cancel()
+                raise
+            except Exception as e:
+                outcome = "error"
+                if not request.future.done():
+                    request.future.set_exception(e)
+            else:
+                if not request.future.done():
+                    request.future.set_result(result)
+        finally:
+            self._running -= 1
+            bucket = self.buckets.get(request.route)
+            if bucket is not None:
+                bucket.in_flight -= 1
+            self.dispatched.inc(request.kind, PRIORITY_NAMES.get(request.priority, str(request.priority)), outcome)
+            self._wakeup.set()
+            async with self._room:
+                self._room.notify_all()
+
+    # Rate limit headers, from every response the bot's HTTP client gets.
+
+    async def _on_request_end(self, session, context, params: aiohttp.TraceRequestEndParams) -> None:
+        response = params.response
+        headers = response.headers
+        if "X-RateLimit-Limit" not in headers and response.status != 429:
+            return
+        now = time.monotonic()
+        route = route_key(params.method, params.url.path)
+        bucket = self.buckets.setdefault(route, BucketState())
+        if response.status == 429:
+            retry_after = float(headers.get("Retry-After", headers.get("X-RateLimit-Reset-After", 1.0)))
+            if headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global":
+                self._global_until = now + retry_after
+            else:
+                bucket.exhaust(retry_after, now)
+            log.warning(f"Dispatcher: {route} was rate limited for {retry_after:.1f}s.")
+        else:
+            bucket.update(headers, now)
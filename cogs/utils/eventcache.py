@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/eventcache.py
+
+# In-memory, per-guild index of scheduled events.
+# The index is seeded with one fetch_scheduled_events() call per guild and then kept current from gateway events, so
+# reading it costs no REST traffic. A guild is only fetched again after it's been marked stale (a shard reconnect or
+# resume).
+# The events cog saves each guild's events to the store (cogs/utils/store.py) and seeds the index from those snapshots
+# after a restart. A seeded guild is provisional until its shard connects, and is then brought up to date from the
+# events the gateway sent with the guild, still without a fetch.
+
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+import discord
+
+log = logging.getLogger("discord")
+
+
+class CachedEvent:
+    """The handful of scheduled event fields the bot actually uses."""
+
+    __slots__ = ("id", "guild_id", "name", "start_time", "status", "user_count")
+
+    def __init__(
+        self,
+        id: int,
+        guild_id: int,
+        name: str,
+        start_time: datetime,
+        status: discord.EventStatus,
+        user_count: Optional[int] = None,
+    ) -> None:
+        self.id = id
+        self.guild_id = guild_id
+        self.name = name
+        self.start_time = start_time
+        self.status = status
+        self.user_count = user_count
+
+    @classmethod
+    def from_event(cls, event: discord.ScheduledEvent) -> "CachedEvent":
+        return cls(event.id, event.guild_id, event.name, event.start_time, event.status, event.user_count)
+
+    @classmethod
+    def from_dict(cls, guild_id: int, data: dict) -> "CachedEvent":
+        return cls(
+            data["id"],
+            guild_id,
+            data["name"],
+            datetime.fromisoformat(data["start_time"]),
+            discord.EventStatus(data["status"]),
+            data.get("user_count"),
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "start_time": self.start_time.isoformat(),
+            "status": self.status.value,
+            "user_count": self.user_count,
+        }
+
+    @property
+    def url(self) -> str:
+        return f"https://discord.com/events/{self.guild_id}/{self.id}"
+
+    def __repr__(self) -> str:
+        return f"<CachedEvent id={self.id} guild_id={self.guild_id} name={self.name!r} start_time={self.start_time}>"
+
+
+class ScheduledEventCache:
+    """Scheduled events per guild, kept current from the gateway."""
+
+    def __init__(self) -> None:
+        self._events: Dict[int, Dict[int, CachedEvent]] = {}
+        self._stale: Set[int] = set()
+        # Seeded from a snapshot and not yet checked against the gateway.
+        self._provisional: Set[int] = set()
+        # Changed since the last snapshot was taken.
+        self._dirty: Set[int] = set()
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._events
+
+    def events(self, guild_id: int) -> List[CachedEvent]:
+        return list(self._events.get(guild_id, {}).values())
+
+    def get(self, guild_id: int, event_id: int) -> Optional[CachedEvent]:
+        return self._events.get(guild_id, {}).get(event_id)
+
+    def needs_fetch(self, guild_id: int) -> bool:
+        return guild_id not in self._events or guild_id in self._stale
+
+    def mark_stale(self, guild_ids: Iterable[int]) -> None:
+        self._stale.update(guild_ids)
+
+    def is_provisional(self, guild_id: int) -> bool:
+        return guild_id in self._provisional
+
+    def drop_guild(self, guild_id: int) -> None:
+        self._events.pop(guild_id, None)
+        self._stale.discard(guild_id)
+        self._provisional.discard(guild_id)
+        self._dirty.add(guild_id)
+
+    def seed(self, guild_id: int, events: List[dict]) -> None:
+        """Start a guild from a saved snapshot, unless it's already been fetched."""
+        if guild_id in self._events:
+            return
+        self._events[guild_id] = {data["id"]: CachedEvent.from_dict(guild_id, data) for data in events}
+        self._provisional.add(guild_id)
+
+    def reconcile(self, guild: discord.Guild) -> List[CachedEvent]:
+        """Bring a provisional guild up to date from the scheduled events the gateway sent with the guild. The gateway doesn't
+        send interest counts, so those are kept from the snapshot."""
+        old = self._events.get(guild.id, {})
+        events = {}
+        for event in guild.scheduled_events:
+            cached = CachedEvent.from_event(event)
+            if cached.user_count is None and event.id in old:
+                cached.user_count = old[event.id].user_count
+            events[event.id] = cached
+        self._events[guild.id] = events
+        self._provisional.discard(guild.id)
+        self._stale.discard(guild.id)
+        self._dirty.add(guild.id)
+        return self.events(guild.id)
+
+    def snapshot(self, guild_id: int) -> Optional[List[dict]]:
+        events = self._events.get(guild_id)
+        return None if events is None else [event.to_dict() for event in events.values()]
+
+    def take_dirty(self) -> Set[int]:
+        """The guilds that changed since the last call."""
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    async def fetch(self, guild: discord.Guild) -> List[CachedEvent]:
+        """Replace a guild's events with a fresh REST fetch. This is the only place the cache makes an API call."""
+        fetched = await guild.fetch_scheduled_events()
+        self._events[guild.id] = {event.id: CachedEvent.from_event(event) for event in fetched}
+        self._stale.discard(guild.id)
+        self._provisional.discard(guild.id)
+        self._dirty.add(guild.id)
+        log.debug(f"EventCache: Fetched {len(fetched)} scheduled event(s) for {guild.name} (ID: {guild.id}).")
+        return self.events(guild.id)
+
+    def upsert(self, event: discord.ScheduledEvent) -> Optional[CachedEvent]:
+        # Ignore guilds that haven't been seeded yet. Their first fetch will include this event anyway.
+        guild_events = self._events.get(event.guild_id)
+        if guild_events is None:
+            return None
+        cached = CachedEvent.from_event(event)
+        guild_events[event.id] = cached
+        self._dirty.add(event.guild_id)
+        return cached
+
+    def remove(self, event: discord.ScheduledEvent) -> Optional[CachedEvent]:
+        removed = self._events.get(event.guild_id, {}).pop(event.id, None)
+        if removed is not None:
+            self._dirty.add(event.guild_id)
+        return removed
+
+    def adjust_user_count(self, event: discord.ScheduledEvent, delta: int) -> None:
+        cached = self.get(event.guild_id, event.id)
+        if cached is None:
+            return
+        cached.user_count = max(0, (cached.user_count or 0) + delta)
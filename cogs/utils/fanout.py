@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/fanout.py
+
+# Runs the same piece of work for many items (usually guilds) with a limit on how many run at once.
+# Every task is kept track of, errors and timings are collected into one report per run, and close() drains or cancels
+# whatever is still running.
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, TypeVar
+
+log = logging.getLogger("discord")
+
+T = TypeVar("T")
+
+MAX_LOGGED_ERRORS = 5
+
+
+class FanOutReport:
+    """What happened during one FanOut.run()."""
+
+    def __init__(self, name: str, total: int) -> None:
+        self.name = name
+        self.total = total
+        self.succeeded = 0
+        self.errors: Dict[Hashable, BaseException] = {}
+        self.latencies: List[float] = []
+        self.duration = 0.0
+        self.cancelled = False
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.succeeded}/{self.total} succeeded, {self.failed} failed in {self.duration:.2f}s "
+            f"(p50 {self.percentile(50) * 1000:.0f}ms, p95 {self.percentile(95) * 1000:.0f}ms, max "
+            f"{max(self.latencies, default=0.0) * 1000:.0f}ms)"
+        )
+
+
+class FanOut:
+    """A bounded, tracked executor for per-item work."""
+
+    def __init__(self, name: str, *, concurrency: int = 10, jitter: float = 0.0) -> None:
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        self.name = name
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.last_report: Optional[FanOutReport] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._closed = False
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    async def run(
+        self,
+        func: Callable[[T], Awaitable[Any]],
+        items: Iterable[T],
+        *,
+        key: Callable[[T], Hashable] = lambda item: item,
+        jitter: Optional[float] = None,
+    ) -> FanOutReport:
+        """Call func(item) for every item, at most `concurrency` at a time, and wait for all of them.
+        jitter overrides the FanOut's for this run."""
+        if self._closed:
+            raise RuntimeError(f"FanOut {self.name} is closed.")
+
+        items = list(items)
+        report = FanOutReport(self.name, len(items))
+        queue = iter(items)
+        started = time.perf_counter()
+        jitter = self.jitter if jitter is None else jitter
+
+        async def worker() -> None:
+            # Stagger when each worker starts so a tick doesn't hit the API all in the same instant. Only once per worker: a
+            # sleep before every item would hold a slot for nothing, and a run would take len(items) / concurrency * jitter / 2
+            # seconds even when no item calls the API.
+            if jitter:
+                await asyncio.sleep(random.uniform(0, jitter))
+            for item in queue:
+                await self._call(func, item, key, report)
+
+        workers = [
+            asyncio.create_task(worker(), name=f"fanout: {self.name}") for _ in range(min(self.concurrency, len(items)))
+        ]
+        self._tasks.update(workers)
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            report.cancelled = True
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        finally:
+            self._tasks.difference_update(workers)
+            report.duration = time.perf_counter() - started
+            self.last_report = report
+            self._log(report)
+
+        return report
+
+    @staticmethod
+    async def _call(func: Callable[[T], Awaitable[Any]], item: T, key: Callable[[T], Hashable], report: FanOutReport) -> None:
+        item_started = time.perf_counter()
+        try:
+            await func(item)
+            report.succeeded += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            report.errors[key(item)] = e
+        finally:
+            report.latencies.append(time.perf_counter() - item_started)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Let running work finish for up to `timeout` seconds, then cancel the rest."""
+        self._closed = True
+        tasks = list(self._tasks)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pending:
+            log.warning(f"FanOut: Cancelled {len(pending)} unfinished task(s) for {self.name}.")
+
+    def _log(self, report: FanOutReport) -> None:
+        if report.cancelled:
+            log.warning(f"FanOut: {report} (cancelled)")
+        elif report.errors:
+            log.error(f"FanOut: {report}")
+            # Only log the first few tracebacks. If the API is down, every item fails the same way.
+            for item_key, error in list(report.errors.items())[:MAX_LOGGED_ERRORS]:
+                log.error(f"FanOut: {self.name} failed for {item_key}: {error.__class__.__name__}: {error}", exc_info=error)
+            if report.failed > MAX_LOGGED_ERRORS:
+                log.error(f"FanOut: {self.name} had {report.failed - MAX_LOGGED_ERRORS} more failure(s).")
+        else:
+            log.debug(f"FanOut: {report}")
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/gatewayprofile.py
+
+# What the gateway sends the bot, and what it costs.
+# With gateway_profile on, every gateway event is counted per event type and shard, with the time discord.py spent parsing it
+# (updating its caches and dispatching it to listeners), and which dispatched events and listeners each type fed. Admins can
+# see the top of it with /gateway, and it's in bot.metrics. Off, it costs nothing.
+# Event types in gateway_skip_events aren't parsed or dispatched at all. That's for traffic nothing in the bot uses
+# (presence updates and typing, say, when an intent is on for something else), and /gateway shows which types that is. A
+# skipped type is still counted when profiling. discord.py's caches aren't updated from a skipped type either, so only
+# skip what the bot doesn't read from its cache. Types the bot can't run without can't be skipped.
+# Both hook discord.py's table of parsers: each shard's websocket gets it as it connects, before it reads anything.
+
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from discord.ext import commands
+
+log = logging.getLogger("discord")
+
+# gateway_skip_events when the config file doesn't set it. The bot has no prefix commands, so commands.Bot's on_message
+# (process_commands for every message) would only burn CPU, and nothing else listens for messages. Dropping MESSAGE_CREATE
+# here means they're never parsed or dispatched at all. A config that adds prefix commands or an on_message listener has to
+# set gateway_skip_events without it.
+DEFAULT_SKIP = ("MESSAGE_CREATE",)
+
+# Without these the bot doesn't know what guilds it's in, can't resume, or can't answer commands.
+NEVER_SKIP = frozenset({"READY", "RESUMED", "GUILD_CREATE", "GUILD_DELETE", "GUILD_MEMBERS_CHUNK", "INTERACTION_CREATE"})
+
+# The events discord.py dispatches for some common gateway event types, to warn about skipping a type something listens to
+# before the profiler has seen any. The profiler learns the rest as they arrive.
+KNOWN_DISPATCHES = {
+    "PRESENCE_UPDATE": ("presence_update",),
+    "TYPING_START": ("typing", "raw_typing"),
+    "MESSAGE_CREATE": ("message",),
+    "MESSAGE_UPDATE": ("message_edit", "raw_message_edit"),
+    "MESSAGE_DELETE": ("message_delete", "raw_message_delete"),
+    "MESSAGE_REACTION_ADD": ("reaction_add", "raw_reaction_add"),
+    "MESSAGE_REACTION_REMOVE": ("reaction_remove", "raw_reaction_remove"),
+    "VOICE_STATE_UPDATE": ("voice_state_update",),
+    "GUILD_MEMBER_UPDATE": ("member_update", "raw_member_update"),
+    "GUILD_SCHEDULED_EVENT_CREATE": ("scheduled_event_create",),
+    "GUILD_SCHEDULED_EVENT_UPDATE": ("scheduled_event_update",),
+    "GUILD_SCHEDULED_EVENT_DELETE": ("scheduled_event_delete",),
+}
+
+
+def _skipped(data: Any) -> None:
+    pass
+
+
+class GatewayProfiler:
+    """Per event type and shard accounting of gateway events, and skipping the ones nothing uses."""
+
+    def __init__(self, bot, *, profile: bool = False, skip: Iterable[str] = ()) -> None:
+        self.bot = bot
+        self.profile = profile
+        skip = {event.upper() for event in skip}
+        for event in sorted(skip & NEVER_SKIP):
+            log.warning(f"Gateway: {event} can't be skipped. The bot needs it.")
+        self.skip: Set[str] = skip - NEVER_SKIP
+        # Gateway event type -> the events discord.py dispatched for it.
+        self.dispatches: Dict[str, Set[str]] = {event: set(names) for event, names in KNOWN_DISPATCHES.items()}
+        self._current: Optional[str] = None
+        self._installed = False
+
+        registry = bot.metrics.registry
+        self.events = registry.counter(
+            "discordbot_gateway_events_total", "Gateway events received, by shard and type.", ("shard", "event")
+        )
+        self.parse_time = registry.counter(
+            "discordbot_gateway_parse_seconds_total",
+            "Time spent parsing and dispatching gateway events, by shard and type.",
+            ("shard", "event"),
+        )
+
+    def install(self) -> None:
+        """Hook discord.py's parsers. Call it before the shards connect."""
+        if self._installed or not (self.profile or self.skip):
+            return
+        connection = self.bot._connection
+        parsers = connection.parsers
+        for event in sorted(self.skip):
+            if event in parsers:
+                parsers[event] = _skipped
+            else:
+                log.warning(f"Gateway: There's no gateway event type called {event} to skip.")
+        if self.profile:
+            # Each websocket gets its own copy of the parsers, so an event can be put down to its shard.
+            update_references = connection._update_references
+
+            def _update_references(ws) -> None:
+                update_references(ws)
+                ws._discord_parsers = self.parsers_for(ws.shard_id or 0)
+
+            connection._update_references = _update_references
+            dispatch = connection.dispatch
+
+            def _dispatch(event: str, *args, **kwargs) -> None:
+                if self._current is not None:
+                    self.dispatches.setdefault(self._current, set()).add(event)
+                dispatch(event, *args, **kwargs)
+
+            connection.dispatch = _dispatch
+        self._installed = True
+        if self.skip:
+            log.info(f"Gateway: Skipping {', '.join(sorted(self.skip))}.")
+
+    def check_skipped(self) -> None:
+        """Warn about skipped event types that something listens to after all. Cogs are loaded by now."""
+        for event in sorted(self.skip):
+            consumers = self.consumers(event)
+            if consumers:
+                log.warning(
+                    f"Gateway: {event} is skipped, but {', '.join(consumers)} listen(s) for it and won't hear anything."
+                )
+
+    def parsers_for(self, shard_id: int) -> Dict[str, Callable[[Any], None]]:
+        shard = str(shard_id)
+        return {event: self._timed(event, shard, parser) for event, parser in self.bot._connection.parsers.items()}
+
+    def _timed(self, event: str, shard: str, parser: Callable[[Any], None]) -> Callable[[Any], None]:
+        events = self.events
+        parse_time = self.parse_time
+        labels = (shard, event)
+        if parser is _skipped:
+            def skipped(data: Any) -> None:
+                events.values[labels] = events.values.get(labels, 0.0) + 1
+
+            return skipped
+
+        def parse(data: Any) -> None:
+            self._current = event
+            started = time.perf_counter()
+            try:
+                parser(data)
+            finally:
+                parse_time.values[labels] = parse_time.values.get(labels, 0.0) + time.perf_counter() - started
+                events.values[labels] = events.values.get(labels, 0.0) + 1
+                self._current = None
+
+        return parse
+
+    # Reports
+
+    def consumers(self, event: str) -> List[str]:
+        """The listeners (cog listeners, the bot's own on_ methods and wait_for calls) of what an event type dispatches."""
+        consumers = []
+        for name in sorted(self.dispatches.get(event, ())):
+            for listener in self.bot.extra_events.get(f"on_{name}", []):
+                consumers.append(getattr(listener, "__qualname__", repr(listener)))
+            method = getattr(type(self.bot), f"on_{name}", None)
+            # commands.Bot's own on_message is only for prefix commands, which the bot doesn't have. Overrides count.
+            if method is not None and method is not getattr(commands.Bot, f"on_{name}", None):
+                consumers.append(method.__qualname__)
+            if self.bot._listeners.get(name):
+                consumers.append(f"wait_for({name!r})")
+        return consumers
+
+    def totals(self) -> Dict[str, Tuple[float, float]]:
+        """Count and seconds per event type, over every shard."""
+        totals: Dict[str, List[float]] = {}
+        for (_, event), count in self.events.values.items():
+            totals.setdefault(event, [0.0, 0.0])[0] += count
+        for (_, event), seconds in self.parse_time.values.items():
+            totals.setdefault(event, [0.0, 0.0])[1] += seconds
+        return {event: (count, seconds) for event, (count, seconds) in totals.items()}
+
+    def report(self, top: int = 15) -> str:
+        if not self.profile:
+            return "Gateway profiling is off. Set gateway_profile = True in the config file to turn it on."
+        totals = sorted(self.totals().items(), key=lambda item: (item[1][1], item[1][0]), reverse=True)
+        if not totals:
+            return "No gateway events yet."
+        lines = [f"{'event':<30} {'count':>9} {'ms':>9} {'µs/ev':>7}  consumers"]
+        for event, (count, seconds) in totals[:top]:
+            if event in self.skip:
+                consumers = "(skipped)"
+            else:
+                consumers = ", ".join(self.consumers(event)) or "none"
+            lines.append(
+                f"{event[:30]:<30} {int(count):>9} {seconds * 1000:>9.1f} "
+                f"{seconds / count * 1e6 if count else 0:>7.1f}  {consumers}"
+            )
+        unused = [
+            event for event, _ in totals if event not in self.skip and event not in NEVER_SKIP and not self.consumers(event)
+        ]
+        if unused:
+            lines.append(f"Nothing listens to: {', '.join(unused[:10])}. Consider gateway_skip_events.")
+        return "\n".join(lines)
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/httpclient.py
+
+# The one HTTP client for everything the cogs fetch from outside Discord (discord.py has its own for Discord).
+# One pooled aiohttp session with keepalive and a DNS cache, and per host:
+#   - a limit on requests in flight and a timeout, from http_hosts in the config file;
+#   - retries with exponential backoff and jitter, for connection errors, timeouts, 429s and 5xx (honouring Retry-After),
+#     for idempotent methods only unless the caller says otherwise;
+#   - a circuit breaker: after CIRCUIT_FAILURES failures in a row, requests to the host fail at once with CircuitOpen
+#     for CIRCUIT_RESET seconds, then one request is let through to see if it's back;
+#   - latency and outcome metrics in bot.metrics.
+# Responses to GETs can be cached for a TTL (cache_ttl=) in a bounded LRU. Once an entry is stale, it's revalidated with its
+# ETag or Last-Modified, so an unchanged resource costs a 304 instead of a full download.
+# Nothing here knows about particular APIs, so it works just as well against a local stand-in server (see benchmarks/).
+# The bot has it as bot.http_client.
+
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from cogs.utils.search import LRUCache
+
+log = logging.getLogger("discord")
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Defaults for hosts that aren't in http_hosts.
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRIES = 2
+# Seconds. Doubled for every retry, with full jitter, and never more than BACKOFF_MAX (Retry-After included).
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET = 30.0
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """A request wasn't sent because its host has been failing."""
+
+    def __init__(self, host: str, retry_in: float) -> None:
+        super().__init__(f"{host} has been failing. Not trying again for {retry_in:.0f}s.")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class Response:
+    """A response, read in full, so it can be cached and the connection goes straight back to the pool."""
+
+    __slots__ = ("request_info", "status", "headers", "body", "from_cache")
+
+    def __init__(
+        self, request_info: aiohttp.RequestInfo, status: int, headers: CIMultiDictProxy, body: bytes, from_cache: bool = False
+    ) -> None:
+        self.request_info = request_info
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.from_cache = from_cache
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def url(self) -> URL:
+        return self.request_info.real_url
+
+    def text(self, encoding: str = "utf-8") -> str:
+        return self.body.decode(encoding, errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise aiohttp.ClientResponseError(
+                self.request_info, (), status=self.status, message=self.text()[:200], headers=self.headers
+            )
+
+
+class CircuitBreaker:
+    """Whether a host is worth sending requests to."""
+
+    __slots__ = ("state", "failures", "opened_at", "trial")
+
+    def __init__(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # Whether the one half-open trial request is out.
+        self.trial = False
+
+    def before(self, host: str, now: float) -> bool:
+        """Raise CircuitOpen if a request shouldn't be sent. True if the request is the half-open trial."""
+        if self.state == OPEN:
+            if now - self.opened_at < CIRCUIT_RESET:
+                raise CircuitOpen(host, CIRCUIT_RESET - (now - self.opened_at))
+            self.state = HALF_OPEN
+            self.trial = False
+        if self.state == HALF_OPEN:
+            if self.trial:
+                raise CircuitOpen(host, 0.0)
+            self.trial = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.trial = False
+
+    def response(self, host: str, now: float, status: int) -> None:
+        # A 429 means the host is fine, just busy. Only the 5xx worth retrying count against the circuit.
+        if status >= 500 and status in RETRY_STATUSES:
+            self.failure(host, now)
+        else:
+            self.success()
+
+    def abandoned(self) -> None:
+        """The trial request never finished (it was cancelled, say), so the next request gets to be the trial."""
+        self.trial = False
+
+    def failure(self, host: str, now: float) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.state == HALF_OPEN or self.failures >= CIRCUIT_FAILURES:
+            if self.state != OPEN:
+                log.warning(f"HTTP: {host} failed {self.failures} time(s) in a row. Failing fast for {CIRCUIT_RESET:.0f}s.")
+            self.state = OPEN
+            self.opened_at = now
+
+
+class Host:
+    """Limits and state for one host."""
+
+    __slots__ = ("name", "semaphore", "timeout", "retries", "circuit")
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        timeout: float = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+    ) -> None:
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=min(timeout, 5.0))
+        self.retries = retries
+        self.circuit = CircuitBreaker()
+
+
+class _CacheEntry:
+    __slots__ = ("response", "expires", "etag", "last_modified")
+
+    def __init__(self, response: Response, expires: float) -> None:
+        self.response = response
+        self.expires = expires
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+
+class HTTPClient:
+    """Pooled HTTP client with per-host limits, retries, circuit breakers and a response cache."""
+
+    def __init__(
+        self,
+        bot,
+        *,
+        hosts: Optional[Mapping[str, Mapping[str, Any]]] = None,
+        cache_size: int = 512,
+        user_agent: str = "DiscordBot",
+    ) -> None:
+        self.bot = bot
+        # Per-host settings from the config file: {"api.thecatapi.com": {"concurrency": 4, "timeout": 10, "retries": 2}}
+        self.host_settings: Dict[str, Mapping[str, Any]] = dict(hosts or {})
+        self.hosts: Dict[str, Host] = {}
+        self.cache = LRUCache(maxsize=cache_size)
+        self.user_agent = user_agent
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        registry = bot.metrics.registry
+        self.latency = registry.histogram(
+            "discordbot_http_request_seconds", "Outbound HTTP request duration per attempt, by host.", ("host",)
+        )
+        self.requests = registry.counter(
+            "discordbot_http_requests_total", "Outbound HTTP requests by host and outcome.", ("host", "outcome")
+        )
+        registry.gauge("discordbot_http_circuit_state", "Circuit breaker per host: 0 closed, 1 half open, 2 open.", ("host",),
+                       callback=lambda: {(name,): CIRCUIT_STATES[host.circuit.state] for name, host in self.hosts.items()})
+
+    async def start(self) -> None:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                # The per-host limits are enforced by Host.semaphore, so requests wait there, where they're counted.
+                limit_per_host=0,
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": self.user_agent})
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def host(self, name: str) -> Host:
+        if name not in self.hosts:
+            self.hosts[name] = Host(name, **self.host_settings.get(name, {}))
+        return self.hosts[name]
+
+    # What the cogs call.
+
+    async def get_json(self, url: str, **kwargs) -> Any:
+        """GET a URL and return its JSON. Raises aiohttp.ClientResponseError for an error status."""
+        response = await self.request("GET", url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[Mapping[str, str]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        cache_ttl: Optional[float] = None,
+        retry: Optional[bool] = None,
+        **kwargs,
+    ) -> Response:
+        """Send a request and read the whole response.
+
+        cache_ttl caches a successful GET for that many seconds. retry defaults to retrying idempotent methods only.
+        Raises CircuitOpen if the host has been failing, and whatever aiohttp raised if every attempt failed.
+        """
+        if self.session is None:
+            raise RuntimeError("The HTTP client isn't started.")
+        method = method.upper()
+        target = URL(url)
+        if params:
+            target = target.update_query(params)
+        host = self.host(target.host or "")
+        request_headers = CIMultiDict(headers or {})
+
+        key: Optional[Tuple[str, Tuple[Tuple[str, str], ...]]] = None
+        entry: Optional[_CacheEntry] = None
+        if cache_ttl and method == "GET":
+            key = (str(target), tuple(sorted((name.lower(), value) for name, value in request_headers.items())))
+            entry = self.cache.get(key)
+            if entry is not None:
+                if time.monotonic() < entry.expires:
+                    self.requests.inc(host.name, "cache_hit")
+                    return Response(
+                        entry.response.request_info,
+                        entry.response.status,
+                        entry.response.headers,
+                        entry.response.body,
+                        from_cache=True,
+                    )
+                if entry.etag:
+                    request_headers["If-None-Match"] = entry.etag
+                if entry.last_modified:
+                    request_headers["If-Modified-Since"] = entry.last_modified
+
+        response = await self._send(
+            host, method, target, request_headers, method in IDEMPOTENT_METHODS if retry is None else retry, **kwargs
+        )
+
+        if key is not None:
+            return self._cache_response(key, entry, response, cache_ttl)
+        return response
+
+    def _cache_response(
+        self, key: Tuple[str, Tuple[Tuple[str, str], ...]], entry: Optional[_CacheEntry], response: Response, cache_ttl: float
+    ) -> Response:
+        """Cache a GET's response, or renew the cached one if the host said it hasn't changed."""
+        if response.status == 304 and entry is not None:
+            entry.expires = time.monotonic() + cache_ttl
+            self.cache.put(key, entry)
+            return Response(
+                entry.response.request_info,
+                entry.response.status,
+                entry.response.headers,
+                entry.response.body,
+                from_cache=True,
+            )
+        if response.ok and "no-store" not in response.headers.get("Cache-Control", ""):
+            self.cache.put(key, _CacheEntry(response, time.monotonic() + cache_ttl))
+        return response
+
+    # Retries and the circuit breaker.
+
+    async def _send(self, host: Host, method: str, target: URL, headers: CIMultiDict, retry: bool, **kwargs) -> Response:
+        attempts = 1 + (host.retries if retry else 0)
+        attempt = 0
+        while True:
+            trial = host.circuit.before(host.name, time.monotonic())
+            delay: Optional[float] = None
+            started = time.perf_counter()
+            try:
+                async with host.semaphore:
+                    started = time.perf_counter()
+                    async with self.session.request(method, target, headers=headers, timeout=host.timeout, **kwargs) as raw:
+                        response = Response(raw.request_info, raw.status, raw.headers, await raw.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.latency.observe(time.perf_counter() - started, host.name)
+                self.requests.inc(host.name, "timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+                host.circuit.failure(host.name, time.monotonic())
+                if attempt == attempts - 1:
+                    raise
+                log.debug(f"HTTP: {method} {target.host}{target.path} failed ({e.__class__.__name__}: {e}). Retrying.")
+            except BaseException:
+                # Cancelled (by a wait_for, an interaction timing out or a cog unloading) or failed some other way. Without
+                # this, a trial that never finished would keep the circuit half open, failing every request, until a restart.
+                if trial:
+                    host.circuit.abandoned()
+                raise
+            else:
+                self.latency.observe(time.perf_counter() - started, host.name)
+                self.requests.inc(host.name, f"{response.status // 100}xx")
+                host.circuit.response(host.name, time.monotonic(), response.status)
+                if response.status not in RETRY_STATUSES or attempt == attempts - 1:
+                    return response
+                delay = _retry_after(response)
+                log.debug(f"HTTP: {method} {target.host}{target.path} returned {response.status}. Retrying.")
+            if delay is None:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _retry_after(response: Response) -> Optional[float]:
+    """How long a 429 or 503 asked to wait, if it said."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return min(float(retry_after), BACKOFF_MAX)
+    except ValueError:
+        return None
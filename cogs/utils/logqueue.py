@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/logqueue.py
+
+# Queue-based logging, so a log call never does file I/O on the event loop.
+# Records go into a bounded queue. A background thread takes them off in batches, formats them, writes each batch with one
+# write per handler and takes care of rotating (and optionally gzipping) the log files. If the queue is full, records are
+# dropped and counted instead of blocking whoever logged them, so a burst of logging can't stall the shards' heartbeats.
+
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import QueueHandler, RotatingFileHandler
+from typing import Any, Dict, List, Optional
+
+DROP_POLICIES = ("drop_new", "drop_oldest")
+
+# Extra record attributes the JSON formatter writes out, when a log call sets them with extra=.
+EXTRA_FIELDS = ("command", "guild", "user", "shard")
+
+
+class BoundedQueueHandler(QueueHandler):
+    """A QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+
+    def __init__(self, maxsize: int = 10000, drop_policy: str = "drop_new") -> None:
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {DROP_POLICIES}, not {drop_policy!r}.")
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.drop_policy = drop_policy
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The writer thread is in the same process, so there's no need to format (and pickle-proof) the record here.
+        # Formatting is the expensive part, and it happens in the writer thread instead.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.drop_policy == "drop_oldest":
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(record)
+                except (queue.Empty, queue.Full):
+                    pass
+            self.dropped += 1
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """A RotatingFileHandler that can write a whole batch of records at once, and can gzip rotated files."""
+
+    def __init__(self, filename: str, *, compress: bool = False, **kwargs) -> None:
+        super().__init__(filename, **kwargs)
+        if compress:
+            self.namer = _gzip_namer
+            self.rotator = _gzip_rotator
+
+    def emit_batch(self, records: List[logging.LogRecord]) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + self.terminator)
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        data = "".join(lines)
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() + len(data) >= self.maxBytes and self.stream.tell() > 0:
+                self.doRollover()
+            self.stream.write(data)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+
+
+def _gzip_namer(name: str) -> str:
+    return f"{name}.gz"
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+class BatchWriter(threading.Thread):
+    """Takes records off the queue in batches and hands them to the real handlers."""
+
+    def __init__(
+        self,
+        queue_handler: BoundedQueueHandler,
+        handlers: List[logging.Handler],
+        *,
+        batch_size: int = 500,
+        flush_interval: float = 0.5,
+    ) -> None:
+        super().__init__(name="log writer", daemon=True)
+        self.queue = queue_handler.queue
+        self.queue_handler = queue_handler
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._reported_drops = 0
+
+    def run(self) -> None:
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            self._report_drops()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop_event.set()
+        self.join(timeout)
+
+    def _next_batch(self) -> List[logging.LogRecord]:
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[logging.LogRecord]) -> None:
+        for handler in self.handlers:
+            records = [record for record in batch if record.levelno >= handler.level and handler.filter(record)]
+            if not records:
+                continue
+            if isinstance(handler, BatchRotatingFileHandler):
+                with handler.lock:
+                    handler.emit_batch(records)
+            else:
+                for record in records:
+                    handler.handle(record)
+
+    def _report_drops(self) -> None:
+        dropped = self.queue_handler.dropped
+        if dropped > self._reported_drops:
+            record = logging.LogRecord(
+                "discord", logging.WARNING, __file__, 0,
+                "Logging: Dropped %d log record(s) because the log queue was full (%d in total).",
+                (dropped - self._reported_drops, dropped), None,
+            )
+            self._reported_drops = dropped
+            self._write([record])
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line. The command/guild/user/shard fields are only turned into text here, in the writer thread."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = _describe(value)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _describe(value: Any) -> Any:
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    name = getattr(value, "name", None)
+    object_id = getattr(value, "id", None)
+    if name is not None and object_id is not None:
+        return {"name": str(name), "id": object_id}
+    if name is not None:
+        return str(name)
+    return str(value)
+
+
+class Actor:
+    """'<user> in <guild>' for an interaction, only worked out if the record is actually written."""
+
+    __slots__ = ("interaction",)
+
+    def __init__(self, interaction) -> None:
+        self.interaction = interaction
+
+    def __str__(self) -> str:
+        user = getattr(self.interaction, "user", None)
+        guild = getattr(self.interaction, "guild", None)
+        user_name = getattr(user, "name", None) or getattr(user, "display_name", "unknown")
+        return f"{user_name} in {getattr(guild, 'name', 'unknown')}"
+
+
+def interaction_extra(interaction) -> Dict[str, Any]:
+    """extra= for a log call about an interaction. The objects are passed as-is and only described by the formatter."""
+    guild = getattr(interaction, "guild", None)
+    return {
+        "command": getattr(interaction, "command", None),
+        "guild": guild,
+        "user": getattr(interaction, "user", None),
+        "shard": getattr(guild, "shard_id", None),
+    }
+
+
+def get_queue_handler() -> Optional[BoundedQueueHandler]:
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            return handler
+    return None
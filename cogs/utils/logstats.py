@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/logstats.py
+
+# Reads the bot's log files back for `launcher.py logstats`: which commands were used and how often they failed, in
+# which guilds, and how often the event loop stalled or the shards reconnected, over a time window.
+# The files are the ones setup_logging writes (logs/DiscordBot.log, -supervisor and -clusterN, each with up to 5 rotated files,
+# gzipped or not, text or log_json). They're read newest to oldest, a line at a time, so memory doesn't grow with the logs:
+# what's kept is a counter per command, guild, cog, shard and hour. A file last written before the window is skipped without
+# opening it, and an uncompressed file is bisected to the start of the window instead of read from the top.
+# Only lines with a timestamp are looked at. Tracebacks and stacks under a record are skipped.
+# The cogs log free-form messages, so the patterns below follow what each of them writes. Anything else is only counted
+# by level.
+
+import collections
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+from typing import IO, Any, Dict, List, Optional
+
+# Rotated files keep their modification time, so the newest is the one written last.
+LOG_PATTERNS = ("DiscordBot*.log", "DiscordBot*.log.[0-9]", "DiscordBot*.log.[0-9].gz")
+
+STAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+JSON_PREFIX = b'{"time": "'
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+OK, ERROR, REFUSED = "ok", "error", "refused"
+# Some commands don't log where they were used.
+UNKNOWN_GUILD = "(not logged)"
+
+# Command records, by the first word of the message. Each pattern has a command group, and a guild group where the
+# message says.
+_ANNOUNCE = re.compile(
+    rb"used /(?P<command>\w+)"
+    rb"(?:(?P<ok> successfully)| in (?P<guild>.+) but the server has not been configured| but it (?P<error>failed))"
+)
+_PING_ROLE = re.compile(
+    rb"(?:(?P<ok>used)|attempted to use) (?P<command>\w+) in guild (?P<guild>\d+)"
+    rb"(?P<error> but the bot got a permission error)?"
+)
+_COMMAND_IN = re.compile(
+    rb"Command (?P<command>\w+) (?:was )?"
+    rb"(?:(?P<ok>executed successfully)|(?P<error>failed|had no cat to show)) in (?P<guild>.+)\.$"
+)
+_SIMPLE_COMMAND = re.compile(rb"(?P<command>\w+) command (?:(?P<ok>ran successfully)|(?P<error>failed))")
+_NOT_ALLOWED = re.compile(rb"tried to use (?P<command>\w+)(?: in (?P<guild>.+?))?, but")
+_UNHANDLED = re.compile(rb"Ignoring exception in command '(?P<command>[\w ]+)'")
+# Admin commands say what they did, and who did it where: "... (user in guild)".
+_ADMIN = re.compile(
+    rb"(?:Cog \S+ (?P<load>\*\*loaded\*\*|unloaded|reloaded|loaded) successfully"
+    rb"|Changed cogs (?P<reload_all>reloaded)|(?P<stop>Cluster|Bot) stopped"
+    rb"|(?P<resync>Resync) successful|(?P<clear>clear_commands) has been called"
+    rb"|Tried to (?P<tried>load|unload|reload|stop|resync|clear|unload all)\b)"
+    rb".*?\((?P<actor>[^()]*) in (?P<guild>[^()]*)\)"
+)
+_ADMIN_COMMANDS = {
+    b"**loaded**": "load",
+    b"loaded": "reload",
+    b"unloaded": "unload",
+    b"reloaded": "reload",
+    b"load": "load",
+    b"unload": "unload",
+    b"reload": "reload",
+    b"stop": "stop",
+    b"resync": "resync",
+    b"clear": "clear_commands",
+    b"unload all": "reload_all",
+}
+
+_STALL = re.compile(rb"blocked for (?P<seconds>[\d.]+)s(?: so far)? in (?:cog (?P<cog>[^,\s]+))?")
+_SHARD = re.compile(rb"[Ss]hard (?:ID )?(?P<shard>\d+)")
+_CLUSTER = re.compile(rb"Cluster (?P<cluster>\d+) exited")
+_DROPPED = re.compile(rb"Dropped (?P<count>\d+) log record")
+_SOURCE = re.compile(rb"^(\w+): ")
+
+
+class LogStats:
+    """What the log records in a time window add up to."""
+
+    def __init__(self, since: Optional[str] = None, until: Optional[str] = None) -> None:
+        self.since = since
+        self.until = until
+        self.files: List[str] = []
+        self.bytes = 0
+        self.records = 0
+        self.first: Optional[bytes] = None
+        self.last: Optional[bytes] = None
+        self.levels: collections.Counter = collections.Counter()
+        # Where the warnings and errors came from: the "Announce: " the cogs start their messages with, or the logger.
+        self.problems: collections.Counter = collections.Counter()
+        # command -> outcome -> count, guild -> outcome -> count.
+        self.commands: Dict[str, collections.Counter] = {}
+        self.guilds: Dict[str, collections.Counter] = {}
+        # "YYYY-MM-DD HH" -> [commands, command errors, warnings and errors]
+        self.hours: Dict[bytes, List[int]] = {}
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.longest_stall = 0.0
+        self.stalls_by_cog: collections.Counter = collections.Counter()
+        self.gateway: collections.Counter = collections.Counter()
+        self.reconnects_by_shard: collections.Counter = collections.Counter()
+        self.cluster_restarts: collections.Counter = collections.Counter()
+        self.dropped_records = 0
+        # INFO lines read() has counted, but not added to levels yet.
+        self._info = 0
+
+    # Reading
+
+    def add(self, stamp: bytes, level: bytes, logger: bytes, message: bytes, fields: Optional[Dict[str, Any]] = None) -> None:
+        """Count one record. stamp is "YYYY-MM-DD HH:MM:SS", the rest as it was logged."""
+        self.records += 1
+        if self.first is None or stamp < self.first:
+            self.first = stamp
+        if self.last is None or stamp > self.last:
+            self.last = stamp
+        self.levels[level] += 1
+        space = message.find(b" ")
+        self._classify(stamp, level, logger, message, fields, _HANDLERS.get(message[:space] if space > 0 else message))
+
+    def _classify(
+        self, stamp: bytes, level: bytes, logger: bytes, message: bytes, fields: Optional[Dict[str, Any]], handler
+    ) -> None:
+        hour = self.hours.get(stamp[:13])
+        if hour is None:
+            hour = self.hours[stamp[:13]] = [0, 0, 0]
+        if level != b"INFO" and level != b"DEBUG":
+            hour[2] += 1
+            source = _SOURCE.match(message)
+            self.problems[source.group(1) if source else logger] += 1
+        if handler is None and level == b"ERROR" and b" tried to use " in message:
+            # The admin checks start with the user's name.
+            handler = _not_allowed
+        if handler is not None:
+            handler(self, message, level, fields, hour)
+        elif fields is not None and fields.get("command"):
+            # A log_json record about a command that doesn't match anything above.
+            self.command(str(fields["command"]), ERROR if level in (b"ERROR", b"CRITICAL") else OK, None, fields, hour)
+
+    def command(
+        self, name: str, outcome: str, guild: Optional[str], fields: Optional[Dict[str, Any]], hour: List[int]
+    ) -> None:
+        if fields is not None and fields.get("guild") is not None:
+            # log_json records say which guild even when the message doesn't.
+            guild = fields["guild"]["name"] if isinstance(fields["guild"], dict) else str(fields["guild"])
+        counts = self.commands.get(name)
+        if counts is None:
+            counts = self.commands[name] = collections.Counter()
+        counts[outcome] += 1
+        guild = guild or UNKNOWN_GUILD
+        counts = self.guilds.get(guild)
+        if counts is None:
+            counts = self.guilds[guild] = collections.Counter()
+        counts[outcome] += 1
+        hour[0] += 1
+        if outcome == ERROR:
+            hour[1] += 1
+
+    def _match(
+        self, pattern: re.Pattern, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]
+    ) -> None:
+        match = pattern.search(message)
+        if match is None:
+            return
+        groups = match.groupdict()
+        # Whatever a command's message doesn't call a success or a failure (not configured, not allowed, ...) was refused.
+        outcome = ERROR if groups.get("error") or pattern is _UNHANDLED else OK if groups.get("ok") else REFUSED
+        guild = groups.get("guild")
+        self.command(
+            groups["command"].decode().lower(), outcome, guild.decode(errors="replace") if guild else None, fields, hour
+        )
+
+    def _admin(self, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        match = _ADMIN.search(message)
+        if match is None:
+            return
+        if match.group("tried"):
+            name, outcome = _ADMIN_COMMANDS[match.group("tried")], ERROR
+        elif match.group("load"):
+            name, outcome = _ADMIN_COMMANDS[match.group("load")], OK
+        else:
+            name = (
+                "reload_all"
+                if match.group("reload_all")
+                else "stop" if match.group("stop") else "resync" if match.group("resync") else "clear_commands"
+            )
+            outcome = OK
+        self.command(name, outcome, match.group("guild").decode(errors="replace"), fields, hour)
+
+    def _resync_failed(self, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        if message.startswith(b"Resync failed"):
+            self.command("resync", ERROR, None, fields, hour)
+        else:
+            self._admin(message, level, fields, hour)
+
+    def _cluster(self, message: bytes) -> None:
+        match = _CLUSTER.search(message)
+        if match is not None:
+            self.cluster_restarts[match.group("cluster").decode()] += 1
+        elif b"Lost the connection to the supervisor" in message or b"supervisor went away" in message:
+            self.gateway["supervisor lost"] += 1
+
+    def _watchdog(self, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        if not message.startswith(b"Watchdog: The event loop is blocked."):
+            return
+        self.stalls += 1
+        match = _STALL.search(message)
+        if match is not None:
+            seconds = float(match.group("seconds"))
+            self.stalled_seconds += seconds
+            self.longest_stall = max(self.longest_stall, seconds)
+            self.stalls_by_cog[(match.group("cog") or b"none").decode(errors="replace")] += 1
+
+    def _gateway(self, kind: str, message: bytes) -> None:
+        self.gateway[kind] += 1
+        if kind in ("reconnect", "resumed", "invalidated", "zombie"):
+            match = _SHARD.search(message)
+            if match is not None:
+                self.reconnects_by_shard[int(match.group("shard"))] += 1
+
+    def _shard(self, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        if b"has connected to Gateway" in message:
+            self.gateway["identify"] += 1
+        elif b"successfully RESUMED" in message:
+            self._gateway("resumed", message)
+        elif b"session has been invalidated" in message:
+            self._gateway("invalidated", message)
+        elif b"stopped responding to the gateway" in message:
+            self._gateway("zombie", message)
+
+    def _other(self, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        if message.startswith(b"Attempting a reconnect"):
+            self._gateway("reconnect", message)
+        elif message.startswith(b"Can't keep up"):
+            self._gateway("heartbeat behind", message)
+        elif message.startswith(b"We are being rate limited") or message.startswith(b"WebSocket in shard"):
+            self.gateway["rate limited"] += 1
+        elif message.startswith(b"Global rate limit"):
+            self.gateway["global rate limit"] += 1
+        elif message.startswith(b"Logging: Dropped"):
+            match = _DROPPED.search(message)
+            if match is not None:
+                self.dropped_records += int(match.group("count"))
+
+    def read(self, path: str) -> None:
+        """Count the records of one log file that are in the window."""
+        self.files.append(path)
+        since = self.since.encode() if self.since else b""
+        until = self.until.encode() if self.until else b"~"
+        first = last = None
+        text_line = self._text_line
+        with open_log(path) as file:
+            if since and not path.endswith(".gz"):
+                _seek(file, since)
+            start = file.tell()
+            for line in file:
+                if line[:1] == b"[" and line[20:22] == b"] ":
+                    stamp = line[1:20]
+                elif line[:10] == JSON_PREFIX:
+                    stamp = line[10:29].replace(b"T", b" ")
+                else:
+                    continue
+                if stamp < since:
+                    continue
+                if stamp > until:
+                    break
+                if first is None:
+                    first = stamp
+                last = stamp
+                if line[:1] == b"[":
+                    text_line(stamp, line)
+                else:
+                    self._json_line(stamp, line)
+            self.bytes += os.path.getsize(path) if path.endswith(".gz") else file.tell() - start
+        self.levels[b"INFO"] += self._info
+        self._info = 0
+        if first is not None:
+            self.first = first if self.first is None else min(self.first, first)
+            self.last = last if self.last is None else max(self.last, last)
+
+    def _text_line(self, stamp: bytes, line: bytes) -> None:
+        colon = line.find(b": ", 32)
+        if colon < 0:
+            return
+        self.records += 1
+        message = line[colon + 2:]
+        handler = _HANDLERS.get(message[:message.find(b" ")])
+        if line[22:31] == b"[INFO   ]":
+            # Most records are INFO lines nothing here is looking for. They're only counted, without going through _classify().
+            self._info += 1
+            if handler is None:
+                return
+            level = b"INFO"
+            name = 32
+        else:
+            close = line.find(b"]", 23)
+            level = line[23:close].rstrip()
+            name = close + 2
+            self.levels[level] += 1
+        self._classify(stamp, level, line[name:colon], message.rstrip(b"\r\n"), None, handler)
+
+    def _json_line(self, stamp: bytes, line: bytes) -> None:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return
+        self.add(
+            stamp, data.get("level", "INFO").encode(), data.get("logger", "").encode(), data.get("message", "").encode(), data
+        )
+
+    # Reports
+
+    def to_dict(self) -> Dict[str, Any]:
+        commands = {name: _outcomes(counts) for name, counts in self.commands.items()}
+        guilds = {name: _outcomes(counts) for name, counts in self.guilds.items()}
+        return {
+            "window": {"since": self.since, "until": self.until},
+            "files": self.files,
+            "bytes": self.bytes,
+            "records": self.records,
+            "first": self.first.decode() if self.first else None,
+            "last": self.last.decode() if self.last else None,
+            "levels": {level.decode(): count for level, count in self.levels.items()},
+            "problems": {source.decode(errors="replace"): count for source, count in self.problems.most_common()},
+            "commands": dict(sorted(commands.items(), key=lambda item: -item[1]["total"])),
+            "guilds": dict(sorted(guilds.items(), key=lambda item: -item[1]["total"])),
+            "hours": {
+                hour.decode() + ":00": {"commands": counts[0], "errors": counts[1], "problems": counts[2]}
+                for hour, counts in sorted(self.hours.items())
+            },
+            "stalls": {
+                "count": self.stalls,
+                "seconds": round(self.stalled_seconds, 2),
+                "longest": self.longest_stall,
+                "by_cog": dict(self.stalls_by_cog.most_common()),
+            },
+            "gateway": dict(self.gateway.most_common()),
+            "reconnects_by_shard": {str(shard): count for shard, count in sorted(self.reconnects_by_shard.items())},
+            "cluster_restarts": dict(sorted(self.cluster_restarts.items())),
+            "dropped_records": self.dropped_records,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def table(self, top: int = 10) -> str:
+        data = self.to_dict()
+        window = f"{self.since or 'the start'} to {self.until or 'now'}"
+        lines = [f"{self.records} records from {len(self.files)} file(s) ({self.bytes / 1024 / 1024:.1f} MiB), {window}."]
+        if self.first:
+            lines.append(f"First record {data['first']}, last {data['last']}.")
+        lines.append("Levels: " + (", ".join(f"{level} {count}" for level, count in sorted(data["levels"].items())) or "none"))
+
+        for title, rows in (("command", data["commands"]), ("guild", data["guilds"])):
+            lines.append("")
+            lines.extend(_outcome_rows(title, rows, top))
+
+        if data["problems"]:
+            lines.append("")
+            lines.append(
+                "Warnings and errors by source: "
+                + ", ".join(f"{source} {count}" for source, count in list(data["problems"].items())[:top])
+            )
+        lines.append("")
+        stalls = data["stalls"]
+        lines.append(
+            f"Event loop stalls: {stalls['count']}, {stalls['seconds']:.2f}s in total, longest {stalls['longest']:.2f}s."
+        )
+        if stalls["by_cog"]:
+            lines.append("  by cog: " + ", ".join(f"{cog} {count}" for cog, count in list(stalls["by_cog"].items())[:top]))
+        lines.append(
+            "Gateway: " + (", ".join(f"{kind} {count}" for kind, count in data["gateway"].items()) or "nothing to report")
+        )
+        if data["reconnects_by_shard"]:
+            busiest = sorted(data["reconnects_by_shard"].items(), key=lambda item: -item[1])[:top]
+            lines.append(
+                "  reconnects, resumes and invalidations by shard: "
+                + ", ".join(f"{shard} {count}" for shard, count in busiest)
+            )
+        if data["cluster_restarts"]:
+            lines.append(
+                "Cluster restarts: "
+                + ", ".join(f"cluster {cluster} {count}" for cluster, count in data["cluster_restarts"].items())
+            )
+        if data["dropped_records"]:
+            lines.append(f"Log records dropped by a full queue: {data['dropped_records']}")
+        return "\n".join(lines)
+
+
+def _outcomes(counts: collections.Counter) -> Dict[str, Any]:
+    total = sum(counts.values())
+    return {
+        "total": total,
+        OK: counts[OK],
+        REFUSED: counts[REFUSED],
+        ERROR: counts[ERROR],
+        "error_rate": round(counts[ERROR] / total, 4) if total else 0.0,
+    }
+
+
+def _outcome_rows(title: str, rows: Dict[str, Dict[str, Any]], top: int) -> List[str]:
+    lines = [f"{title:<30} {'total':>7} {'ok':>7} {'refused':>7} {'error':>7} {'errors':>7}"]
+    for name, counts in list(rows.items())[:top]:
+        lines.append(
+            f"{name[:30]:<30} {counts['total']:>7} {counts[OK]:>7} {counts[REFUSED]:>7} {counts[ERROR]:>7} "
+            f"{counts['error_rate'] * 100:>6.1f}%"
+        )
+    if len(rows) > top:
+        lines.append(f"... and {len(rows) - top} more")
+    if not rows:
+        lines.append("none")
+    return lines
+
+
+def _handler(pattern: re.Pattern):
+    def handle(self: LogStats, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+        self._match(pattern, message, level, fields, hour)
+
+    return handle
+
+
+def _cluster(self: LogStats, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+    self._cluster(message)
+
+
+def _events(self: LogStats, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+    if message.startswith(b"Events: Shard ID") and b"reconnected" in message:
+        self.gateway["events resync"] += 1
+
+
+def _not_allowed(self: LogStats, message: bytes, level: bytes, fields: Optional[Dict[str, Any]], hour: List[int]) -> None:
+    # "User x tried to use y, but is not the bot owner." and "x tried to use y in z, but ...": the admin checks.
+    if b" tried to use " in message:
+        self._match(_NOT_ALLOWED, message, level, fields, hour)
+    else:
+        self._match(_PING_ROLE, message, level, fields, hour)
+
+
+# The first word of a message -> what it's about.
+_HANDLERS = {
+    b"Announce:": _handler(_ANNOUNCE),
+    b"User": _not_allowed,
+    b"CatAPI:": _handler(_COMMAND_IN),
+    b"Test:": _handler(_COMMAND_IN),
+    b"Uptime": _handler(_SIMPLE_COMMAND),
+    b"whattimeisit": _handler(_SIMPLE_COMMAND),
+    b"Ignoring": _handler(_UNHANDLED),
+    b"Cog": LogStats._admin,
+    b"Tried": LogStats._admin,
+    b"Changed": LogStats._admin,
+    b"Bot": LogStats._admin,
+    b"Resync": LogStats._resync_failed,
+    b"clear_commands": LogStats._admin,
+    b"Cluster": LogStats._admin,
+    b"Cluster:": _cluster,
+    b"Watchdog:": LogStats._watchdog,
+    b"Shard": LogStats._shard,
+    b"Events:": _events,
+    b"Attempting": LogStats._other,
+    b"Can't": LogStats._other,
+    b"We": LogStats._other,
+    b"WebSocket": LogStats._other,
+    b"Global": LogStats._other,
+    b"Logging:": LogStats._other,
+}
+
+
+def parse_time(value: str, now: Optional[datetime.datetime] = None) -> str:
+    """A window bound as "YYYY-MM-DD HH:MM:SS" local time, from a date/time or an age like 30m, 24h or 7d."""
+    value = value.strip()
+    if value[:-1].isdigit() and value[-1:].lower() in WINDOW_UNITS:
+        now = now or datetime.datetime.now()
+        return (now - datetime.timedelta(seconds=int(value[:-1]) * WINDOW_UNITS[value[-1].lower()])).strftime(STAMP_FORMAT)
+    try:
+        return datetime.datetime.fromisoformat(value).strftime(STAMP_FORMAT)
+    except ValueError:
+        raise ValueError(f"{value!r} isn't a date, a time or an age like 30m, 24h or 7d.") from None
+
+
+def log_files(directory: str = "logs") -> List[str]:
+    """The log files in a directory, newest first."""
+    paths = {path for pattern in LOG_PATTERNS for path in glob.glob(os.path.join(directory, pattern))}
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), -_rotation(path)), reverse=True)
+
+
+def _rotation(path: str) -> int:
+    # "DiscordBot.log.3.gz" -> 3. Breaks ties between files rotated in the same second.
+    suffix = path.rsplit(".log", 1)[-1].strip(".").split(".", 1)[0]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def open_log(path: str) -> IO[bytes]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb", buffering=1024 * 1024)
+
+
+def _stamp(file: IO[bytes]) -> Optional[bytes]:
+    """The timestamp of the next record from the current position, skipping lines without one."""
+    for _ in range(64):
+        line = file.readline()
+        if not line:
+            return None
+        if line[:1] == b"[" and line[20:22] == b"] ":
+            return line[1:20]
+        if line[:10] == JSON_PREFIX:
+            return line[10:29].replace(b"T", b" ")
+    return None
+
+
+def _seek(file: IO[bytes], since: bytes) -> None:
+    """Move to the start of a line at most one record before the first one at or after since. Lines are in time order."""
+    size = file.seek(0, os.SEEK_END)
+    low, high = 0, size
+    while high - low > 64 * 1024:
+        middle = (low + high) // 2
+        file.seek(middle)
+        file.readline()
+        stamp = _stamp(file)
+        if stamp is None or stamp >= since:
+            high = middle
+        else:
+            low = middle
+    file.seek(low)
+    if low:
+        # Partway into a line. The loop skips to the next whole one.
+        file.readline()
+
+
+def scan(directory: str = "logs", since: Optional[str] = None, until: Optional[str] = None) -> LogStats:
+    """Read every log file in a directory, newest first, for the records between since and until."""
+    stats = LogStats(since, until)
+    oldest = datetime.datetime.strptime(since, STAMP_FORMAT).timestamp() if since else None
+    for path in log_files(directory):
+        if oldest is not None and os.path.getmtime(path) < oldest:
+            # Last written before the window started. The rest are older still, but other process's files may not be.
+            continue
+        stats.read(path)
+    return stats
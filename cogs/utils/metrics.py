@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/metrics.py
+
+# In-process metrics: counters, gauges and histograms that cost a dict lookup and an addition to update, rendered in the
+# Prometheus text format only when something asks for them.
+# BotMetrics hooks them up to the bot: app command latency (from when the command tree got the interaction to when the first
+# response was sent), successes and errors, shard latency and reconnects, REST calls and 429s, and event loop lag.
+# Only discord.py's public hooks are used: the command tree's interaction_check and on_error, the on_app_command_completion
+# event, and the aiohttp trace of the bot's HTTP session (http_trace) for every REST request, interaction responses included.
+# If metrics_port is set in the config file, they're served on http://<metrics_host>:<metrics_port>/metrics for Prometheus.
+# The bot has it as bot.metrics.
+
+import asyncio
+import bisect
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+import discord
+from discord import app_commands
+
+log = logging.getLogger("discord")
+
+# Seconds. Discord gives an interaction 3 seconds for its first response.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 2.5, 3.0, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+# Interactions that never got a response are forgotten after this long.
+PENDING_TTL = 15 * 60
+
+Labels = Tuple[str, ...]
+
+# REST routes are labelled with their IDs and webhook tokens left out, so there's one series per route, not per channel.
+_API_PATH = re.compile(r"^/api/v\d+(/.*)$")
+_ID = re.compile(r"/\d+(?=/|$)")
+_TOKEN = re.compile(r"^/(interactions|webhooks)/\{id\}/[^/]+")
+# An interaction callback is always the first response.
+_CALLBACK = re.compile(r"/interactions/(\d+)/[^/]+/callback$")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def rest_route(path: str) -> Optional[str]:
+    """The route of a Discord API request path, like /channels/{id}/messages.
+    None for anything that isn't the API (the CDN)."""
+    api = _API_PATH.match(path)
+    if api is None:
+        return None
+    return _TOKEN.sub(r"/\1/{id}/{token}", _ID.sub("/{id}", api.group(1)))
+
+
+def _label_text(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[Tuple[str, Labels, str, float]]:
+        """(suffix, label values, extra label, value) for every sample."""
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_label_text(self.labels, values, extra)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0.0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self) -> List[Tuple[str, Labels, str, float]]:
+        return [("", labels, "", value) for labels, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """A value that's set, or worked out by a callback when the metrics are rendered."""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help: str, labels: Iterable[str] = (), *, callback: Optional[Callable[[], Dict[Labels, float]]] = None
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> List[Tuple[str, Labels, str, float]]:
+        values = self.callback() if self.callback else self.values
+        return [("", labels, "", value) for labels, value in sorted(values.items())]
+
+
+class _HistogramData:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self, buckets: int) -> None:
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Iterable[str] = (), *, buckets: Iterable[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.data: Dict[Labels, _HistogramData] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        data = self.data.get(labels)
+        if data is None:
+            data = self.data[labels] = _HistogramData(len(self.buckets))
+        data.counts[bisect.bisect_left(self.buckets, value)] += 1
+        data.sum += value
+        data.count += 1
+        data.max = max(data.max, value)
+
+    def merged(self, labels: Optional[Labels] = None) -> _HistogramData:
+        """One label set's data, or all of them added together."""
+        if labels is not None:
+            return self.data.get(labels) or _HistogramData(len(self.buckets))
+        total = _HistogramData(len(self.buckets))
+        for data in self.data.values():
+            total.counts = [a + b for a, b in zip(total.counts, data.counts)]
+            total.sum += data.sum
+            total.count += data.count
+            total.max = max(total.max, data.max)
+        return total
+
+    def quantile(self, q: float, labels: Optional[Labels] = None) -> Optional[float]:
+        data = self.merged(labels)
+        return bucket_quantile(self.buckets, data.counts, q, data.max)
+
+    def samples(self) -> List[Tuple[str, Labels, str, float]]:
+        samples = []
+        for labels, data in sorted(self.data.items()):
+            cumulative = 0
+            for upper, count in zip(self.buckets, data.counts):
+                cumulative += count
+                samples.append(("_bucket", labels, f'le="{upper:g}"', cumulative))
+            samples.append(("_bucket", labels, 'le="+Inf"', data.count))
+            samples.append(("_sum", labels, "", data.sum))
+            samples.append(("_count", labels, "", data.count))
+        return samples
+
+
+def bucket_quantile(buckets: Tuple[float, ...], counts: List[int], q: float, maximum: float) -> Optional[float]:
+    """An estimate from histogram buckets (interpolated within the bucket the quantile falls in)."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for upper, count in zip(buckets, counts):
+        if count and seen + count >= rank:
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return maximum
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = (), **kwargs) -> Gauge:
+        return self.add(Gauge(name, help, labels, **kwargs))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), **kwargs) -> Histogram:
+        return self.add(Histogram(name, help, labels, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log.warning(f"Metrics: Could not render {metric.name}. {e}")
+        return "\n".join(lines) + "\n"
+
+
+class MeteredCommandTree(app_commands.CommandTree):
+    """Notes when each app command interaction reaches the tree, before its command runs, and counts command errors."""
+
+    # The tree's interaction_check is the first public hook an app command or autocomplete interaction goes through.
+    async def interaction_check(self, interaction: discord.Interaction, /) -> bool:
+        metrics = getattr(self.client, "metrics", None)
+        if metrics is not None:
+            metrics.interaction_received(interaction)
+        return await super().interaction_check(interaction)
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError, /) -> None:
+        metrics = getattr(self.client, "metrics", None)
+        if metrics is not None:
+            metrics.command_finished(interaction, error)
+        await super().on_error(interaction, error)
+
+
+class BotMetrics:
+    """The bot's metrics, and the hooks that collect them."""
+
+    def __init__(self, bot, *, lag_interval: float = 0.5) -> None:
+        self.bot = bot
+        self.lag_interval = lag_interval
+        self.started = time.monotonic()
+        self.registry = Registry()
+        r = self.registry
+
+        self.command_latency = r.histogram(
+            "discordbot_command_first_response_seconds",
+            "Time from receiving an interaction to sending its first response.",
+            ("command", "kind"),
+        )
+        self.commands = r.counter("discordbot_commands_total", "App commands run, by outcome.", ("command", "outcome"))
+        self.interaction_acks = r.counter(
+            "discordbot_interaction_acks_total",
+            "How commands answered through the responder were acknowledged: response, defer or followup.",
+            ("command", "path"),
+        )
+        self.shard_events = r.counter(
+            "discordbot_shard_events_total", "Shard connects, disconnects, resumes and readies.", ("shard", "event")
+        )
+        self.rest_calls = r.counter(
+            "discordbot_rest_requests_total", "REST requests, by route and status.", ("method", "route", "status")
+        )
+        self.rest_latency = r.histogram(
+            "discordbot_rest_request_seconds",
+            "REST request duration, until the response headers arrived.",
+            ("method", "route"),
+        )
+        self.rate_limits = r.counter("discordbot_rate_limited_total", "429 responses from Discord.", ("source", "scope"))
+        self.loop_stalls = r.counter(
+            "discordbot_event_loop_stalls_total",
+            "Times the event loop was blocked past the watchdog threshold, by cog.",
+            ("cog",),
+        )
+        self.loop_lag = r.histogram(
+            "discordbot_event_loop_lag_seconds", "How late the event loop was to wake up a sleeping task.", buckets=LAG_BUCKETS
+        )
+        r.gauge(
+            "discordbot_shard_latency_seconds",
+            "Gateway heartbeat latency per shard.",
+            ("shard",),
+            callback=self._shard_latencies,
+        )
+        r.gauge("discordbot_guilds", "Guilds the bot is in.", callback=lambda: {(): len(self.bot.guilds)})
+        r.gauge(
+            "discordbot_uptime_seconds",
+            "Seconds since the bot was created.",
+            callback=lambda: {(): time.monotonic() - self.started},
+        )
+        r.gauge(
+            "discordbot_log_records_dropped",
+            "Log records dropped because the log queue was full.",
+            callback=self._dropped_logs,
+        )
+        r.gauge(
+            "discordbot_scheduler_jobs", "Jobs waiting in the scheduler.", callback=lambda: {(): len(self.bot.scheduler.jobs)}
+        )
+
+        # interaction ID -> (when it arrived, command name, kind)
+        self._pending: Dict[int, Tuple[float, str, str]] = {}
+        self._lag_task: Optional[asyncio.Task] = None
+        self._server = None
+
+        bot.add_listener(self.on_app_command_completion)
+        for event in ("connect", "disconnect", "resumed", "ready"):
+            bot.add_listener(self._shard_listener(event), f"on_shard_{event}")
+
+    def attach(self, trace: aiohttp.TraceConfig) -> None:
+        """Time the REST requests of the bot's HTTP session. The trace is the one passed to the bot as http_trace."""
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+
+    async def start(self, host: str = "127.0.0.1", port: Optional[int] = None) -> None:
+        self._lag_task = asyncio.create_task(self._measure_lag(), name="metrics: loop lag")
+        if port:
+            await self._start_server(host, port)
+
+    async def close(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._server is not None:
+            await self._server.cleanup()
+            self._server = None
+
+    # Interactions
+
+    def interaction_received(self, interaction: discord.Interaction) -> None:
+        now = time.perf_counter()
+        data = interaction.data or {}
+        kind = "autocomplete" if interaction.type == discord.InteractionType.autocomplete else "command"
+        self._pending[interaction.id] = (now, str(data.get("name", "unknown")), kind)
+        if len(self._pending) > 1000:
+            cutoff = now - PENDING_TTL
+            self._pending = {key: value for key, value in self._pending.items() if value[0] > cutoff}
+
+    def received_at(self, interaction_id: int) -> Optional[float]:
+        """When an interaction that hasn't been answered yet arrived, in time.perf_counter() time."""
+        pending = self._pending.get(interaction_id)
+        return pending[0] if pending is not None else None
+
+    def _first_response(self, interaction_id: int) -> None:
+        pending = self._pending.pop(interaction_id, None)
+        if pending is not None:
+            received, name, kind = pending
+            self.command_latency.observe(time.perf_counter() - received, name, kind)
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command) -> None:
+        self.command_finished(interaction)
+
+    def command_finished(self, interaction: discord.Interaction, error: Optional[BaseException] = None) -> None:
+        command = getattr(interaction.command, "qualified_name", None) or str((interaction.data or {}).get("name", "unknown"))
+        self.commands.inc(command, "success" if error is None else "error")
+
+    # Shards
+
+    def _shard_listener(self, event: str):
+        async def listener(shard_id: int) -> None:
+            self.shard_events.inc(str(shard_id), event)
+
+        listener.__name__ = f"on_shard_{event}"
+        return listener
+
+    def _shard_latencies(self) -> Dict[Labels, float]:
+        latencies = {}
+        for shard_id, latency in getattr(self.bot, "latencies", []):
+            if latency == latency and latency != float("inf"):
+                latencies[(str(shard_id),)] = latency
+        return latencies
+
+    # REST
+
+    # Each attempt is a request of its own here, including the ones discord.py retries after a 429.
+
+    async def _on_request_start(self, session, context, params: aiohttp.TraceRequestStartParams) -> None:
+        context.metrics_started = time.perf_counter()
+
+    async def _on_request_end(self, session, context, params: aiohttp.TraceRequestEndParams) -> None:
+        response = params.response
+        route = self._rest_finished(
+            context, params.method, params.url.path, "ok" if response.status < 400 else str(response.status)
+        )
+        if route is None:
+            return
+        if response.status == 429:
+            headers = response.headers
+            scope = "global" if headers.get("X-RateLimit-Global") or headers.get("X-RateLimit-Scope") == "global" else "route"
+            self.rate_limits.inc("webhook" if route.startswith(("/interactions/", "/webhooks/")) else "bot", scope)
+        elif response.status < 300:
+            callback = _CALLBACK.search(params.url.path)
+            if callback is not None:
+                self._first_response(int(callback.group(1)))
+
+    async def _on_request_exception(self, session, context, params: aiohttp.TraceRequestExceptionParams) -> None:
+        self._rest_finished(context, params.method, params.url.path, "error")
+
+    def _rest_finished(self, context, method: str, path: str, status: str) -> Optional[str]:
+        route = rest_route(path)
+        started = getattr(context, "metrics_started", None)
+        if route is not None and started is not None:
+            self.rest_calls.inc(method, route, status)
+            self.rest_latency.observe(time.perf_counter() - started, method, route)
+        return route
+
+    # Event loop
+
+    async def _measure_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            self.loop_lag.observe(max(loop.time() - expected, 0.0))
+
+    @staticmethod
+    def _dropped_logs() -> Dict[Labels, float]:
+        from cogs.utils.logqueue import get_queue_handler
+
+        handler = get_queue_handler()
+        return {(): handler.dropped} if handler is not None else {}
+
+    # Output
+
+    async def _start_server(self, host: str, port: int) -> None:
+        from aiohttp import web
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            log.error(f"Metrics: Could not listen on {host}:{port}. {e}")
+            await runner.cleanup()
+            return
+        self._server = runner
+        log.info(f"Metrics: Serving metrics on http://{host}:{port}/metrics")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The numbers behind /stats, as plain JSON-able values so they can be sent between cluster processes and merged."""
+        latency = self.command_latency.merged()
+        lag = self.loop_lag.merged()
+        shard_events: Dict[str, float] = {}
+        for (_, event), count in self.shard_events.values.items():
+            shard_events[event] = shard_events.get(event, 0) + count
+        return {
+            "uptime": time.monotonic() - self.started,
+            "guilds": len(self.bot.guilds),
+            "shards": {labels[0]: value for labels, value in self._shard_latencies().items()},
+            "disconnects": shard_events.get("disconnect", 0),
+            "resumes": shard_events.get("resumed", 0),
+            "commands": self.commands.total(),
+            "errors": sum(value for (_, outcome), value in self.commands.values.items() if outcome == "error"),
+            "latency_counts": latency.counts,
+            "latency_max": latency.max,
+            "rest": self.rest_calls.total(),
+            "rate_limited": self.rate_limits.total(),
+            "stalls": self.loop_stalls.total(),
+            "lag_max": lag.max,
+            "lag_sum": lag.sum,
+            "lag_count": lag.count,
+        }
+
+    def summary(self) -> str:
+        """A few lines for the /stats command."""
+        return format_summary(self.snapshot())
+
+
+def merge_snapshots(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Add up the snapshots of several processes."""
+    merged: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if key not in merged:
+                merged[key] = list(value) if isinstance(value, list) else dict(value) if isinstance(value, dict) else value
+            elif key in ("uptime", "latency_max", "lag_max"):
+                merged[key] = max(merged[key], value)
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            elif isinstance(value, dict):
+                merged[key].update(value)
+            else:
+                merged[key] += value
+    return merged
+
+
+def format_summary(snapshot: Dict[str, Any]) -> str:
+    uptime = int(snapshot["uptime"])
+    latencies = list(snapshot["shards"].values())
+    counts = snapshot["latency_counts"]
+    p50 = bucket_quantile(LATENCY_BUCKETS, counts, 0.5, snapshot["latency_max"])
+    p95 = bucket_quantile(LATENCY_BUCKETS, counts, 0.95, snapshot["latency_max"])
+    lines = [
+        f"Uptime: {uptime // 86400}d {uptime % 86400 // 3600}h {uptime % 3600 // 60}m, {snapshot['guilds']} guilds",
+        f"Shards: {len(latencies)}, latency "
+        + (f"{min(latencies) * 1000:.0f}-{max(latencies) * 1000:.0f}ms" if latencies else "unknown")
+        + f", {int(snapshot['disconnects'])} disconnects, {int(snapshot['resumes'])} resumes",
+        f"Commands: {int(snapshot['commands'])} run, {int(snapshot['errors'])} errors, "
+        + (f"first response p50 {p50 * 1000:.0f}ms / p95 {p95 * 1000:.0f}ms" if p50 is not None else "no responses yet"),
+        f"REST: {int(snapshot['rest'])} requests, {int(snapshot['rate_limited'])} rate limited",
+        f"Event loop lag: max {snapshot['lag_max'] * 1000:.0f}ms"
+        + (f", mean {snapshot['lag_sum'] / snapshot['lag_count'] * 1000:.1f}ms" if snapshot["lag_count"] else "")
+        + f", {int(snapshot['stalls'])} stalls",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/reloader.py
+
+# Reloads only the extensions whose source files changed since they were loaded.
+# Each loaded extension's files are fingerprinted (a hash of their contents). The changed ones are reloaded concurrently and
+# every reload is timed. If a reload fails, discord.py puts the previous version of the extension back, so a bad file never
+# leaves a cog unloaded.
+# The bot has it as bot.reloader.
+
+import asyncio
+import hashlib
+import logging
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from discord.ext import commands
+
+log = logging.getLogger("discord")
+
+
+class ReloadResult:
+    __slots__ = ("name", "outcome", "duration", "error")
+
+    def __init__(self, name: str, outcome: str, duration: float = 0.0, error: Optional[str] = None) -> None:
+        self.name = name
+        self.outcome = outcome  # "reloaded", "unchanged", "would reload" or "failed"
+        self.duration = duration
+        self.error = error
+
+    def __str__(self) -> str:
+        text = f"{self.name}: {self.outcome}"
+        if self.outcome in ("reloaded", "failed"):
+            text += f" in {self.duration * 1000:.0f}ms"
+        if self.error:
+            text += f" (rolled back: {self.error})"
+        return text
+
+
+class ReloadReport:
+    def __init__(self, results: List[ReloadResult], duration: float) -> None:
+        self.results = results
+        self.duration = duration
+
+    def by_outcome(self, outcome: str) -> List[ReloadResult]:
+        return [result for result in self.results if result.outcome == outcome]
+
+    @property
+    def failed(self) -> List[ReloadResult]:
+        return self.by_outcome("failed")
+
+    def summary(self) -> str:
+        counts = ", ".join(
+            f"{len(self.by_outcome(outcome))} {outcome}"
+            for outcome in ("reloaded", "would reload", "unchanged", "failed")
+            if self.by_outcome(outcome)
+        )
+        return f"{counts or 'nothing to do'} in {self.duration * 1000:.0f}ms"
+
+    def __str__(self) -> str:
+        lines = [self.summary()]
+        lines.extend(str(result) for result in self.results if result.outcome != "unchanged")
+        return "\n".join(lines)
+
+
+class ExtensionReloader:
+    """Fingerprint-based selective extension reloads."""
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self.fingerprints: Dict[str, str] = {}
+
+    def files(self, name: str) -> List[str]:
+        """The source files of an extension: its module, plus its submodules if it's a package."""
+        files = []
+        for module_name, module in list(sys.modules.items()):
+            if module_name == name or module_name.startswith(f"{name}."):
+                path = getattr(module, "__file__", None)
+                if path:
+                    files.append(path)
+        return sorted(files)
+
+    async def fingerprint(self, name: str) -> Optional[str]:
+        return await asyncio.to_thread(self._fingerprint, self.files(name))
+
+    @staticmethod
+    def _fingerprint(files: List[str]) -> Optional[str]:
+        if not files:
+            return None
+        digest = hashlib.sha1()
+        for path in files:
+            digest.update(path.encode("utf-8"))
+            try:
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+            except OSError:
+                # A missing file counts as a change. The reload will report why it failed.
+                digest.update(b"\0missing")
+        return digest.hexdigest()
+
+    async def record(self, name: str) -> None:
+        """Remember what an extension looked like when it was (re)loaded."""
+        fingerprint = await self.fingerprint(name)
+        if fingerprint is not None:
+            self.fingerprints[name] = fingerprint
+
+    def forget(self, name: str) -> None:
+        self.fingerprints.pop(name, None)
+
+    async def changed(self, names: Optional[Iterable[str]] = None) -> List[Tuple[str, bool]]:
+        """(name, changed) for each loaded extension."""
+        names = list(names) if names is not None else list(self.bot.extensions)
+        fingerprints = await asyncio.gather(*(self.fingerprint(name) for name in names))
+        return [
+            (name, fingerprint is None or self.fingerprints.get(name) != fingerprint)
+            for name, fingerprint in zip(names, fingerprints)
+        ]
+
+    async def reload(
+        self, names: Optional[Iterable[str]] = None, *, force: bool = False, dry_run: bool = False
+    ) -> ReloadReport:
+        started = time.perf_counter()
+        results: List[ReloadResult] = []
+        to_reload = []
+        for name, changed in await self.changed(names):
+            if changed or force:
+                to_reload.append(name)
+            else:
+                results.append(ReloadResult(name, "unchanged"))
+
+        if dry_run:
+            results.extend(ReloadResult(name, "would reload") for name in to_reload)
+        else:
+            results.extend(await asyncio.gather(*(self._reload_one(name) for name in to_reload)))
+
+        report = ReloadReport(sorted(results, key=lambda result: result.name), time.perf_counter() - started)
+        log.info(f"Reloader: {'Dry run: ' if dry_run else ''}{report.summary()}.")
+        for result in report.failed:
+            log.error(f"Reloader: {result}")
+        return report
+
+    async def _reload_one(self, name: str) -> ReloadResult:
+        started = time.perf_counter()
+        try:
+            # reload_extension restores the previous module if the new one fails to load.
+            await self.bot.reload_extension(name)
+        except commands.ExtensionError as e:
+            cause = e.__cause__ or e
+            return ReloadResult(name, "failed", time.perf_counter() - started, f"{cause.__class__.__name__}: {cause}")
+        return ReloadResult(name, "reloaded", time.perf_counter() - started)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/resolver.py
+
+# Resolves role and channel names to IDs once per guild instead of scanning guild.roles on every command.
+# The name maps are built the first time a guild is looked up and kept current from the role and channel gateway events.
+# Cogs get it as bot.resolver.
+
+import logging
+from typing import Dict, FrozenSet, Optional, Set, Tuple, Union
+
+import discord
+
+import config
+
+log = logging.getLogger("discord")
+
+
+class GuildResolver:
+    """O(1) role and channel lookups by name, per guild."""
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self._roles: Dict[int, Dict[str, int]] = {}
+        self._channels: Dict[int, Dict[str, int]] = {}
+        self._admin_roles: Dict[int, FrozenSet[int]] = {}
+        # Lookups that already failed, so they're only logged once until something changes in that guild.
+        self._warned: Set[Tuple[int, str, str]] = set()
+
+        for listener in (
+            self.on_guild_role_create,
+            self.on_guild_role_update,
+            self.on_guild_role_delete,
+            self.on_guild_channel_create,
+            self.on_guild_channel_update,
+            self.on_guild_channel_delete,
+            self.on_guild_available,
+            self.on_guild_remove,
+        ):
+            bot.add_listener(listener)
+
+    def role(self, guild: discord.Guild, name: str) -> Optional[discord.Role]:
+        roles = self._roles.get(guild.id)
+        if roles is None:
+            roles = self._index_roles(guild)
+        role_id = roles.get(name)
+        role = guild.get_role(role_id) if role_id is not None else None
+        if role is None:
+            self._warn_once(guild, "role", name)
+        return role
+
+    def channel(self, guild: discord.Guild, channel: Union[int, str, None]) -> Optional[discord.abc.GuildChannel]:
+        """Look up a channel by ID or by name."""
+        if isinstance(channel, str) and not channel.isdigit():
+            channels = self._channels.get(guild.id)
+            if channels is None:
+                channels = self._index_channels(guild)
+            channel_id = channels.get(channel)
+        else:
+            channel_id = int(channel) if channel is not None else None
+        found = guild.get_channel(channel_id) if channel_id is not None else None
+        if found is None:
+            self._warn_once(guild, "channel", str(channel))
+        return found
+
+    def admin_role_ids(self, guild: discord.Guild) -> FrozenSet[int]:
+        """The IDs of the roles allowed to use admin commands in the guild, from admin_roles in the config file."""
+        admin_roles = self._admin_roles.get(guild.id)
+        if admin_roles is None:
+            names = config.admin_roles.get(guild.id, {}).get("admin_role")
+            if isinstance(names, str):
+                names = [names]
+            admin_roles = frozenset(role.id for role in (self.role(guild, name) for name in names or []) if role is not None)
+            self._admin_roles[guild.id] = admin_roles
+        return admin_roles
+
+    def invalidate(self, guild_id: int) -> None:
+        self._roles.pop(guild_id, None)
+        self._channels.pop(guild_id, None)
+        self._admin_roles.pop(guild_id, None)
+        self._warned = {warned for warned in self._warned if warned[0] != guild_id}
+
+    def _index_roles(self, guild: discord.Guild) -> Dict[str, int]:
+        # guild.roles is in position order, and the first role with a name wins, the same as discord.utils.get().
+        roles: Dict[str, int] = {}
+        for role in guild.roles:
+            roles.setdefault(role.name, role.id)
+        self._roles[guild.id] = roles
+        return roles
+
+    def _index_channels(self, guild: discord.Guild) -> Dict[str, int]:
+        channels: Dict[str, int] = {}
+        for channel in guild.channels:
+            channels.setdefault(channel.name, channel.id)
+        self._channels[guild.id] = channels
+        return channels
+
+    def _warn_once(self, guild: discord.Guild, kind: str, name: str) -> None:
+        key = (guild.id, kind, name)
+        if key in self._warned:
+            return
+        self._warned.add(key)
+        log.warning(f"Resolver: The {kind} \"{name}\" does not exist in {guild.name} (ID: {guild.id}).")
+
+    # Roles and channels only change through these events, so any change just drops that guild's maps and they're
+    # rebuilt on the next lookup.
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        self.invalidate(role.guild.id)
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        if before.name != after.name or before.position != after.position:
+            self.invalidate(after.guild.id)
+
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        self.invalidate(role.guild.id)
+
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel) -> None:
+        self.invalidate(channel.guild.id)
+
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel) -> None:
+        if before.name != after.name:
+            self.invalidate(after.guild.id)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel) -> None:
+        self.invalidate(channel.guild.id)
+
+    async def on_guild_available(self, guild: discord.Guild) -> None:
+        self.invalidate(guild.id)
+
+    async def on_guild_remove(self, guild: discord.Guild) -> None:
+        self.invalidate(guild.id)
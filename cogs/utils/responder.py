@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/responder.py
+
+# Discord gives an interaction 3 seconds for its first response, and after that only followups work. Responder answers an
+# interaction the right way whatever happened before:
+#   - if the command is still busy DEFER_AFTER seconds after the interaction arrived, it defers on its own, in the background;
+#   - send() answers with the initial response if there hasn't been one yet, or a followup if there has (e.g. a defer);
+#   - concurrently() runs side effects that don't change the answer (posting an announcement, say) alongside the answer,
+#     instead of making the user wait for them first. They're awaited when the block exits;
+#   - fail() tells the user something went wrong through whichever path is still open, and never raises itself.
+#     async with Responder(interaction, ephemeral=True) as responder:
+#         responder.concurrently(self.bot.dispatcher.send(channel, ...), error="The announcement couldn't be posted.")
+#         await responder.send("Announced!")
+# How each command was acknowledged is counted in bot.metrics, next to the time to the first response it already records.
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, List, Optional, Tuple
+
+import discord
+
+log = logging.getLogger("discord")
+
+# Seconds after the interaction arrived. Far enough from Discord's 3 seconds that the defer itself gets there in time.
+DEFER_AFTER = 2.0
+
+
+class Responder:
+    """Answers one interaction within its latency budget."""
+
+    def __init__(self, interaction: discord.Interaction, *, ephemeral: bool = False, defer_after: float = DEFER_AFTER) -> None:
+        self.interaction = interaction
+        self.ephemeral = ephemeral
+        self.metrics = getattr(interaction.client, "metrics", None)
+        received = self.metrics.received_at(interaction.id) if self.metrics is not None else None
+        # How long is left of the budget, counting what the interaction already spent waiting in the event loop.
+        self.defer_after = max(0.0, defer_after - (time.perf_counter() - received)) if received is not None else defer_after
+        self.command = getattr(interaction.command, "qualified_name", None) or str(
+            (interaction.data or {}).get("name", "unknown")
+        )
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._defer_task: Optional[asyncio.Task] = None
+        self._side_effects: List[Tuple[asyncio.Task, Optional[str]]] = []
+
+    async def __aenter__(self) -> "Responder":
+        self._timer = asyncio.get_running_loop().call_later(self.defer_after, self._start_defer)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._cancel_timer()
+        if self._defer_task is not None:
+            await asyncio.gather(self._defer_task, return_exceptions=True)
+        for task, error in self._side_effects:
+            try:
+                await task
+            except Exception as e:
+                log.error(f"Responder: A side effect of /{self.command} failed. {e.__class__.__name__}: {e}")
+                if error is not None:
+                    await self.fail(error)
+        self._side_effects.clear()
+
+    @property
+    def is_done(self) -> bool:
+        return self.interaction.response.is_done()
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _start_defer(self) -> None:
+        self._timer = None
+        self._defer_task = asyncio.create_task(self.defer(), name=f"responder: defer /{self.command}")
+
+    async def defer(self) -> None:
+        """Acknowledge the interaction now, with a "thinking..." message, unless it already has been."""
+        self._cancel_timer()
+        async with self._lock:
+            if self.is_done:
+                return
+            try:
+                await self.interaction.response.defer(ephemeral=self.ephemeral, thinking=True)
+                self._count("defer")
+            except discord.HTTPException as e:
+                # Most likely the interaction expired. send() will try a followup anyway.
+                log.warning(f"Responder: Could not defer /{self.command}. {e.__class__.__name__}: {e}")
+
+    async def send(self, content: Optional[str] = None, **kwargs) -> None:
+        """The answer: the initial response if there hasn't been one, otherwise a followup."""
+        self._cancel_timer()
+        kwargs.setdefault("ephemeral", self.ephemeral)
+        async with self._lock:
+            if not self.is_done:
+                await self.interaction.response.send_message(content, **kwargs)
+                self._count("response")
+            else:
+                await self.interaction.followup.send(content, **kwargs)
+                self._count("followup")
+
+    async def fail(self, content: str = "Command failed, sorry.") -> None:
+        """Tell the user something went wrong. Doesn't raise, since it's usually called from an except block."""
+        try:
+            await self.send(content, ephemeral=True)
+        except discord.DiscordException as e:
+            log.warning(f"Responder: Could not tell the user /{self.command} failed. {e.__class__.__name__}: {e}")
+
+    def concurrently(self, awaitable: Awaitable[Any], *, error: Optional[str] = None) -> asyncio.Task:
+        """Start a side effect that doesn't change the answer. If it fails, the user is told error (if given) in a followup."""
+        task = asyncio.ensure_future(awaitable)
+        self._side_effects.append((task, error))
+        return task
+
+    def _count(self, path: str) -> None:
+        if self.metrics is not None:
+            self.metrics.interaction_acks.inc(self.command, path)
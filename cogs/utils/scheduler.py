@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/scheduler.py
+
+# One scheduler for the whole bot, instead of a tasks.loop per cog that wakes up just to check the time.
+# Jobs sit in a single heap ordered by deadline and the scheduler only wakes up when the earliest one is due.
+# Cogs get it as bot.scheduler. Jobs registered with owner=<cog> are cancelled automatically when that cog is removed.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+log = logging.getLogger("discord")
+
+JobCallback = Callable[[], Awaitable[Any]]
+When = Union[datetime, float]
+
+# Never sleep longer than this in one go, so a wall clock change doesn't leave a job waiting for hours.
+MAX_SLEEP = 60.0
+
+# How many missed runs the "all" catch-up policy will replay at most.
+MAX_CATCH_UP = 100
+
+CATCH_UP_POLICIES = ("skip", "once", "all")
+
+# Cancelled jobs stay in the heap until they come up, unless they're more than half of it. Then it's rebuilt without them.
+COMPACT_MIN_SIZE = 64
+
+
+def _timestamp(when: When) -> float:
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return when.timestamp()
+    return float(when)
+
+
+class OneShot:
+    """Runs once at a fixed time."""
+
+    def __init__(self, when: When) -> None:
+        self.when = _timestamp(when)
+
+    def first(self, now: float) -> Optional[float]:
+        return self.when
+
+    def next(self, after: float) -> Optional[float]:
+        return None
+
+    def __repr__(self) -> str:
+        return f"<OneShot at {datetime.fromtimestamp(self.when, timezone.utc).isoformat()}>"
+
+
+class Interval:
+    """Runs every `seconds` seconds, starting now or after the first interval."""
+
+    def __init__(self, seconds: float, run_now: bool = False) -> None:
+        if seconds <= 0:
+            raise ValueError("Interval must be greater than zero.")
+        self.seconds = seconds
+        self.run_now = run_now
+
+    def first(self, now: float) -> Optional[float]:
+        return now if self.run_now else now + self.seconds
+
+    def next(self, after: float) -> Optional[float]:
+        return after + self.seconds
+
+    def __repr__(self) -> str:
+        return f"<Interval every {self.seconds}s>"
+
+
+class Cron:
+    """Runs at the matching minutes/hours (UTC), like a cron line without the day fields."""
+
+    def __init__(self, minute: Iterable[int] = (0,), hour: Optional[Iterable[int]] = None) -> None:
+        self.minutes = sorted(set(minute))
+        self.hours = sorted(set(hour)) if hour is not None else list(range(24))
+        if not self.minutes or not all(0 <= m < 60 for m in self.minutes):
+            raise ValueError("Cron minutes must be between 0 and 59.")
+        if not self.hours or not all(0 <= h < 24 for h in self.hours):
+            raise ValueError("Cron hours must be between 0 and 23.")
+
+    def first(self, now: float) -> Optional[float]:
+        return self.next(now)
+
+    def next(self, after: float) -> Optional[float]:
+        start = datetime.fromtimestamp(after, timezone.utc).replace(second=0, microsecond=0)
+        day = start.replace(hour=0, minute=0)
+        for days in range(2):
+            for hour in self.hours:
+                for minute in self.minutes:
+                    candidate = day + timedelta(days=days, hours=hour, minutes=minute)
+                    if candidate.timestamp() > after:
+                        return candidate.timestamp()
+        return None
+
+    def __repr__(self) -> str:
+        return f"<Cron minute={self.minutes} hour={self.hours}>"
+
+
+class JobStats:
+    """Run metrics for one job."""
+
+    __slots__ = ("runs", "failures", "misfires", "last_run", "last_duration", "total_duration", "max_lateness", "last_error")
+
+    def __init__(self) -> None:
+        self.runs = 0
+        self.failures = 0
+        self.misfires = 0
+        self.last_run: Optional[float] = None
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.max_lateness = 0.0
+        self.last_error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Job:
+    """A registered job. Keep the reference if you want to cancel it."""
+
+    def __init__(
+        self,
+        scheduler: "Scheduler",
+        callback: JobCallback,
+        trigger,
+        *,
+        name: str,
+        owner: Any,
+        jitter: float,
+        misfire_grace: float,
+        catch_up: str,
+    ) -> None:
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"catch_up must be one of {CATCH_UP_POLICIES}, not {catch_up!r}.")
+        self.scheduler = scheduler
+        self.callback = callback
+        self.trigger = trigger
+        self.name = name
+        self.owner = owner
+        self.jitter = jitter
+        self.misfire_grace = misfire_grace
+        self.catch_up = catch_up
+        self.deadline: Optional[float] = None  # The trigger's deadline, without jitter.
+        self.cancelled = False
+        self.running = False
+        self.stats = JobStats()
+
+    @property
+    def next_run(self) -> Optional[datetime]:
+        if self.deadline is None or self.cancelled:
+            return None
+        return datetime.fromtimestamp(self.deadline, timezone.utc)
+
+    def cancel(self) -> None:
+        self.scheduler.cancel(self)
+
+    def __repr__(self) -> str:
+        return f"<Job name={self.name!r} trigger={self.trigger!r} next_run={self.next_run}>"
+
+
+class Scheduler:
+    """Deadline-based job scheduler backed by a single heap."""
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Job]] = []
+        self._counter = itertools.count()
+        self._jobs: Set[Job] = set()
+        # Heap entries of cancelled jobs that haven't come up yet.
+        self._cancelled = 0
+        # Running jobs, by their task.
+        self._running: Dict[asyncio.Task, Job] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def jobs(self) -> List[Job]:
+        return sorted(self._jobs, key=lambda job: job.deadline or 0.0)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="scheduler")
+
+    async def close(self) -> None:
+        for job in list(self._jobs):
+            job.cancelled = True
+        self._jobs.clear()
+        self._heap.clear()
+        self._cancelled = 0
+        tasks = list(self._running)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def add(
+        self,
+        callback: JobCallback,
+        trigger,
+        *,
+        name: Optional[str] = None,
+        owner: Any = None,
+        jitter: float = 0.0,
+        misfire_grace: float = 60.0,
+        catch_up: str = "once",
+    ) -> Job:
+        """Register a job.
+
+        jitter spreads each run randomly over that many seconds after its deadline.
+        A run that starts more than misfire_grace seconds late is a misfire, and catch_up decides what happens:
+        "skip" drops the missed run(s), "once" runs once now, "all" replays every missed run.
+        """
+        job = Job(
+            self,
+            callback,
+            trigger,
+            name=name or getattr(callback, "__qualname__", repr(callback)),
+            owner=owner,
+            jitter=jitter,
+            misfire_grace=misfire_grace,
+            catch_up=catch_up,
+        )
+        self._jobs.add(job)
+        self._push(job, trigger.first(time.time()))
+        return job
+
+    def call_at(self, when: When, callback: JobCallback, **kwargs) -> Job:
+        return self.add(callback, OneShot(when), **kwargs)
+
+    def call_later(self, delay: float, callback: JobCallback, **kwargs) -> Job:
+        return self.add(callback, OneShot(time.time() + delay), **kwargs)
+
+    def before(self, when: When, callback: JobCallback, *, hours: float = 0, minutes: float = 0, **kwargs) -> Job:
+        """Run once, the given amount of time before `when`."""
+        return self.add(callback, OneShot(_timestamp(when) - hours * 3600 - minutes * 60), **kwargs)
+
+    def every(
+        self,
+        callback: JobCallback,
+        *,
+        hours: float = 0,
+        minutes: float = 0,
+        seconds: float = 0,
+        run_now: bool = False,
+        **kwargs,
+    ) -> Job:
+        return self.add(callback, Interval(hours * 3600 + minutes * 60 + seconds, run_now=run_now), **kwargs)
+
+    def cron(
+        self, callback: JobCallback, *, minute: Iterable[int] = (0,), hour: Optional[Iterable[int]] = None, **kwargs
+    ) -> Job:
+        return self.add(callback, Cron(minute=minute, hour=hour), **kwargs)
+
+    def cancel(self, job: Job) -> None:
+        # The heap entry is left behind and skipped when it comes up. That keeps cancelling O(1), except when cancelled entries
+        # (of jobs days ahead, from a cog that's reloaded often) are more than half the heap.
+        if job in self._jobs:
+            self._cancelled += 1
+        job.cancelled = True
+        self._jobs.discard(job)
+        if self._cancelled > len(self._heap) // 2 and len(self._heap) >= COMPACT_MIN_SIZE:
+            self._compact()
+
+    def cancel_owner(self, owner: Any) -> int:
+        """Cancel an owner's jobs, and stop the ones that are running, so nothing runs against a cog that's been removed."""
+        jobs = [job for job in self._jobs if job.owner is owner]
+        for job in jobs:
+            self.cancel(job)
+        running = [task for task, job in self._running.items() if job.owner is owner and task is not asyncio.current_task()]
+        for task in running:
+            task.cancel()
+        if jobs or running:
+            log.debug(
+                f"Scheduler: Cancelled {len(jobs)} job(s) owned by {owner.__class__.__name__}, {len(running)} of them running."
+            )
+        return len(jobs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {job.name: job.stats.to_dict() for job in self.jobs}
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        self._cancelled = 0
+        self._wakeup.set()
+
+    def _push(self, job: Job, deadline: Optional[float]) -> None:
+        if deadline is None or job.cancelled:
+            self._jobs.discard(job)
+            job.deadline = None
+            return
+        job.deadline = deadline
+        fire_at = deadline + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (fire_at, next(self._counter), job))
+        if earliest is None or fire_at < earliest:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+
+            if not self._heap:
+                delay = None
+            else:
+                delay = self._heap[0][0] - time.time()
+
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=None if delay is None else min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            fire_at, _, job = heapq.heappop(self._heap)
+            self._dispatch(job, fire_at)
+
+    def _dispatch(self, job: Job, fire_at: float) -> None:
+        now = time.time()
+        lateness = now - fire_at
+        deadline = job.deadline
+        runs = 1
+
+        if lateness > job.misfire_grace:
+            missed = 0
+            next_deadline = deadline
+            while next_deadline is not None and next_deadline <= now and missed < MAX_CATCH_UP:
+                missed += 1
+                next_deadline = job.trigger.next(next_deadline)
+            job.stats.misfires += missed
+            if job.catch_up == "skip":
+                runs = 0
+            elif job.catch_up == "all":
+                runs = missed
+            log.warning(
+                f"Scheduler: Job {job.name} is {lateness:.1f}s late ({missed} missed run(s), catch-up policy "
+                f"\"{job.catch_up}\")."
+            )
+        else:
+            next_deadline = job.trigger.next(deadline)
+            while next_deadline is not None and next_deadline <= now:
+                next_deadline = job.trigger.next(next_deadline)
+
+        # Schedule the next run before this one starts so a slow job doesn't push the whole schedule back.
+        self._push(job, next_deadline)
+
+        if runs == 0:
+            return
+        if job.running:
+            job.stats.misfires += 1
+            log.warning(f"Scheduler: Job {job.name} is still running from its previous deadline, so this run was skipped.")
+            return
+
+        job.stats.max_lateness = max(job.stats.max_lateness, lateness)
+        task = asyncio.create_task(self._execute(job, runs), name=f"scheduler: {job.name}")
+        self._running[task] = job
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._running.pop(task, None)
+
+    async def _execute(self, job: Job, runs: int) -> None:
+        job.running = True
+        try:
+            for _ in range(runs):
+                started = time.perf_counter()
+                job.stats.last_run = time.time()
+                try:
+                    await job.callback()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    job.stats.failures += 1
+                    job.stats.last_error = f"{e.__class__.__name__}: {e}"
+                    log.exception(f"Scheduler: Job {job.name} failed. {e}")
+                finally:
+                    duration = time.perf_counter() - started
+                    job.stats.runs += 1
+                    job.stats.last_duration = duration
+                    job.stats.total_duration += duration
+        finally:
+            job.running = False
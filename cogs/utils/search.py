@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/search.py
+
+# A small precomputed search index for autocomplete.
+# Names are normalized once when the index is built. Lookups use sorted prefix lists and an n-gram index instead of
+# scanning every name on every keystroke.
+# Results are ranked exact > prefix > word prefix > substring, then by weight (e.g. how often something was picked), and
+# capped at Discord's 25 choices.
+
+import re
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Discord won't accept more than 25 autocomplete choices.
+MAX_CHOICES = 25
+
+# Longest n-gram indexed. Longer queries intersect their trigrams and then check the candidates.
+GRAM_SIZE = 3
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _whitespace.sub(" ", text.casefold()).strip()
+
+
+class SearchIndex:
+    """Ranked substring search over a fixed list of names."""
+
+    def __init__(self, names: Iterable[str], weights: Optional[Dict[str, int]] = None) -> None:
+        # Keep the first spelling of any duplicate names.
+        seen: Set[str] = set()
+        self.names: List[str] = []
+        self.normalized: List[str] = []
+        for name in names:
+            name = str(name)
+            norm = normalize(name)
+            if not norm or norm in seen:
+                continue
+            seen.add(norm)
+            self.names.append(name)
+            self.normalized.append(norm)
+
+        self._by_name = {norm: i for i, norm in enumerate(self.normalized)}
+        self.weights: List[int] = [0] * len(self.names)
+        for name, weight in (weights or {}).items():
+            self.set_weight(name, weight)
+
+        # Whole-name prefixes and word prefixes are both bisected out of sorted lists.
+        self._prefixes: List[Tuple[str, int]] = sorted((norm, i) for i, norm in enumerate(self.normalized))
+        self._word_prefixes: List[Tuple[str, int]] = sorted(
+            (norm[match.start():], i)
+            for i, norm in enumerate(self.normalized)
+            for match in re.finditer(r"(?<=[\s\-_:/(])\w", norm)
+        )
+        self._grams: Dict[str, Set[int]] = defaultdict(set)
+        for i, norm in enumerate(self.normalized):
+            for size in range(1, GRAM_SIZE + 1):
+                for start in range(len(norm) - size + 1):
+                    self._grams[norm[start:start + size]].add(i)
+        self._grams = dict(self._grams)
+
+        # Bumped whenever the ranking changes, so cached results can be told apart.
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def set_weight(self, name: str, weight: int) -> None:
+        i = self._by_name.get(normalize(name))
+        if i is not None:
+            self.weights[i] = weight
+            self.generation += 1
+
+    def bump(self, name: str, amount: int = 1) -> None:
+        i = self._by_name.get(normalize(name))
+        if i is not None:
+            self.set_weight(name, self.weights[i] + amount)
+
+    def search(self, query: str, limit: int = MAX_CHOICES) -> List[str]:
+        q = normalize(query)
+        if not q:
+            best = sorted(range(len(self.names)), key=lambda i: (-self.weights[i], self.normalized[i]))
+            return [self.names[i] for i in best[:limit]]
+
+        tiers: Dict[int, int] = {}
+        for tier, entries in ((1, self._prefixes), (2, self._word_prefixes)):
+            start = bisect_left(entries, (q, -1))
+            for text, i in entries[start:]:
+                if not text.startswith(q):
+                    break
+                if i not in tiers:
+                    tiers[i] = 0 if self.normalized[i] == q else tier
+
+        for i in self._substring_candidates(q):
+            if i not in tiers and q in self.normalized[i]:
+                tiers[i] = 3
+
+        best = sorted(tiers, key=lambda i: (tiers[i], -self.weights[i], len(self.normalized[i]), self.normalized[i]))
+        return [self.names[i] for i in best[:limit]]
+
+    def _substring_candidates(self, q: str) -> Set[int]:
+        if len(q) <= GRAM_SIZE:
+            return self._grams.get(q, set())
+        grams = sorted(
+            (self._grams.get(q[start:start + GRAM_SIZE], set()) for start in range(len(q) - GRAM_SIZE + 1)), key=len
+        )
+        if not grams[0]:
+            return set()
+        return grams[0].intersection(*grams[1:])
+
+
+class LRUCache:
+    """A plain size-bounded least-recently-used cache."""
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, object]" = OrderedDict()
+
+    def get(self, key: Hashable, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key: Hashable, value: object) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
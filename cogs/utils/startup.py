@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/startup.py
+
+# Dependency-aware extension load order, and the startup timing report.
+# An extension declares the extensions it needs with a module-level tuple, e.g. dependencies = ("cogs.admin",).
+# It's read from the source without importing the module, so the load order is known before anything is loaded.
+# The config file can add more with extension_dependencies = {"cogs.x": ("cogs.y",)}.
+
+import ast
+import importlib.util
+import json
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger("discord")
+
+
+def declared_dependencies(name: str) -> Tuple[str, ...]:
+    """Read `dependencies = (...)` from an extension's source without importing it."""
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return ()
+    if spec is None or not spec.origin or not spec.origin.endswith(".py"):
+        return ()
+    try:
+        with open(spec.origin, "r", encoding="utf-8") as file:
+            tree = ast.parse(file.read(), filename=spec.origin)
+    except (OSError, SyntaxError):
+        # Let load_extension report the real problem.
+        return ()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "dependencies" for target in node.targets
+        ):
+            try:
+                return tuple(ast.literal_eval(node.value))
+            except ValueError:
+                log.warning(
+                    f"Startup: {name} has a dependencies setting that isn't a plain tuple of names, so it was ignored."
+                )
+    return ()
+
+
+def load_waves(names: Iterable[str], dependencies: Dict[str, Iterable[str]]) -> List[List[str]]:
+    """Group extensions into waves: everything in a wave only depends on extensions in earlier waves."""
+    names = list(dict.fromkeys(names))
+    remaining = {name: {dep for dep in dependencies.get(name, ()) if dep in names} for name in names}
+    for name in names:
+        missing = [dep for dep in dependencies.get(name, ()) if dep not in names]
+        if missing:
+            log.warning(f"Startup: {name} depends on {', '.join(missing)}, which isn't in initial_extensions.")
+
+    waves = []
+    loaded = set()
+    while remaining:
+        wave = [name for name, deps in remaining.items() if deps <= loaded]
+        if not wave:
+            # A dependency cycle. Load the rest one after another in the configured order rather than not at all.
+            log.error(f"Startup: Dependency cycle between {', '.join(remaining)}. Loading them in config order.")
+            waves.extend([name] for name in remaining)
+            break
+        waves.append(wave)
+        loaded.update(wave)
+        for name in wave:
+            del remaining[name]
+    return waves
+
+
+class StartupReport:
+    """How long each part of startup took, relative to when the bot was created."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.extensions: Dict[str, Dict[str, object]] = {}
+        self.shards: Dict[int, float] = {}
+        # Whether the extensions were loaded one at a time. If not, their times overlap.
+        self.sequential = False
+        self._setup_times: Dict[str, float] = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def mark(self, phase: str) -> None:
+        self.phases.setdefault(phase, round(self.elapsed(), 4))
+
+    def add_setup_time(self, module: str, duration: float) -> None:
+        # add_cog time (including cog_load), which is the part of load_extension that isn't the import.
+        self._setup_times[module] = self._setup_times.get(module, 0.0) + duration
+
+    def extension_loaded(self, name: str, wave: int, duration: float, error: Optional[BaseException] = None) -> None:
+        setup = sum(
+            seconds for module, seconds in self._setup_times.items() if module == name or module.startswith(f"{name}.")
+        )
+        self.extensions[name] = {
+            "wave": wave,
+            "total": round(duration, 4),
+            "import": round(max(duration - setup, 0.0), 4),
+            "setup": round(setup, 4),
+            "status": "ok" if error is None else f"{error.__class__.__name__}: {error}",
+        }
+
+    def shard_ready(self, shard_id: int) -> None:
+        self.shards.setdefault(shard_id, round(self.elapsed(), 4))
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"phases": self.phases, "extensions": self.extensions, "shards": self.shards, "sequential": self.sequential}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def table(self) -> str:
+        lines = [f"{'extension':<30} {'wave':>4} {'import':>9} {'setup':>9} {'total':>9}  status"]
+        for name, timing in self.extensions.items():
+            lines.append(
+                f"{name:<30} {timing['wave']:>4} {timing['import'] * 1000:>7.1f}ms {timing['setup'] * 1000:>7.1f}ms "
+                f"{timing['total'] * 1000:>7.1f}ms  {timing['status']}"
+            )
+        if not self.sequential and len(self.extensions) > 1:
+            lines.append(
+                "(Extensions in a wave were loaded at the same time, so their times overlap. launcher.py coldstart "
+                "times them one at a time.)"
+            )
+        for phase, at in self.phases.items():
+            lines.append(f"{phase:<30} at {at * 1000:.1f}ms")
+        for shard_id, at in sorted(self.shards.items()):
+            lines.append(f"{f'shard {shard_id} ready':<30} at {at * 1000:.1f}ms")
+        return "\n".join(lines)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/store.py
+
+# The bot's state that has to survive a restart, in one SQLite file:
+#   - the announcement ledger: every event announcement that was posted, so nothing is posted twice across restarts;
+#   - the last scheduled event snapshot per guild, so the events cog can start from it instead of refetching every guild;
+#   - the command tree hashes of the last successful syncs (see treesync.py);
+#   - when the bot was last known to be running, so the events cog knows which announcements it missed while it was down.
+# SQLite blocks, so every query runs in a worker thread with asyncio.to_thread, one at a time. Cluster workers share the file.
+# The bot has it as bot.store.
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+log = logging.getLogger("discord")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS announcements (
+    guild_id INTEGER NOT NULL,
+    event_id INTEGER NOT NULL,
+    hours INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY (guild_id, event_id, hours, start_time)
+);
+CREATE INDEX IF NOT EXISTS announcements_start_time ON announcements (start_time);
+CREATE TABLE IF NOT EXISTS event_snapshots (
+    guild_id INTEGER PRIMARY KEY,
+    events TEXT NOT NULL,
+    saved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS command_hashes (
+    scope TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+"""
+
+# (guild ID, event ID, hours before the event, start time as a unix timestamp)
+AnnouncementKey = Tuple[int, int, int, int]
+
+
+class Store:
+    """The bot's persistent state, in SQLite."""
+
+    def __init__(self, path: str = "data/discordbot.sqlite3", *, name: str = "main") -> None:
+        self.path = path
+        # Cluster workers each keep their own last_alive.
+        self.name = name
+        # When the bot was last known to be running, as of when the store was opened. None the first time the bot runs,
+        # and once the events cog has used it.
+        self.previous_alive: Optional[float] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    async def open(self) -> None:
+        if self._connection is None:
+            await asyncio.to_thread(self._open)
+            self.previous_alive = await self.last_alive()
+            await self.touch_alive()
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        # WAL lets cluster workers read while another one writes.
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        self._connection = connection
+
+    async def close(self) -> None:
+        if self._connection is None:
+            return
+        await self.touch_alive()
+        connection, self._connection = self._connection, None
+        await asyncio.to_thread(self._locked, connection.close)
+
+    def _locked(self, function: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            return function(*args)
+
+    async def _run(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        if self._connection is None:
+            raise RuntimeError("The store isn't open.")
+        return await asyncio.to_thread(self._locked, function, self._connection)
+
+    async def _write(self, statements: Iterable[Tuple[str, tuple]]) -> None:
+        statements = list(statements)
+        if not statements:
+            return
+
+        def write(connection: sqlite3.Connection) -> None:
+            with connection:
+                connection.execute("BEGIN")
+                for sql, parameters in statements:
+                    connection.execute(sql, parameters)
+
+        await self._run(write)
+
+    # Liveness
+
+    async def last_alive(self) -> Optional[float]:
+        rows = await self._run(
+            lambda connection: connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (f"last_alive:{self.name}",)
+            ).fetchall()
+        )
+        return float(rows[0][0]) if rows else None
+
+    async def touch_alive(self) -> None:
+        await self._write(
+            [("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"last_alive:{self.name}", str(time.time())))]
+        )
+
+    # The announcement ledger
+
+    async def announcements(self, since: float) -> Set[AnnouncementKey]:
+        """Every announcement for an event starting after since."""
+        rows = await self._run(lambda connection: connection.execute(
+            "SELECT guild_id, event_id, hours, start_time FROM announcements WHERE start_time >= ?", (int(since),)).fetchall())
+        return {tuple(row) for row in rows}
+
+    async def record_announcements(self, keys: Iterable[AnnouncementKey]) -> None:
+        now = time.time()
+        await self._write(
+            (
+                "INSERT OR IGNORE INTO announcements (guild_id, event_id, hours, start_time, sent_at) VALUES (?, ?, ?, ?, ?)",
+                (*key, now),
+            )
+            for key in keys
+        )
+
+    async def prune_announcements(self, before: float) -> None:
+        await self._write([("DELETE FROM announcements WHERE start_time < ?", (int(before),))])
+
+    # Scheduled event snapshots
+
+    async def event_snapshots(self) -> Dict[int, List[dict]]:
+        rows = await self._run(
+            lambda connection: connection.execute("SELECT guild_id, events FROM event_snapshots").fetchall()
+        )
+        snapshots = {}
+        for guild_id, events in rows:
+            try:
+                snapshots[guild_id] = json.loads(events)
+            except ValueError:
+                log.warning(f"Store: The event snapshot for guild {guild_id} is unreadable. Ignoring it.")
+        return snapshots
+
+    async def save_event_snapshots(self, snapshots: Dict[int, Optional[List[dict]]]) -> None:
+        """Replace the snapshot of each guild given. None deletes a guild's snapshot."""
+        now = time.time()
+        await self._write(
+            (
+                ("DELETE FROM event_snapshots WHERE guild_id = ?", (guild_id,))
+                if events is None
+                else (
+                    "INSERT OR REPLACE INTO event_snapshots (guild_id, events, saved_at) VALUES (?, ?, ?)",
+                    (guild_id, json.dumps(events, separators=(",", ":")), now),
+                )
+            )
+            for guild_id, events in snapshots.items()
+        )
+
+    # Command tree hashes
+
+    async def command_hashes(self) -> Dict[str, str]:
+        rows = await self._run(lambda connection: connection.execute("SELECT scope, hash FROM command_hashes").fetchall())
+        return dict(rows)
+
+    async def save_command_hashes(self, hashes: Dict[str, str]) -> None:
+        await self._write(
+            ("INSERT OR REPLACE INTO command_hashes (scope, hash) VALUES (?, ?)", item) for item in hashes.items()
+        )
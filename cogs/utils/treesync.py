@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/treesync.py
+
+# Syncs the app command tree only where it actually changed.
+# Each scope (global, or one guild) gets a hash of the exact payload tree.sync() would send. The hashes of the last
+# successful syncs are kept in the bot's store (cogs/utils/store.py), and a scope is only synced again when its hash is
+# different. The sync endpoint is heavily rate-limited, so the syncs that do happen are spaced out and only a couple run
+# at once.
+# The bot has it as bot.tree_sync.
+
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+import discord
+
+from cogs.utils.store import Store
+
+log = logging.getLogger("discord")
+
+GLOBAL_SCOPE = "global"
+
+
+def _scope_key(guild_id: Optional[int]) -> str:
+    return GLOBAL_SCOPE if guild_id is None else str(guild_id)
+
+
+def _scope_name(key: str) -> str:
+    return "global" if key == GLOBAL_SCOPE else f"guild {key}"
+
+
+def payload_hash(payload: list) -> str:
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+EMPTY_HASH = payload_hash([])
+
+
+class SyncReport:
+    """Which scopes were synced, skipped (unchanged) or failed."""
+
+    def __init__(self) -> None:
+        self.synced: List[str] = []
+        self.skipped: List[str] = []
+        self.failed: Dict[str, str] = {}
+        self.duration = 0.0
+
+    def __str__(self) -> str:
+        text = f"{len(self.synced)} synced, {len(self.skipped)} unchanged, {len(self.failed)} failed in {self.duration:.1f}s"
+        if self.synced:
+            text += f". Synced: {', '.join(_scope_name(key) for key in self.synced)}"
+        if self.failed:
+            text += f". Failed: {', '.join(f'{_scope_name(key)} ({error})' for key, error in self.failed.items())}"
+        return text
+
+
+class TreeSync:
+    """Hash-diffed, rate-limit-aware command tree sync."""
+
+    def __init__(
+        self,
+        tree: discord.app_commands.CommandTree,
+        store: Store,
+        *,
+        concurrency: int = 2,
+        spacing: float = 1.0,
+        include_global: bool = True,
+    ) -> None:
+        self.tree = tree
+        self.store = store
+        self.include_global = include_global
+        self.spacing = spacing
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_start = 0.0
+        self._hashes: Optional[Dict[str, str]] = None
+
+    async def payload(self, guild_id: Optional[int]) -> list:
+        guild = discord.Object(id=guild_id) if guild_id is not None else None
+        commands = self.tree.get_commands(guild=guild)
+        translator = self.tree.translator
+        if translator:
+            return [await command.get_translated_payload(self.tree, translator) for command in commands]
+        return [command.to_dict(self.tree) for command in commands]
+
+    async def sync(
+        self, guild_ids: Optional[Iterable[Optional[int]]] = None, *, force: bool = False, dry_run: bool = False
+    ) -> SyncReport:
+        """Sync the given scopes (None is global), or every scope the bot knows about, skipping the ones that haven't changed.
+        Without include_global, "every scope" leaves out the global one, for cluster workers other than the first."""
+        started = time.perf_counter()
+        hashes = await self._load()
+        if guild_ids is None:
+            # Cluster workers share the store, so leave out the guilds on other workers' shards.
+            owned = getattr(self.tree.client, "has_guild_shard", lambda guild_id: True)
+            guild_ids = [
+                *(guild.id for guild in self.tree.client.guilds),
+                *(int(key) for key in hashes if key != GLOBAL_SCOPE and owned(int(key))),
+            ]
+            if self.include_global:
+                guild_ids.insert(0, None)
+
+        report = SyncReport()
+        pending = []
+        for guild_id in dict.fromkeys(guild_ids):
+            key = _scope_key(guild_id)
+            digest = payload_hash(await self.payload(guild_id))
+            if not force and hashes.get(key, EMPTY_HASH) == digest:
+                report.skipped.append(key)
+            else:
+                pending.append((guild_id, key, digest))
+
+        if not dry_run:
+            await asyncio.gather(*(self._sync_scope(guild_id, key, digest, report) for guild_id, key, digest in pending))
+            if report.synced:
+                await self._save(report.synced)
+        else:
+            report.synced = [key for _, key, _ in pending]
+
+        report.duration = time.perf_counter() - started
+        log.info(f"TreeSync: {'Dry run: ' if dry_run else ''}{report}.")
+        return report
+
+    async def clear(self, guild_id: Optional[int]) -> None:
+        """Remove a scope's commands (None is global) from the tree and from Discord."""
+        guild = discord.Object(id=guild_id) if guild_id is not None else None
+        key = _scope_key(guild_id)
+        # Remember that the scope is empty before syncing, so the next sync() sees that it changed even if this one
+        # doesn't finish. Otherwise the stored hash would still match the commands the bot starts with and the scope
+        # would never come back.
+        await self._load()
+        self._hashes[key] = EMPTY_HASH
+        await self._save([key])
+        self.tree.clear_commands(guild=guild)
+        await self.tree.sync(guild=guild)
+
+    async def _sync_scope(self, guild_id: Optional[int], key: str, digest: str, report: SyncReport) -> None:
+        guild = discord.Object(id=guild_id) if guild_id is not None else None
+        async with self._semaphore:
+            for attempt in range(2):
+                # Space the syncs out instead of sending them all in the same second.
+                now = time.monotonic()
+                start_at = max(now, self._next_start)
+                self._next_start = start_at + self.spacing
+                if start_at > now:
+                    await asyncio.sleep(start_at - now)
+                try:
+                    await self.tree.sync(guild=guild)
+                except discord.RateLimited as e:
+                    if attempt == 0:
+                        log.warning(
+                            f"TreeSync: Rate limited while syncing {_scope_name(key)}. Retrying in {e.retry_after:.1f}s."
+                        )
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    report.failed[key] = f"rate limited for {e.retry_after:.0f}s"
+                except discord.HTTPException as e:
+                    report.failed[key] = f"{e.__class__.__name__}: {e.text or e.status}"
+                except Exception as e:
+                    report.failed[key] = f"{e.__class__.__name__}: {e}"
+                else:
+                    self._hashes[key] = digest
+                    report.synced.append(key)
+                return
+
+    async def _load(self) -> Dict[str, str]:
+        if self._hashes is None:
+            self._hashes = await self.store.command_hashes()
+            if not self._hashes:
+                self._hashes = await asyncio.to_thread(self._read_legacy)
+                if self._hashes:
+                    await self._save(self._hashes)
+        return self._hashes
+
+    # The hashes used to be kept in JSON files. Bring them over once, so upgrading doesn't resync everything.
+    def _read_legacy(self) -> Dict[str, str]:
+        hashes = {}
+        for path in sorted(glob.glob("data/command_hashes*.json")):
+            try:
+                with open(path, "r") as file:
+                    hashes.update(json.load(file))
+            except (OSError, ValueError) as e:
+                log.warning(f"TreeSync: Could not read {path} ({e}). Its scopes will be synced again.")
+        return hashes
+
+    # Only the given scopes are written. Cluster workers share the table, and the rest of this worker's hashes may be older
+    # than what another worker has saved since.
+    async def _save(self, keys: Iterable[str]) -> None:
+        await self.store.save_command_hashes({key: self._hashes[key] for key in keys})
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Discord bot: cogs/utils/watchdog.py
+
+# Event loop stall detector. A thread asks the event loop to run a tiny callback every interval. If the loop doesn't get to it
+# within the threshold, something is blocking the loop (and with it every shard's heartbeat), so the thread grabs the main
+# thread's stack right then, along with the task and cog that were running, and logs it. Recent stalls are kept for /stalls.
+# When the bot runs under systemd with WatchdogSec= set, the same thread sends WATCHDOG=1, but only while the loop is
+# responsive, so systemd restarts a bot whose loop is stuck instead of one that's merely busy.
+# The bot has it as bot.watchdog.
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, List, Optional
+
+from discord.ext import commands
+
+log = logging.getLogger("discord")
+
+# Frames of the main thread's stack to keep for each stall.
+STACK_LIMIT = 25
+
+
+class Stall:
+    __slots__ = ("started", "duration", "ongoing", "task", "coroutine", "cog", "stack")
+
+    def __init__(self, started: float, task: Optional[str], coroutine: Optional[str], cog: Optional[str], stack: str) -> None:
+        self.started = started  # time.time() of when the loop stopped responding
+        self.duration = 0.0
+        self.ongoing = True
+        self.task = task
+        self.coroutine = coroutine
+        self.cog = cog
+        self.stack = stack
+
+    def describe(self) -> str:
+        where = ", ".join(part for part in (
+            f"cog {self.cog}" if self.cog else None,
+            f"coroutine {self.coroutine}" if self.coroutine else None,
+            f"task {self.task}" if self.task else None,
+        ) if part) or "outside any task"
+        length = f"{self.duration:.2f}s so far" if self.ongoing else f"{self.duration:.2f}s"
+        return f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}: blocked for {length} in {where}"
+
+
+def sd_notify(message: str) -> bool:
+    """Send a message to systemd's notify socket, if there is one."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode("utf-8"))
+    except OSError as e:
+        log.warning(f"Watchdog: Could not notify systemd. {e}")
+        return False
+    return True
+
+
+class LoopWatchdog(threading.Thread):
+    """Watches the event loop from a separate thread."""
+
+    def __init__(
+        self, *, threshold: float = 0.5, interval: float = 0.25, history: int = 50, systemd: bool = False, on_stall=None
+    ) -> None:
+        super().__init__(name="loop watchdog", daemon=True)
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: Deque[Stall] = deque(maxlen=history)
+        self.on_stall = on_stall
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._sent: Optional[float] = None  # When the pending beat was sent, if there is one.
+        self._last_beat = time.monotonic()
+        self._current: Optional[Stall] = None
+
+        # systemd sets WATCHDOG_USEC when the unit has WatchdogSec=. Ping it twice per period, as it recommends.
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        self._systemd_interval = int(watchdog_usec) / 2_000_000 if systemd and watchdog_usec else None
+        self._last_notify = 0.0
+
+    def start_watching(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        """Call this from the event loop's thread."""
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self.start()
+        if self._systemd_interval:
+            sd_notify("READY=1")
+            log.info(f"Watchdog: Sending systemd keepalives every {self._systemd_interval:.1f}s.")
+
+    def stop(self, timeout: float = 2.0) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def recent(self, count: int = 5) -> List[Stall]:
+        with self._lock:
+            return list(self.stalls)[-count:][::-1]
+
+    # Runs in the watchdog thread.
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            now = time.monotonic()
+            stall = None
+            with self._lock:
+                sent = self._sent
+                if sent is None:
+                    self._sent = now
+                elif now - sent >= self.threshold:
+                    if self._current is None:
+                        self._current = self._capture(time.time() - (now - sent))
+                        self.stalls.append(self._current)
+                        stall = self._current
+                    else:
+                        self._current.duration = now - sent
+            if sent is None:
+                try:
+                    self._loop.call_soon_threadsafe(self._beat, now)
+                except RuntimeError:
+                    # The loop is closed.
+                    return
+            elif stall is not None:
+                stall.duration = now - sent
+                log.warning(f"Watchdog: The event loop is blocked. {stall.describe()}\n{stall.stack}")
+            self._notify_systemd(now)
+
+    # Runs on the event loop.
+    def _beat(self, sent: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._sent = None
+            self._last_beat = now
+            stall, self._current = self._current, None
+            if stall is not None:
+                stall.duration = now - sent
+                stall.ongoing = False
+        if stall is not None:
+            log.warning(f"Watchdog: The event loop is responding again. {stall.describe()}")
+            if self.on_stall is not None:
+                self.on_stall(stall)
+
+    def _capture(self, started: float) -> Stall:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        task = None
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            pass
+        coroutine = None
+        if task is not None:
+            coro = task.get_coro()
+            coroutine = getattr(coro, "__qualname__", None) or repr(coro)
+        cog = None
+        stack = ""
+        if frame is not None:
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            cog = _find_cog(frame)
+        return Stall(started, task.get_name() if task is not None else None, coroutine, cog, stack)
+
+    def _notify_systemd(self, now: float) -> None:
+        if not self._systemd_interval or now - self._last_notify < self._systemd_interval:
+            return
+        # Only vouch for the bot while the loop is answering.
+        if now - self._last_beat <= max(self._systemd_interval, self.threshold + self.interval):
+            sd_notify("WATCHDOG=1")
+            self._last_notify = now
+
+
+def _find_cog(frame) -> Optional[str]:
+    """The innermost cog method on the stack."""
+    while frame is not None:
+        owner = frame.f_locals.get("self")
+        if isinstance(owner, commands.Cog):
+            return owner.qualified_name
+        frame = frame.f_back
+    return None
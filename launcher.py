@@ -4,12 +4,21 @@
 import asyncio
 import contextlib
 import logging
+import os
+import signal
+import sys
+import tempfile
 from logging.handlers import RotatingFileHandler
 
+import aiohttp
 import click
 import discord
 
+import config
 from bot import DiscordBot
+from cogs.utils.cluster import Supervisor, format_shard_ids, parse_shard_ids
+from cogs.utils.logqueue import BatchRotatingFileHandler, BatchWriter, BoundedQueueHandler, JSONFormatter
+from cogs.utils.logstats import parse_time, scan
 from config import discordbot_token
 
 
@@ -22,9 +31,13 @@ class RemoveNoise(logging.Filter):
             return False
         return True
 
+
+# log_mode = "queue" (the default) hands records to a background writer thread. "sync" writes them on the event loop
+# like before.
 @contextlib.contextmanager
-def setup_logging():
+def setup_logging(filename: str = "logs/DiscordBot.log"):
     log = logging.getLogger()
+    writer = None
 
     try:
         discord.utils.setup_logging()
@@ -34,25 +47,104 @@ def setup_logging():
         logging.getLogger("discord.state").addFilter(RemoveNoise())
 
         log.setLevel(logging.INFO)
-        handler = RotatingFileHandler(filename="logs/DiscordBot.log", encoding="utf-8", mode="w", maxBytes=max_bytes, backupCount=5)
-        dt_fmt = "%Y-%m-%d %H:%M:%S"
-        fmt = logging.Formatter("[{asctime}] [{levelname:<7}] {name}: {message}", dt_fmt, style="{")
+        queued = getattr(config, "log_mode", "queue") == "queue"
+        handler_class = BatchRotatingFileHandler if queued else RotatingFileHandler
+        handler_options = {"compress": getattr(config, "log_compress", False)} if queued else {}
+        handler = handler_class(
+            filename=filename, encoding="utf-8", mode="w", maxBytes=max_bytes, backupCount=5, **handler_options
+        )
+        if getattr(config, "log_json", False):
+            fmt = JSONFormatter()
+        else:
+            dt_fmt = "%Y-%m-%d %H:%M:%S"
+            fmt = logging.Formatter("[{asctime}] [{levelname:<7}] {name}: {message}", dt_fmt, style="{")
         handler.setFormatter(fmt)
         log.addHandler(handler)
 
+        if queued:
+            # Move the real handlers behind the queue. The root logger only has the queue handler left.
+            queue_handler = BoundedQueueHandler(
+                maxsize=getattr(config, "log_queue_size", 10000),
+                drop_policy=getattr(config, "log_drop_policy", "drop_new"),
+            )
+            writer = BatchWriter(queue_handler, log.handlers[:])
+            for hdlr in writer.handlers:
+                log.removeHandler(hdlr)
+            log.addHandler(queue_handler)
+            writer.start()
+
         yield
     finally:
         # __exit__
         handlers = log.handlers[:]
+        if writer is not None:
+            writer.stop()
+            handlers += writer.handlers
         for hdlr in handlers:
             hdlr.close()
             log.removeHandler(hdlr)
 
+
 async def run_bot():
 #    log = logging.getLogger()
     async with DiscordBot() as bot:
         await bot.start(discordbot_token)
 
+
+async def run_worker(cluster_id: int, shard_ids: list, shard_count: int, port: int):
+    async with DiscordBot(shard_ids=shard_ids, shard_count=shard_count, cluster_id=cluster_id, cluster_port=port) as bot:
+        await bot.start(discordbot_token)
+
+
+async def recommended_shard_count() -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{discord.http.Route.BASE}/gateway/bot", headers={"Authorization": f"Bot {discordbot_token}"}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+async def run_cluster(processes: int, shard_count: int) -> None:
+    if not shard_count:
+        shard_count = await recommended_shard_count()
+    launcher = os.path.abspath(__file__)
+
+    def command(cluster_id: int, shard_ids: range, port: int) -> list:
+        return [
+            sys.executable,
+            launcher,
+            "worker",
+            "--cluster-id",
+            str(cluster_id),
+            "--shard-ids",
+            format_shard_ids(shard_ids),
+            "--shard-count",
+            str(shard_count),
+            "--port",
+            str(port),
+        ]
+
+    supervisor = Supervisor(shard_count, processes, command)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, supervisor.stop)
+    await supervisor.run()
+
+
+async def measure_coldstart() -> DiscordBot:
+    # Everything setup_hook does except talking to Discord. The store and config indexes are throwaway copies, so measuring
+    # doesn't move the real last alive time (and with it the events cog's catch-up window) or rebuild the real indexes.
+    with tempfile.TemporaryDirectory(prefix="coldstart-") as directory:
+        async with DiscordBot(data_directory=directory) as bot:
+            await bot.start_services(measure_only=True)
+            bot.startup.mark("setup_hook")
+            await bot.load_initial_extensions(sequential=True)
+            bot.startup.mark("extensions loaded")
+    return bot
+
+
 @click.group(invoke_without_command=True, options_metavar="[options]")
 @click.pass_context
 def main(ctx) -> None:
@@ -61,5 +153,78 @@ def main(ctx) -> None:
         with setup_logging():
             asyncio.run(run_bot())
 
+
+@main.command()
+@click.option(
+    "--processes",
+    "-p",
+    type=click.IntRange(min=1),
+    required=True,
+    help="How many worker processes to split the shards across.",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Total shard count. Defaults to shard_count in the config file, or Discord's recommendation.",
+)
+def cluster(processes: int, shards: int) -> None:
+    """Runs the bot as several processes, each with a contiguous range of shards."""
+    with setup_logging("logs/DiscordBot-supervisor.log"):
+        asyncio.run(run_cluster(processes, shards or getattr(config, "shard_count", None)))
+
+
+# Started by the cluster supervisor, not by hand.
+@main.command(hidden=True)
+@click.option("--cluster-id", type=int, required=True)
+@click.option("--shard-ids", required=True)
+@click.option("--shard-count", type=int, required=True)
+@click.option("--port", type=int, required=True)
+def worker(cluster_id: int, shard_ids: str, shard_count: int, port: int) -> None:
+    with setup_logging(f"logs/DiscordBot-cluster{cluster_id}.log"):
+        asyncio.run(run_worker(cluster_id, parse_shard_ids(shard_ids), shard_count, port))
+
+
+@main.command()
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON.")
+def coldstart(as_json: bool) -> None:
+    """Measures startup time (imports and extension loading) without connecting to Discord."""
+    bot = asyncio.run(measure_coldstart())
+    if as_json:
+        click.echo(bot.startup.to_json())
+    else:
+        click.echo(bot.startup.table())
+
+
+@main.command()
+@click.option(
+    "--since", default="24h", show_default=True, help="Start of the window: an age like 30m, 24h or 7d, or a date and time."
+)
+@click.option("--until", default=None, help="End of the window, in the same format. Defaults to now.")
+@click.option(
+    "--logs",
+    "directory",
+    type=click.Path(exists=True, file_okay=False),
+    default="logs",
+    show_default=True,
+    help="The log directory.",
+)
+@click.option(
+    "--top", type=click.IntRange(min=1), default=10, show_default=True, help="How many commands, guilds and so on to list."
+)
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON.")
+def logstats(since: str, until: str, directory: str, top: int, as_json: bool) -> None:
+    """Summarizes the log files: commands and their errors by guild, event loop stalls and reconnects."""
+    try:
+        window = parse_time(since), parse_time(until) if until else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--since/--until")
+    stats = scan(directory, *window)
+    if as_json:
+        click.echo(stats.to_json())
+    else:
+        click.echo(stats.table(top))
+
+
 if __name__ == "__main__":
     main()